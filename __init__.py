@@ -16,8 +16,10 @@ from product import (
 )
 from sale import Sale
 from party import Party, Address
-from country import Subdivision
+from country import Subdivision, SubdivisionAmazonAlias
 from shipment import ShipmentOut
+from throttle import MWSThrottle
+from feed import AmazonFeedSubmission, AmazonFeedQueue
 
 
 def register():
@@ -35,8 +37,12 @@ def register():
         Party,
         Address,
         Subdivision,
+        SubdivisionAmazonAlias,
         ProductSaleChannelListing,
         ShipmentOut,
+        MWSThrottle,
+        AmazonFeedSubmission,
+        AmazonFeedQueue,
         module='amazon_mws', type_='model'
     )
     Pool.register(
@@ -3,19 +3,34 @@
     channle.py
 
 """
+import sys
+import Queue
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, time, timedelta
+import multiprocessing
+from itertools import islice
+from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
 from mws import mws
-from lxml import etree
 from lxml.builder import E
 from dateutil.relativedelta import relativedelta
 
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, Button
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.pool import Pool, PoolMeta
 
+from throttle import ThrottledAPI
+from import_cache import import_cache_run, get_import_cache
+from report import (
+    CATALOG_REPORT_TYPES, REPORT_ENCODING, REPORT_TIMEOUT, iter_report_rows,
+    iter_catalog_rows, get_generated_reports
+)
+
 __metaclass__ = PoolMeta
 
 __all__ = [
@@ -30,6 +45,21 @@ AMAZON_MWS_STATES = {
 
 logger = logging.getLogger("amazon_mws")
 
+#: Number of pages of orders fetched ahead of the import
+PREFETCH_PAGES = 1
+
+#: Number of threads fetching the items of new orders
+ORDER_ITEMS_WORKERS = 4
+
+#: Number of SKUs and ASINs of which the product is kept in cache
+PRODUCT_CACHE_SIZE = 10000
+
+#: Maximum number of ids in a GetMatchingProductForId request
+MATCHING_PRODUCT_IDS_LIMIT = 5
+
+#: Number of rows of the catalog reports imported at once
+CATALOG_BATCH_SIZE = 1000
+
 
 def batch(iterable, n=1):
     l = len(iterable)
@@ -37,6 +67,195 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
+def prefetch(iterable, size=1):
+    """
+    Iterate over `iterable` in a background thread, keeping at most `size`
+    items ready ahead of the consumer.
+
+    The iterable must not use the transaction as it is consumed in
+    another thread. Exceptions are raised to the consumer.
+    """
+    items = Queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, exc_info=None):
+        # Give up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                items.put((item, exc_info), timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception:
+            put(done, sys.exc_info())
+        else:
+            put(done)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, exc_info = items.get()
+            if item is done:
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def iter_order_pages(order_api, list_orders_kwargs=None, next_token=None):
+    """
+    Yield the pages of orders from amazon as (orders, next_token), where
+    next_token is the token of the following page or None.
+
+    Orders are deduplicated in the page by AmazonOrderId.
+
+    :param order_api: Order api instance
+    :param list_orders_kwargs: Arguments of ListOrders for the first page
+    :param next_token: Start from this page instead of calling ListOrders
+    """
+    if next_token is None:
+        response = order_api.list_orders(**list_orders_kwargs).parsed
+    else:
+        response = order_api.list_orders_by_next_token(next_token).parsed
+
+    while True:
+        orders = OrderedDict()
+        if response.get('Orders'):
+            # Orders are returned as dictionary for single order and as
+            # list for multiple orders.
+            page_orders = response['Orders']['Order']
+            if not isinstance(page_orders, list):
+                page_orders = [page_orders]
+            for order in page_orders:
+                orders[order['AmazonOrderId']['value']] = order
+
+        next_token = response.get('NextToken') and \
+            response['NextToken']['value'] or None
+        yield orders.values(), next_token
+
+        if not next_token:
+            return
+        response = order_api.list_orders_by_next_token(next_token).parsed
+
+
+def fetch_order_items(order_api, order_ids, workers=ORDER_ITEMS_WORKERS):
+    """
+    Fetch the items of the orders with a bounded pool of threads.
+
+    The throttling of the api is shared by the threads, so the pool never
+    exceeds the ListOrderItems quota.
+
+    :param order_api: Order api instance
+    :param order_ids: List of AmazonOrderId
+    :return: Iterator over the OrderItem data, in the order of order_ids
+    """
+    def fetch(order_id):
+        return order_api.list_order_items(
+            order_id
+        ).parsed['OrderItems']['OrderItem']
+
+    if len(order_ids) < 2:
+        for order_id in order_ids:
+            yield fetch(order_id)
+        return
+
+    pool = ThreadPool(min(workers, len(order_ids)))
+    try:
+        for items in pool.imap(fetch, order_ids):
+            yield items
+    finally:
+        pool.terminate()
+
+
+# Databases and transaction inherited by the scheduler workers from the
+# parent process
+_inherited_databases = []
+_inherited_transactions = []
+
+
+def init_sync_worker():
+    """
+    Initialise a scheduler worker process so that it opens its own
+    database connections and transaction.
+
+    The worker is forked from the thread running the transaction of the
+    cron, so the thread local transaction of the worker holds the user,
+    context and cursor of the parent.
+    """
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        # Keep a reference so that the connections of the parent process
+        # are never closed by the worker.
+        _inherited_databases.append(dict(databases))
+        databases.clear()
+
+    transaction = Transaction()
+    # Keep a reference for the same reason, clearing the thread local
+    # attributes restores the defaults of an idle transaction.
+    _inherited_transactions.append(dict(transaction.__dict__))
+    transaction.__dict__.clear()
+
+
+def sync_merchant_channels(args):
+    """
+    Import orders and update order status of the channels of a merchant
+    account, in its own transaction.
+
+    :param args: Tuple of (database name, user id, list of channel ids)
+    :return: List of dictionaries of statistics per channel
+    """
+    database_name, user, channel_ids = args
+
+    if database_name not in Pool.database_list():
+        Pool(database_name).init()
+
+    stats = []
+    with Transaction().start(database_name, user):
+        Cache.clean(database_name)
+        SaleChannel = Pool().get('sale.channel')
+
+        for channel in SaleChannel.browse(channel_ids):
+            stat = {
+                'channel': channel.id,
+                'name': channel.name,
+                'merchant': channel.amazon_merchant_id,
+                'orders': 0,
+                'error': None,
+            }
+            start = datetime.utcnow()
+            try:
+                with Transaction().set_context(company=channel.company.id):
+                    stat['orders'] = len(channel.import_orders())
+                    stat['import_duration'] = (
+                        datetime.utcnow() - start
+                    ).total_seconds()
+                    channel.update_order_status()
+                Transaction().cursor.commit()
+            except Exception, e:
+                Transaction().cursor.rollback()
+                logger.exception(
+                    "Synchronisation of channel %s failed" % channel.name
+                )
+                stat['error'] = unicode(e)
+            stat['duration'] = (datetime.utcnow() - start).total_seconds()
+            stats.append(stat)
+        Cache.resets(database_name)
+    return stats
+
+
 class SaleChannel:
     "Amazon MWS Account"
     __name__ = 'sale.channel'
@@ -60,6 +279,79 @@ class SaleChannel:
         domain=[('type', '=', 'warehouse')],
         states=AMAZON_MWS_STATES, depends=['source']
     )
+    amazon_order_import_mode = fields.Selection([
+        ('window', 'Last 10 Days'),
+        ('incremental', 'Incremental'),
+    ], 'Order Import Mode', states=AMAZON_MWS_STATES, depends=['source'],
+        help="Incremental imports only the orders updated since the last "
+        "import, Last 10 Days always imports the orders of the last 10 days"
+    )
+    amazon_import_overlap = fields.Integer(
+        'Import Overlap (Minutes)', states={
+            'invisible': ~(
+                (Eval('source') == 'amazon_mws') &
+                (Eval('amazon_order_import_mode') == 'incremental')
+            ),
+        }, depends=['source', 'amazon_order_import_mode'],
+        help="Orders updated this many minutes before the last import are "
+        "fetched again, so that orders updated during the last import "
+        "are not missed"
+    )
+
+    amazon_last_shipment_export_time = fields.DateTime(
+        'Export Shipments Done Since', states={
+            'invisible': ~(Eval('source') == 'amazon_mws'),
+        }, depends=['source'],
+        help="Shipments done from this date and not exported yet are "
+        "exported to amazon by the cron"
+    )
+    amazon_next_token = fields.Text('Next Token', readonly=True)
+    amazon_next_token_after = fields.DateTime(
+        'Next Token Updated After', readonly=True,
+        help="LastUpdatedAfter of the import the next token belongs to"
+    )
+    amazon_next_token_before = fields.DateTime(
+        'Next Token Import Time', readonly=True,
+        help="Time at which the import the next token belongs to started"
+    )
+    amazon_catalog_requests = fields.Char(
+        'Catalog Report Requests', readonly=True,
+        help="ReportRequestId of the catalog reports not imported yet"
+    )
+    amazon_catalog_request_time = fields.DateTime(
+        'Catalog Request Time', readonly=True
+    )
+
+    amazon_commit_per_page = fields.Boolean(
+        'Commit Each Page', states={
+            'invisible': ~(Eval('source') == 'amazon_mws'),
+        }, depends=['source'],
+        help="Commit the orders of each page once imported, this keeps the "
+        "transaction small when importing big backlogs"
+    )
+
+    # Map (channel id, 'sku', SKU) to product id and
+    # (channel id, 'asin', ASIN) to (product id, listing has an FBA code)
+    _amazon_product_cache = Cache(
+        'sale_channel.amazon_product', size_limit=PRODUCT_CACHE_SIZE,
+        context=False
+    )
+
+    @staticmethod
+    def default_amazon_order_import_mode():
+        return 'incremental'
+
+    @staticmethod
+    def default_amazon_import_overlap():
+        return 30
+
+    @staticmethod
+    def default_amazon_commit_per_page():
+        return True
+
+    @staticmethod
+    def default_amazon_last_shipment_export_time():
+        return datetime.utcnow()
 
     @classmethod
     def get_source(cls):
@@ -90,7 +382,10 @@ class SaleChannel:
             "missing_product_code": (
                 'Product "%(product)s" misses Product Code'
             ),
-            'invalid_channel': 'Channel does not belong to Amazon.'
+            'invalid_channel': 'Channel does not belong to Amazon.',
+            'product_not_found': (
+                'No product found on amazon for the SKU "%(sku)s"'
+            ),
         })
 
     def validate_amazon_channel(self):
@@ -100,17 +395,101 @@ class SaleChannel:
         if self.source != 'amazon_mws':
             self.raise_user_error('invalid_channel')
 
+    @classmethod
+    def sync_amazon_channels(cls, channels=None, processes=None):
+        """
+        Import orders and update order status of amazon channels in
+        parallel, with one worker process per merchant account.
+
+        Channels of the same merchant account are synchronised one after
+        the other by the same worker as they share the request quota.
+
+        :param channels: Active record list of channels, all the amazon
+                         channels by default
+        :param processes: Maximum number of worker processes
+        :return: List of dictionaries of statistics per channel
+        """
+        if channels is None:
+            channels = cls.search([('source', '=', 'amazon_mws')])
+
+        channels_by_merchant = defaultdict(list)
+        for channel in channels:
+            channel.validate_amazon_channel()
+            channels_by_merchant[channel.amazon_merchant_id].append(
+                channel.id
+            )
+        if not channels_by_merchant:
+            return []
+
+        transaction = Transaction()
+        tasks = [
+            (transaction.cursor.database_name, transaction.user, channel_ids)
+            for channel_ids in channels_by_merchant.values()
+        ]
+        processes = min(
+            processes or multiprocessing.cpu_count(), len(tasks)
+        )
+
+        pool = multiprocessing.Pool(processes, initializer=init_sync_worker)
+        try:
+            results = pool.map(sync_merchant_channels, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        stats = [stat for result in results for stat in result]
+        for stat in stats:
+            logger.info(
+                "Channel %(name)s (%(merchant)s): %(orders)d orders in "
+                "%(duration).1f seconds" % stat
+            )
+            if stat['error']:
+                logger.warning(
+                    "Channel %(name)s failed: %(error)s" % stat
+                )
+        return stats
+
+    @classmethod
+    def sync_amazon_channels_using_cron(cls):
+        """
+        Cron method to synchronise all the amazon channels in parallel
+        """
+        cls.sync_amazon_channels()
+
+    def get_amazon_throttled_api(self, api):
+        """
+        Wrap the api instance so that calls wait for the request quota of
+        this merchant account instead of failing
+
+        :param api: mws api instance
+        :return: Throttled api instance
+        """
+        Throttle = Pool().get('amazon.mws.throttle')
+
+        return ThrottledAPI(api, Throttle.get_buckets(
+            self.amazon_merchant_id, self.amazon_marketplace_id
+        ))
+
+    def save_amazon_throttle_state(self):
+        """
+        Save the request quota state of this merchant account so that it
+        is shared with the other workers
+        """
+        Throttle = Pool().get('amazon.mws.throttle')
+
+        Throttle.persist(self.amazon_merchant_id, self.amazon_marketplace_id)
+
     def get_mws_api(self):
         """
         Create an instance of mws api
 
         :return: mws api instance
         """
-        return mws.MWS(
+        return self.get_amazon_throttled_api(mws.MWS(
             access_key=self.amazon_access_key,
             secret_key=self.amazon_secret_key,
             account_id=self.amazon_merchant_id,
-        )
+        ))
 
     def get_amazon_order_api(self):
         """
@@ -118,11 +497,11 @@ class SaleChannel:
 
         :return: order api instance
         """
-        return mws.Orders(
+        return self.get_amazon_throttled_api(mws.Orders(
             access_key=self.amazon_access_key,
             secret_key=self.amazon_secret_key,
             account_id=self.amazon_merchant_id,
-        )
+        ))
 
     def get_amazon_product_api(self):
         """
@@ -130,21 +509,31 @@ class SaleChannel:
 
         :return: Product API instance
         """
-        return mws.Products(
+        return self.get_amazon_throttled_api(mws.Products(
             access_key=self.amazon_access_key,
             secret_key=self.amazon_secret_key,
             account_id=self.amazon_merchant_id,
-        )
+        ))
 
     def get_amazon_feed_api(self):
         """
         Return an instance of feed api
         """
-        return mws.Feeds(
+        return self.get_amazon_throttled_api(mws.Feeds(
             access_key=self.amazon_access_key,
             secret_key=self.amazon_secret_key,
             account_id=self.amazon_merchant_id,
-        )
+        ))
+
+    def get_amazon_report_api(self):
+        """
+        Return an instance of report api
+        """
+        return self.get_amazon_throttled_api(mws.Reports(
+            access_key=self.amazon_access_key,
+            secret_key=self.amazon_secret_key,
+            account_id=self.amazon_merchant_id,
+        ))
 
     @classmethod
     @ModelView.button_action('amazon_mws.check_amazon_service_status')
@@ -169,14 +558,81 @@ class SaleChannel:
     def import_orders(self):
         """
         Downstream implementation of channel.import_orders
+
+        Orders are imported page by page while the next page is fetched
+        in background. After each page the NextToken of the next page is
+        saved on the channel, so that an interrupted import is resumed by
+        the next run.
+
         :return: List of active record of sale imported
         """
+        Sale = Pool().get('sale.sale')
+
         if self.source != 'amazon_mws':
             return super(SaleChannel, self).import_orders()
 
-        Date = Pool().get('ir.date')
-
         order_api = self.get_amazon_order_api()
+        sale_ids = []
+
+        if self.amazon_next_token:
+            # Resume the import interrupted by the previous run
+            last_updated_after = self.amazon_next_token_after
+            import_time = self.amazon_next_token_before
+            pages = iter_order_pages(
+                order_api, next_token=self.amazon_next_token
+            )
+            resuming = True
+        else:
+            # Watermark of this import, orders updated after this are
+            # fetched by the next import.
+            import_time = datetime.utcnow()
+            last_updated_after = self.get_amazon_last_updated_after(
+                import_time
+            )
+            pages = iter_order_pages(order_api, list_orders_kwargs={
+                'marketplaceids': [self.amazon_marketplace_id],
+                'lastupdatedafter': last_updated_after.strftime(
+                    '%Y-%m-%dT%H:%M:%SZ'
+                ),
+                # Unshipped and PartiallyShipped must be used together in
+                # this version of the Orders API section. Using one and not
+                # the other returns an error.
+                'orderstatus': self.get_amazon_order_statuses_to_import(),
+            })
+            resuming = False
+
+        # Reference data is cached for the whole run
+        with import_cache_run():
+            try:
+                for orders, next_token in prefetch(pages, PREFETCH_PAGES):
+                    resuming = False
+                    sales = self.import_mws_order_bulk(orders)
+                    sale_ids.extend(map(int, sales))
+                    self.save_amazon_order_checkpoint(
+                        next_token, last_updated_after, import_time
+                    )
+            except mws.MWSError, e:
+                # Calls wait for the request quota, so this only fails if
+                # amazon keeps throttling or refuses the request.
+                logger.warning(e.message)
+                if resuming:
+                    # The saved token is not accepted anymore, start the
+                    # window again on next run.
+                    self.save_amazon_order_checkpoint(None, None, None)
+                self.save_amazon_throttle_state()
+                return Sale.browse(sale_ids)
+
+        # Advance the watermark only once every page is imported, else
+        # the next import would skip the orders of the missing pages.
+        self.write([self], {'last_order_import_time': import_time})
+        self.save_amazon_throttle_state()
+
+        return Sale.browse(sale_ids)
+
+    def get_amazon_order_statuses_to_import(self):
+        """
+        Return the amazon OrderStatus of the orders to import
+        """
         with Transaction().set_context(include_past_orders=True):
             # Import past orders by default in case of Amazon
             # to include FBA orders also.
@@ -190,93 +646,155 @@ class SaleChannel:
                 # together.
                 order_states_to_import_in.update(
                     ('Unshipped', 'PartiallyShipped'))
+        return order_states_to_import_in
 
-        lastupdatedafter = (
-            Date.today() - relativedelta(days=10)
-        ).strftime('%Y-%m-%dT00:00:01Z')
-        response = order_api.list_orders(
-            marketplaceids=[self.amazon_marketplace_id],
-            lastupdatedafter=lastupdatedafter,
-            # Unshipped and PartiallyShipped must be used together in
-            # this version of the Orders API section. Using one and not
-            # the other returns an error.
-            orderstatus=order_states_to_import_in
-        ).parsed
-
-        if not response.get('Orders'):
-            return []
+    def save_amazon_order_checkpoint(
+            self, next_token, last_updated_after, import_time):
+        """
+        Save the token of the next page of orders to import and commit
+        the imported orders if the channel commits per page.
+
+        :param next_token: NextToken of the next page or None
+        :param last_updated_after: LastUpdatedAfter of the import window
+        :param import_time: Time at which the import window started
+        """
+        self.write([self], {
+            'amazon_next_token': next_token,
+            'amazon_next_token_after': next_token and last_updated_after,
+            'amazon_next_token_before': next_token and import_time,
+        })
+        self.save_amazon_throttle_state()
+        if self.amazon_commit_per_page:
+            Transaction().cursor.commit()
 
-        # Orders are returned as dictionary for single order and as
-        # list for multiple orders.
-        # Convert to list if dictionary is returned
-        if not isinstance(response['Orders']['Order'], list):
-            orders = [response['Orders']['Order']]
+    def get_amazon_last_updated_after(self, import_time):
+        """
+        Return the LastUpdatedAfter datetime of the orders to import
+
+        :param import_time: UTC datetime at which the import started
+        """
+        Date = Pool().get('ir.date')
+
+        if self.amazon_order_import_mode == 'incremental' and \
+                self.last_order_import_time:
+            last_updated_after = self.last_order_import_time - \
+                relativedelta(minutes=self.amazon_import_overlap or 0)
         else:
-            orders = response['Orders']['Order']
+            last_updated_after = datetime.combine(
+                Date.today() - relativedelta(days=10), time(0, 0, 1)
+            )
 
-        while response.get('NextToken'):
-            # Pull data from pagination
-            # TRY to fetch more orders, if api call limit is reached then
-            # do not continue.
-            try:
-                response = order_api.list_orders_by_next_token(
-                    response['NextToken']['value']
-                ).parsed
-            except mws.MWSError:
-                break
+        # Amazon refuses a LastUpdatedAfter later than two minutes before
+        # the request
+        return min(
+            last_updated_after, import_time - relativedelta(minutes=2)
+        )
 
-            if not isinstance(response['Orders']['Order'], list):
-                new_orders = [response['Orders']['Order']]
-            else:
-                new_orders = response['Orders']['Order']
+    def get_mws_sales_by_order_id(self, order_ids):
+        """
+        Find the sales already imported in this channel for the given
+        amazon order ids.
 
-            orders.extend(new_orders)
+        The ids are resolved with chunked `channel_identifier IN (...)`
+        searches instead of one search per order.
 
-        # Update last order import time for channel
-        self.write([self], {'last_order_import_time': datetime.utcnow()})
+        :param order_ids: List of AmazonOrderId
+        :return: Dictionary mapping AmazonOrderId to active record of sale
+        """
+        Sale = Pool().get('sale.sale')
 
-        return self.import_mws_order_bulk(orders)
+        sales_by_order_id = {}
+        in_max = Transaction().cursor.IN_MAX
+        for order_ids_batch in batch(list(set(order_ids)), in_max):
+            sales = Sale.search([
+                ('channel', '=', self.id),
+                ('channel_identifier', 'in', order_ids_batch),
+            ], order=[('id', 'DESC')])
+            for sale in sales:
+                # Keep the oldest sale in case of duplicates
+                sales_by_order_id[sale.channel_identifier] = sale
+        return sales_by_order_id
 
     def import_mws_order_bulk(self, amazon_orders_data):
         """
         It is expensive to get orders one by one and in addition, it will
         throttle the API requests.
+
+        Items of the new orders are fetched concurrently, then the sales
+        are created at once in the current transaction.
         """
         Sale = Pool().get('sale.sale')
 
         sales = []
         order_api = self.get_amazon_order_api()
+        import_cache = get_import_cache()
+
+        existing_sales = self.get_mws_sales_by_order_id([
+            order['AmazonOrderId']['value'] for order in amazon_orders_data
+        ])
 
+        new_order_ids = OrderedDict()
         for order in amazon_orders_data:
-            already_imported = Sale.search([
-                ('channel', '=', self.id),
-                (
-                    'channel_identifier', '=',
-                    order['AmazonOrderId']['value']
-                ),
-            ])
-            if not already_imported:
-                # New order! get the line items and save the order.
-                order_line_data = order_api.list_order_items(
-                    order['AmazonOrderId']['value']
-                ).parsed
-
-                with Transaction().set_context(
-                    {'current_channel': self.id}
-                ):
-                    sales.append(
-                        Sale.create_using_amazon_data(
-                            order,
-                            order_line_data['OrderItems']['OrderItem']
-                        )
+            order_id = order['AmazonOrderId']['value']
+            if order_id not in existing_sales:
+                new_order_ids[order_id] = True
+        order_items = fetch_order_items(order_api, new_order_ids.keys())
+
+        if new_order_ids:
+            order_items = list(order_items)
+            orders_by_id = {}
+            for order in amazon_orders_data:
+                orders_by_id.setdefault(order['AmazonOrderId']['value'], order)
+
+            # Product data of the first line of each SKU
+            products_data = OrderedDict()
+            for order_id, items in zip(new_order_ids, order_items):
+                if isinstance(items, dict):
+                    items = [items]
+                for item in items:
+                    products_data.setdefault(item['SellerSKU']['value'], {
+                        'FulfillmentChannel': orders_by_id[order_id][
+                            'FulfillmentChannel'
+                        ]['value'],
+                        'ASIN': item['ASIN']['value'],
+                    })
+
+            # Warm the product cache with the SKUs of all the lines and
+            # import the unknown ones at once
+            known = self.get_amazon_product_ids(products_data.keys())
+            unknown = OrderedDict(
+                (sku, data) for sku, data in products_data.iteritems()
+                if sku not in known
+            )
+            if unknown:
+                with Transaction().set_context(current_channel=self.id), \
+                        import_cache_run(import_cache):
+                    self.import_amazon_products(unknown)
+                # Listings were created, the cache is warmed again
+                self.get_amazon_product_ids(products_data.keys())
+
+            with Transaction().set_context(current_channel=self.id), \
+                    import_cache_run(import_cache):
+                # New orders! save them with their line items at once
+                new_sales = Sale.create_bulk_using_amazon_data([
+                    (orders_by_id[order_id], line_items)
+                    for order_id, line_items in zip(
+                        new_order_ids, order_items
                     )
-            else:
+                ])
+            existing_sales.update(zip(new_order_ids, new_sales))
+
+        changed = []
+        for order in amazon_orders_data:
+            order_id = order['AmazonOrderId']['value']
+            sale = existing_sales[order_id]
+            sales.append(sale)
+            if order_id not in new_order_ids and \
+                    sale.is_amazon_order_changed(order):
                 # Order is already there, just ensure it is in the
                 # right status
-                sales.append(already_imported[0])
-                already_imported[0].update_order_status_from_amazon_mws(
-                    order
-                )
+                changed.append((sale, order))
+        Sale.update_orders_status_from_amazon_mws(changed)
         return sales
 
     def import_order(self, order_id):
@@ -331,50 +849,168 @@ class SaleChannel:
         return envelope_xml
 
     def export_product_prices(self):
-        """Export prices of the products to the Amazon account in context
+        """Export prices of the products listed on this amazon channel
+
+        Prices are computed with the price list of the channel, and only
+        the prices that changed since the last export are sent.
 
-        :param products: List of active records of products
+        :return: Number of exported prices
         """
         if self.source != 'amazon_mws':
             return super(SaleChannel, self).export_product_prices()
 
         Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+        FeedQueue = Pool().get('amazon.feed.queue')
 
-        products = Product.search([
-            ('code', '!=', None),
-            ('codes', 'not in', []),
-            ('channel_listings.channel', '=', self.id),
+        listings = Listing.search([
+            ('channel', '=', self.id),
         ])
+        products = Product.browse(list(set(l.product.id for l in listings)))
+
+        with Transaction().set_context(currency=self.currency.id):
+            prices = Product.get_sale_price(products)
+        # The price list is only applied by get_sale_price for a customer
+        if self.price_list:
+            for product in products:
+                prices[product.id] = self.price_list.compute(
+                    None, product, prices[product.id], 0,
+                    product.default_uom
+                )
 
         pricing_xml = []
-        for product in products:
-            if self in [
-                ch.channel for ch in product.channel_listings
-            ]:
-                pricing_xml.append(E.Message(
-                    E.MessageID(str(product.id)),
+        exported = defaultdict(list)
+        for listing in listings:
+            price = self.currency.round(prices[listing.product.id])
+            if listing.amazon_exported_price == price:
+                continue
+            pricing_xml.append((
+                listing.product_identifier,
+                E.Message(
                     E.OperationType('Update'),
                     E.Price(
-                        E.SKU(product.code),
+                        E.SKU(listing.product_identifier),
                         E.StandardPrice(
-                            # TODO: Use a pricelist
-                            str(product.list_price),
-                            currency=self.company.currency.code
+                            str(price), currency=self.currency.code
                         ),
                     )
-                ))
+                ),
+                listing,
+            ))
+            exported[price].append(listing)
+
+        # Submitted by the feed queue
+        FeedQueue.enqueue(self, '_POST_PRODUCT_PRICING_DATA_', pricing_xml)
+
+        args = []
+        for price, exported_listings in exported.iteritems():
+            args.extend([exported_listings, {
+                'amazon_exported_price': price,
+            }])
+        if args:
+            Listing.write(*args)
 
-        envelope_xml = self._get_amazon_envelop('Price', pricing_xml)
+        return len(pricing_xml)
+
+    def get_amazon_product_ids(self, skus):
+        """
+        Return the products listed on this channel for the SKUs, with one
+        search for the SKUs not in cache. The SKU of the listing and its
+        FBA code are both matched.
 
-        feeds_api = self.get_amazon_feed_api()
+        The cache is shared by the transactions of the process and is not
+        rolled back, so the listings created by the current transaction
+        are not cached.
+
+        :param skus: List of seller SKUs
+        :return: Dictionary mapping the SKUs found to product id
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        product_ids = {}
+        missing = set()
+        for sku in skus:
+            product_id = self._amazon_product_cache.get(
+                (self.id, 'sku', sku)
+            )
+            if product_id is None:
+                missing.add(sku)
+            else:
+                product_ids[sku] = product_id
+        if not missing:
+            return product_ids
 
-        feeds_api.submit_feed(
-            etree.tostring(envelope_xml),
-            feed_type='_POST_PRODUCT_PRICING_DATA_',
-            marketplaceids=[self.amazon_marketplace_id]
+        missing = list(missing)
+        created_ids = Transaction().create_records.get(
+            Listing.__name__, set()
+        )
+        in_max = Transaction().cursor.IN_MAX
+        for i in range(0, len(missing), in_max):
+            sub_skus = missing[i:i + in_max]
+            listings = Listing.search_read([
+                ('channel', '=', self.id),
+                [
+                    'OR',
+                    ('product_identifier', 'in', sub_skus),
+                    ('fba_code', 'in', sub_skus),
+                ],
+            ], fields_names=[
+                'product', 'product_identifier', 'fba_code', 'asin'
+            ])
+            for listing in listings:
+                product_id = listing['product']
+                listing_skus = (
+                    listing['product_identifier'], listing['fba_code']
+                )
+                for sku in listing_skus:
+                    if sku:
+                        product_ids[sku] = product_id
+                if listing['id'] in created_ids:
+                    continue
+                for sku in listing_skus:
+                    if sku:
+                        self._amazon_product_cache.set(
+                            (self.id, 'sku', sku), product_id
+                        )
+                if listing['asin']:
+                    self._amazon_product_cache.set(
+                        (self.id, 'asin', listing['asin']),
+                        (product_id, bool(listing['fba_code']))
+                    )
+        return dict(
+            (sku, product_ids[sku]) for sku in skus if sku in product_ids
         )
 
-        return len(pricing_xml)
+    def get_product(self, identifier, product_data=None):
+        """
+        Return the product of the seller SKU, resolved through the
+        product cache of the channel before importing it.
+
+        :param identifier: Seller SKU from amazon
+        :param product_data: Dictionary with the FulfillmentChannel and
+                             ASIN of the order line
+        """
+        Product = Pool().get('product.product')
+
+        if self.source != 'amazon_mws':
+            return super(SaleChannel, self).get_product(
+                identifier, product_data
+            )
+
+        product_id = self.get_amazon_product_ids([identifier]).get(
+            identifier
+        )
+        if product_id is None and product_data:
+            product_id, fba = self._amazon_product_cache.get(
+                (self.id, 'asin', product_data['ASIN']), (None, False)
+            )
+            if product_data['FulfillmentChannel'] == 'AFN' and not fba:
+                # The FBA code of the listing is set by import_product
+                product_id = None
+        if product_id is not None:
+            return Product(product_id)
+
+        return self.import_product(identifier, product_data)
 
     def import_product(self, sku, product_data=None):
         """
@@ -384,67 +1020,445 @@ class SaleChannel:
         :param sku: Product Seller SKU from Amazon
         :returns: Active record of Product Created
         """
-        Product = Pool().get('product.product')
-        Listing = Pool().get('product.product.channel_listing')
-
         if self.source != 'amazon_mws':
             return super(SaleChannel, self).import_product(
                 sku, product_data
             )
 
+        products = self.import_amazon_products({sku: product_data})
+        if sku not in products:
+            self.raise_user_error('product_not_found', {'sku': sku})
+        return products[sku]
+
+    def import_amazon_products(self, products_data):
+        """
+        Import the products of many seller SKUs for this amazon channel.
+
+        Amazon is asked for the SKUs which are neither listed by ASIN on
+        the channel nor products already, up to
+        MATCHING_PRODUCT_IDS_LIMIT SKUs per request. Products and listings
+        are then created with one create each, with one product and one
+        listing for the SKUs amazon matches with the same ASIN.
+
+        :param products_data: Dictionary mapping seller SKU to a
+                              dictionary with the FulfillmentChannel and
+                              ASIN of an order line of the SKU
+        :returns: Dictionary mapping the SKUs found to active record of
+                  product
+        """
+        Product = Pool().get('product.product')
+
+        if not products_data:
+            return {}
+
         # Check if there is a poduct with the seller SKU.
         # Products being sold as AFN and MFN will have same ASIN.
-        # ASIN is unique only in a marketplace, so search asin
-        # with channel.
-        exisiting_listings = Listing.search([
-            ('asin', '=', product_data['ASIN']),
-            ('channel', '=', self),
+        listings, _ = self.update_amazon_listings_by_asin([
+            (sku, data['ASIN'], data['FulfillmentChannel'])
+            for sku, data in products_data.iteritems()
         ])
+        products = dict(
+            (sku, listing.product) for sku, listing in listings.iteritems()
+        )
+
+        skus = [sku for sku in products_data if sku not in products]
+        products_by_code, listed_product_ids = \
+            self.get_amazon_products_by_code(skus)
+        products.update(products_by_code)
+
+        # Amazon data is only needed to create the product or the listing
+        matched = self.get_amazon_matching_products([
+            sku for sku in skus
+            if sku not in products_by_code or
+            products_by_code[sku].id not in listed_product_ids
+        ])
+
+        new_listings = self.get_amazon_new_listings([
+            (
+                sku,
+                matched[sku]['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+                products_data[sku]['FulfillmentChannel'],
+            ) for sku in skus if sku in matched
+        ], products_by_code, listed_product_ids)
+        created = self.create_amazon_listings(
+            new_listings,
+            lambda new_skus: Product.create_bulk_using_amazon_data([
+                matched[sku] for sku in new_skus
+            ])
+        )
+        for sku, product in created.iteritems():
+            products.setdefault(sku, product)
 
-        if exisiting_listings:
-            exisiting_listing, = exisiting_listings
+        return products
 
+    def update_amazon_listings_by_asin(self, skus):
+        """
+        Find the listings of the ASIN of seller SKUs on this channel, and
+        set the FBA SKUs as FBA code of the listings which have none.
+
+        :param skus: List of tuples of seller SKU, ASIN and fulfillment
+                     channel (MFN or AFN)
+        :returns: Tuple of a dictionary mapping the SKUs to the active
+                  record of the listing of their ASIN, and the number of
+                  listings updated
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        # ASIN is unique only in a marketplace, so search asin
+        # with channel.
+        in_max = Transaction().cursor.IN_MAX
+        asins = list(set(asin for _, asin, _ in skus if asin))
+        listings_by_asin = {}
+        for i in range(0, len(asins), in_max):
+            for listing in Listing.search([
+                ('asin', 'in', asins[i:i + in_max]),
+                ('channel', '=', self),
+            ]):
+                listings_by_asin[listing.asin] = listing
+
+        listings = {}
+        fba_codes = {}
+        for sku, asin, fulfillment_channel in skus:
+            listing = listings_by_asin.get(asin)
+            if listing is None:
+                continue
+            listings[sku] = listing
             # Update Listing to respect FBA Design
-            if product_data['FulfillmentChannel'] == 'AFN' and \
-                    not exisiting_listing.fba_code:
-                exisiting_listing.fba_code = sku
-                exisiting_listing.save()
+            if fulfillment_channel == 'AFN' and not listing.fba_code and \
+                    listing.id not in fba_codes:
+                fba_codes[listing.id] = sku
+
+        if fba_codes:
+            args = []
+            for listing_id, sku in fba_codes.iteritems():
+                args.extend([[Listing(listing_id)], {'fba_code': sku}])
+            Listing.write(*args)
+        return listings, len(fba_codes)
+
+    def get_amazon_products_by_code(self, skus):
+        """
+        Find the products of which the code is a seller SKU.
+
+        :param skus: List of seller SKUs
+        :returns: Tuple of a dictionary mapping the SKUs to active record
+                  of product, and the set of ids of those products listed
+                  on this channel
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+
+        in_max = Transaction().cursor.IN_MAX
+        products_by_code = {}
+        for i in range(0, len(skus), in_max):
+            for product in Product.search([
+                ('code', 'in', skus[i:i + in_max]),
+            ]):
+                products_by_code[product.code] = product
+
+        listed_product_ids = set()
+        product_ids = [p.id for p in products_by_code.values()]
+        for i in range(0, len(product_ids), in_max):
+            listed_product_ids.update(
+                listing['product'] for listing in Listing.search_read([
+                    ('product', 'in', product_ids[i:i + in_max]),
+                    ('channel', '=', self),
+                ], fields_names=['product'])
+            )
+        return products_by_code, listed_product_ids
+
+    def get_amazon_new_listings(self, skus, products_by_code,
+                                listed_product_ids):
+        """
+        Group the seller SKUs to list on this channel by ASIN, the MFN SKU
+        of an ASIN identifies its listing and the FBA SKU is its FBA code.
+        SKUs of products already listed are left out.
+
+        :param skus: List of tuples of seller SKU, ASIN and fulfillment
+                     channel (MFN or AFN)
+        :param products_by_code: Dictionary mapping SKUs to active record
+                                 of product
+        :param listed_product_ids: Set of ids of products listed on this
+                                   channel
+        :returns: Ordered dictionary mapping the ASIN, or the SKU when
+                  there is none, to a tuple of the values of the listing,
+                  without product when there is none yet, and the list
+                  of its SKUs
+        """
+        new_listings = OrderedDict()
+        for sku, asin, fulfillment_channel in skus:
+            product = products_by_code.get(sku)
+            if product is not None and product.id in listed_product_ids:
+                continue
+            afn = fulfillment_channel == 'AFN'
+            key = asin or sku
+            if key not in new_listings:
+                new_listings[key] = ({
+                    'product': product and product.id,
+                    'channel': self.id,
+                    'product_identifier': sku,
+                    'fba_code': sku if afn else None,
+                    'asin': asin or None,
+                }, [sku])
+                continue
+
+            values, group_skus = new_listings[key]
+            group_skus.append(sku)
+            if afn and not values['fba_code']:
+                values['fba_code'] = sku
+            elif not afn and \
+                    values['product_identifier'] == values['fba_code']:
+                values['product_identifier'] = sku
+            if values['product'] is None and product is not None:
+                values['product'] = product.id
+        return new_listings
+
+    def create_amazon_listings(self, new_listings, create_products):
+        """
+        Create the listings from get_amazon_new_listings and their missing
+        products, with one create each.
+
+        :param new_listings: Ordered dictionary from get_amazon_new_listings
+        :param create_products: Function creating the products of a list
+                                of SKUs and returning them in that order
+        :returns: Dictionary mapping the SKUs to active record of the
+                  product of their listing
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+
+        if not new_listings:
+            return {}
 
-            return exisiting_listing.product
+        listing_values = [values for values, _ in new_listings.values()]
+        to_create = [v for v in listing_values if v['product'] is None]
+        created = create_products([v['product_identifier'] for v in to_create])
+        for values, product in zip(to_create, created):
+            values['product'] = product.id
+        Listing.create(listing_values)
 
-        products = Product.search([('code', '=', sku)])
+        products = {}
+        for values, group_skus in new_listings.itervalues():
+            product = Product(values['product'])
+            for sku in group_skus:
+                products[sku] = product
+        return products
+
+    def get_amazon_matching_products(self, skus):
+        """
+        Fetch the product data of seller SKUs from amazon, with one
+        GetMatchingProductForId request per MATCHING_PRODUCT_IDS_LIMIT
+        SKUs.
+
+        :param skus: List of seller SKUs
+        :returns: Dictionary mapping the SKUs matched to their product data
+                  in the format of a single SKU request
+        """
         product_api = self.get_amazon_product_api()
-        full_product_data = None
-        if not products:
-            # Create a product since there is no match for an existing
-            # product with the SKU.
 
-            full_product_data = full_product_data or \
-                product_api.get_matching_product_for_id(
-                    self.amazon_marketplace_id, 'SellerSKU', [sku]
-                ).parsed
+        matched = {}
+        for skus_batch in batch(skus, MATCHING_PRODUCT_IDS_LIMIT):
+            results = product_api.get_matching_product_for_id(
+                self.amazon_marketplace_id, 'SellerSKU', skus_batch
+            ).parsed
+            if isinstance(results, dict):
+                results = [results]
+            for result in results:
+                if 'Error' in result or not result.get('Products'):
+                    logger.warning(
+                        "No amazon product for SKU %s" % (
+                            result.get('Id', {}).get('value')
+                        )
+                    )
+                    continue
+                product = result['Products']['Product']
+                if isinstance(product, list):
+                    # Several products match, use the first like amazon
+                    result = dict(result, Products={'Product': product[0]})
+                matched[result['Id']['value']] = result
+        return matched
+
+    def request_amazon_catalog(self):
+        """
+        Request the merchant listings and FBA inventory reports of this
+        amazon channel, import_amazon_catalog_reports imports them once
+        amazon generated them. Reports requested less than REPORT_TIMEOUT
+        ago are not requested again.
+
+        The transaction is committed once the reports are requested, if
+        amazon_commit_per_page is set.
+        """
+        self.validate_amazon_channel()
+
+        if self.amazon_catalog_requests and \
+                self.amazon_catalog_request_time + timedelta(
+                    seconds=REPORT_TIMEOUT) > datetime.utcnow():
+            return
+
+        report_api = self.get_amazon_report_api()
+        request_ids = []
+        for report_type in CATALOG_REPORT_TYPES:
+            response = report_api.request_report(
+                report_type, marketplaceids=[self.amazon_marketplace_id]
+            ).parsed
+            request_ids.append(
+                response['ReportRequestInfo']['ReportRequestId']['value']
+            )
+        self.write([self], {
+            'amazon_catalog_requests': ','.join(request_ids),
+            'amazon_catalog_request_time': datetime.utcnow(),
+        })
+        self.save_amazon_throttle_state()
+        if self.amazon_commit_per_page:
+            Transaction().cursor.commit()
 
-            products = [Product.create_from(self, full_product_data)]
+    def import_amazon_catalog_reports(self):
+        """
+        Import the catalog reports requested by request_amazon_catalog
+        once amazon generated them, CATALOG_BATCH_SIZE rows at a time.
+        The merchant listings are imported first so that FBA SKUs are
+        added to the listing of their ASIN.
 
-        product, = products
-        listings = Listing.search([
-            ('product', '=', product),
-            ('channel', '=', self),
-        ])
-        if not listings:
-            full_product_data = full_product_data or \
-                product_api.get_matching_product_for_id(
-                    self.amazon_marketplace_id, 'SellerSKU', [sku]
-                ).parsed
-            Listing(
-                product=product,
-                channel=self,
-                product_identifier=sku,
-                fba_code=sku if product_data['FulfillmentChannel'] == 'AFN' else None,  # noqa
-                asin=full_product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
-            ).save()
-
-        return product
+        The reports are checked once, they are imported by a later call
+        when amazon is still generating them, and given up after
+        REPORT_TIMEOUT.
+
+        :return: Number of listings created or updated
+        """
+        if not self.amazon_catalog_requests:
+            return 0
+
+        report_api = self.get_amazon_report_api()
+        request_ids = self.amazon_catalog_requests.split(',')
+        reports = get_generated_reports(report_api, request_ids)
+        self.save_amazon_throttle_state()
+        if len(reports) < len(request_ids):
+            if self.amazon_catalog_request_time + timedelta(
+                    seconds=REPORT_TIMEOUT) < datetime.utcnow():
+                logger.warning(
+                    "Channel %s: catalog reports not generated in time" % (
+                        self.name
+                    )
+                )
+                self.write([self], {'amazon_catalog_requests': None})
+            return 0
+        self.write([self], {'amazon_catalog_requests': None})
+
+        count = 0
+        with Transaction().set_context(current_channel=self.id), \
+                import_cache_run():
+            for report_type, request_id in zip(
+                    CATALOG_REPORT_TYPES, request_ids):
+                if reports[request_id] is None:
+                    continue
+                count += self.import_amazon_catalog_report(
+                    report_api, report_type, reports[request_id]
+                )
+        self.save_amazon_throttle_state()
+        return count
+
+    def import_amazon_catalog_report(self, report_api, report_type,
+                                     report_id):
+        """
+        Download and import a generated catalog report.
+
+        :param report_api: Reports api of the channel
+        :param report_type: One of CATALOG_REPORT_TYPES
+        :param report_id: GeneratedReportId of the report
+        :return: Number of listings created or updated
+        """
+        response = report_api.get_report(report_id)
+        encoding = getattr(
+            getattr(response, 'response', None), 'encoding', None
+        ) or REPORT_ENCODING
+        rows = iter_catalog_rows(
+            report_type, iter_report_rows(response.original, encoding)
+        )
+
+        count = 0
+        while True:
+            rows_batch = list(islice(rows, CATALOG_BATCH_SIZE))
+            if not rows_batch:
+                break
+            count += self.import_amazon_catalog_rows(rows_batch)
+            if self.amazon_commit_per_page:
+                Transaction().cursor.commit()
+        logger.info("Channel %s: %s imported" % (self.name, report_type))
+        return count
+
+    @classmethod
+    def request_amazon_catalog_using_cron(cls):
+        """
+        Cron method to request the catalog reports of all the amazon
+        channels
+        """
+        for channel in cls.search([('source', '=', 'amazon_mws')]):
+            try:
+                channel.request_amazon_catalog()
+            except mws.MWSError, e:
+                logger.warning(
+                    "Catalog request of channel %s failed: %s" % (
+                        channel.name, e
+                    )
+                )
+
+    @classmethod
+    def import_amazon_catalog_reports_using_cron(cls):
+        """
+        Cron method to import the catalog reports amazon generated
+        """
+        for channel in cls.search([
+            ('source', '=', 'amazon_mws'),
+            ('amazon_catalog_requests', '!=', None),
+        ]):
+            try:
+                channel.import_amazon_catalog_reports()
+            except mws.MWSError, e:
+                logger.warning(
+                    "Catalog import of channel %s failed: %s" % (
+                        channel.name, e
+                    )
+                )
+
+    def import_amazon_catalog_rows(self, rows):
+        """
+        Create the products and listings of rows of the catalog reports
+        with one create each.
+
+        SKUs already listed on the channel are left untouched. A SKU of
+        which the ASIN is listed on the channel is added as its FBA code
+        when it is fulfilled by amazon, like the SKUs of the orders.
+
+        :param rows: List of dictionaries with the sku, asin, name, price
+                     and fulfillment_channel (MFN or AFN) of the SKUs
+        :return: Number of listings created or updated
+        """
+        Product = Pool().get('product.product')
+
+        rows_by_sku = OrderedDict((row['sku'], row) for row in rows)
+        listed_skus = self.get_amazon_product_ids(rows_by_sku.keys())
+        skus = [
+            (sku, row['asin'], row['fulfillment_channel'])
+            for sku, row in rows_by_sku.iteritems()
+            if sku not in listed_skus
+        ]
+        if not skus:
+            return 0
+
+        listings, updated = self.update_amazon_listings_by_asin(skus)
+        skus = [s for s in skus if s[0] not in listings]
+        products_by_code, listed_product_ids = \
+            self.get_amazon_products_by_code([sku for sku, _, _ in skus])
+
+        new_listings = self.get_amazon_new_listings(
+            skus, products_by_code, listed_product_ids
+        )
+        self.create_amazon_listings(
+            new_listings,
+            lambda new_skus: Product.create_bulk_using_amazon_report([
+                rows_by_sku[sku] for sku in new_skus
+            ])
+        )
+        return updated + len(new_listings)
 
     def import_order_states(self):
         """
@@ -544,7 +1558,10 @@ class SaleChannel:
             ('channel', '=', self.id),
             ('state', 'in', ('confirmed', 'processing')),
         ])
-        order_ids = [sale.channel_identifier for sale in sales]
+        sales_by_order_id = dict(
+            (sale.channel_identifier, sale) for sale in sales
+        )
+        order_ids = sales_by_order_id.keys()
 
         for order_ids_batch in batch(order_ids, 50):
             # The order fetch API limits getting orders to a maximum
@@ -554,21 +1571,26 @@ class SaleChannel:
             except mws.MWSError, e:
                 # Do not continue further in this method as further calls
                 # to amazon will raise same error for further calls,
-                # but calling return will let updated orders commit to
+                # but stopping here will let updated orders commit to
                 # database. Else this will become a never ending process.
                 logger.warning(e.message)
-                return
+                break
 
             if not isinstance(response['Orders']['Order'], list):
                 orders = [response['Orders']['Order']]
             else:
                 orders = response['Orders']['Order']
 
+            # Only process the orders which changed since the last
+            # synchronisation
+            changed = []
             for order in orders:
-                sale, = Sale.search([
-                    ('channel_identifier', '=', order['AmazonOrderId']['value'])
-                ])
-                sale.update_order_status_from_amazon_mws(order)
+                sale = sales_by_order_id.get(order['AmazonOrderId']['value'])
+                if sale is not None and sale.is_amazon_order_changed(order):
+                    changed.append((sale, order))
+            Sale.update_orders_status_from_amazon_mws(changed)
+
+        self.save_amazon_throttle_state()
 
 
 class CheckAmazonServiceStatusView(ModelView):
@@ -5,38 +5,176 @@
     Country
 
 """
-from trytond.pool import PoolMeta
+import unicodedata
 
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import PoolMeta, Pool
+from trytond.cache import Cache
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
 
-__all__ = ['Subdivision']
+
+__all__ = ['Subdivision', 'SubdivisionAmazonAlias']
 __metaclass__ = PoolMeta
 
 
+def normalise_state(value):
+    """
+    Normalise a state name or code for matching: lower case and without
+    accents, spaces or punctuation.
+    """
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    value = unicodedata.normalize('NFKD', value)
+    return u''.join(c for c in value if c.isalnum()).lower()
+
+
 class Subdivision:
     "Subdivision"
     __name__ = 'country.subdivision'
 
+    _amazon_index_cache = Cache(
+        'country_subdivision.amazon_index', context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        subdivisions = super(Subdivision, cls).create(vlist)
+        cls._amazon_index_cache.clear()
+        return subdivisions
+
+    @classmethod
+    def write(cls, *args):
+        super(Subdivision, cls).write(*args)
+        cls._amazon_index_cache.clear()
+
+    @classmethod
+    def delete(cls, subdivisions):
+        super(Subdivision, cls).delete(subdivisions)
+        cls._amazon_index_cache.clear()
+
+    @classmethod
+    def get_amazon_index(cls, country):
+        """
+        Returns the index of the subdivisions of the country, mapping the
+        normalised codes, names and aliases to subdivision ids. Unmatched
+        values recorded as aliases map to None.
+
+        The index is built once per process and invalidated when
+        subdivisions or aliases are modified. The invalidation reaches the
+        other processes like for any trytond Cache: at the start of their
+        next transaction when running multi_server, so an alias resolved
+        in a process is used by the imports of the others afterwards.
+
+        :param country: Active record of country
+        """
+        Alias = Pool().get('country.subdivision.amazon_alias')
+
+        index = cls._amazon_index_cache.get(country.id)
+        if index is not None:
+            return index
+
+        index = {}
+        subdivisions = cls.search([('country', '=', country.id)])
+        # Codes take precedence over names, and aliases over both
+        for subdivision in subdivisions:
+            index[normalise_state(subdivision.name)] = subdivision.id
+        for subdivision in subdivisions:
+            code = subdivision.code or u''
+            index[normalise_state(code)] = subdivision.id
+            index[normalise_state(code.split('-', 1)[-1])] = subdivision.id
+        unmatched = []
+        for alias in Alias.search([('country', '=', country.id)]):
+            if alias.subdivision:
+                index[normalise_state(alias.value)] = alias.subdivision.id
+            else:
+                unmatched.append(normalise_state(alias.value))
+        for key in unmatched:
+            index.setdefault(key, None)
+        index.pop(u'', None)
+
+        cls._amazon_index_cache.set(country.id, index)
+        return index
+
     @classmethod
     def search_using_amazon_state(cls, value, country):
         """
         Searches for state with given amazon StateOrRegion value.
 
+        Values which do not match any subdivision are recorded as aliases
+        without subdivision, so that the right one can be set. Concurrent
+        imports may record the same value twice, which is harmless as
+        aliases are not unique.
+
         :param value: Code or Name of state from amazon
         :param country: Active record of country
-        :return: Active record of state if found else raises error
+        :return: Active record of state if found else None
         """
-        subdivisions = cls.search([
-            ('country', '=', country.id),
-            ('code', '=', country.code + '-' + value.upper())
-        ])
+        Alias = Pool().get('country.subdivision.amazon_alias')
+
+        index = cls.get_amazon_index(country)
+        key = normalise_state(value)
+        if key in index:
+            subdivision_id = index[key]
+            return subdivision_id and cls(subdivision_id) or None
+
+        if key:
+            Alias.create([{
+                'country': country.id,
+                'value': value,
+            }])
+        return None
+
+
+class SubdivisionAmazonAlias(ModelSQL, ModelView):
+    "Amazon Subdivision Alias"
+    __name__ = 'country.subdivision.amazon_alias'
+
+    country = fields.Many2One(
+        'country.country', 'Country', required=True, select=True
+    )
+    value = fields.Char(
+        'Value', required=True,
+        help="StateOrRegion value sent by amazon"
+    )
+    subdivision = fields.Many2One(
+        'country.subdivision', 'Subdivision', domain=[
+            ('country', '=', Eval('country')),
+        ], depends=['country'],
+        help="Subdivision for the value, empty if it is not known yet"
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(SubdivisionAmazonAlias, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Migration: values are no longer unique, so that two imports
+        # recording the same unmatched value never conflict
+        table.drop_constraint('value_uniq')
+
+    @classmethod
+    def create(cls, vlist):
+        Subdivision = Pool().get('country.subdivision')
 
-        if not subdivisions:
-            subdivisions = cls.search([
-                ('country', '=', country.id),
-                ('name', 'ilike', value),
-            ], limit=1)
+        aliases = super(SubdivisionAmazonAlias, cls).create(vlist)
+        Subdivision._amazon_index_cache.clear()
+        return aliases
 
-        if not subdivisions:
-            return None
+    @classmethod
+    def write(cls, *args):
+        Subdivision = Pool().get('country.subdivision')
+
+        super(SubdivisionAmazonAlias, cls).write(*args)
+        Subdivision._amazon_index_cache.clear()
+
+    @classmethod
+    def delete(cls, aliases):
+        Subdivision = Pool().get('country.subdivision')
 
-        return subdivisions[0]
+        super(SubdivisionAmazonAlias, cls).delete(aliases)
+        Subdivision._amazon_index_cache.clear()
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+"""
+    feed
+
+    Queue of the messages to submit to amazon in feeds
+
+"""
+import hashlib
+import logging
+from io import BytesIO
+from datetime import datetime, timedelta
+from itertools import groupby
+from collections import defaultdict
+from tempfile import SpooledTemporaryFile
+
+from mws import mws
+from lxml import etree
+from lxml.builder import E
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+__all__ = ['AmazonFeedQueue', 'AmazonFeedSubmission']
+
+logger = logging.getLogger("amazon_mws")
+
+#: Message type of the envelope of each feed type
+FEED_MESSAGE_TYPES = {
+    '_POST_INVENTORY_AVAILABILITY_DATA_': 'Inventory',
+    '_POST_PRODUCT_PRICING_DATA_': 'Price',
+    '_POST_ORDER_FULFILLMENT_DATA_': 'OrderFulfillment',
+}
+
+FEED_TYPES = [
+    ('_POST_INVENTORY_AVAILABILITY_DATA_', 'Inventory'),
+    ('_POST_PRODUCT_PRICING_DATA_', 'Price'),
+    ('_POST_ORDER_FULFILLMENT_DATA_', 'Order Fulfillment'),
+]
+
+#: Maximum number of messages submitted in one feed
+FEED_MESSAGES_LIMIT = 10000
+
+#: Maximum size in bytes of a submitted feed
+FEED_SIZE_LIMIT = 10 * 1024 * 1024
+
+#: Size in bytes above which a feed being written is moved to disk
+FEED_SPOOL_SIZE = 1024 * 1024
+
+#: Number of times a message amazon failed to process is submitted
+MAX_FEED_ATTEMPTS = 3
+
+#: Maximum number of submission ids in a GetFeedSubmissionList request
+SUBMISSION_LIST_LIMIT = 100
+
+#: Hours after which a submission amazon does not report is given up,
+#: amazon only reports the submissions of the last 90 days
+SUBMISSION_UNREPORTED_HOURS = 24
+
+
+def iter_feed_files(
+        envelope, messages, max_messages=FEED_MESSAGES_LIMIT,
+        max_size=FEED_SIZE_LIMIT):
+    """
+    Write the messages in as many envelopes as needed to stay within the
+    limits, one message at a time.
+
+    Each envelope is written to a spooled temporary file, the caller
+    should close it once used.
+
+    :param envelope: AmazonEnvelope element without messages
+    :param messages: Iterable of Message elements without MessageID
+    :param max_messages: Maximum number of messages in an envelope
+    :param max_size: Maximum size of an envelope in bytes, an envelope
+                     always holds at least one message
+    :return: Generator of (file object, number of messages) where the
+             MessageIDs of the messages run from 1 in each envelope
+    """
+    tail = '</%s>' % envelope.tag
+    head = etree.tostring(envelope)
+    assert head.endswith(tail)
+    head = head[:-len(tail)]
+
+    feed = None
+    count = 0
+    for message in messages:
+        message_id = E.MessageID(str(count + 1))
+        message.insert(0, message_id)
+        data = etree.tostring(message)
+        if feed is not None and (
+                count >= max_messages or
+                feed.tell() + len(data) + len(tail) > max_size):
+            feed.write(tail)
+            feed.seek(0)
+            yield feed, count
+            feed = None
+        if feed is None:
+            feed = SpooledTemporaryFile(max_size=FEED_SPOOL_SIZE)
+            feed.write(head)
+            if count:
+                # Message ID just has to be unique in envelope
+                count = 0
+                message_id.text = '1'
+                data = etree.tostring(message)
+        feed.write(data)
+        count += 1
+
+    if feed is not None:
+        feed.write(tail)
+        feed.seek(0)
+        yield feed, count
+
+
+def iter_processing_report(report):
+    """
+    Iterate over the processing report of a feed without building the
+    whole tree
+
+    :param report: Processing report XML
+    :return: Generator of (tag, values) for the ProcessingSummary and each
+             Result, values maps the tags of the children to their text
+    """
+    for _, element in etree.iterparse(
+            BytesIO(report), events=('end', ),
+            tag=('ProcessingSummary', 'Result')):
+        values = dict((child.tag, child.text) for child in element)
+        yield element.tag, values
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class AmazonFeedQueue(ModelSQL, ModelView):
+    """
+    Amazon Feed Queue
+
+    Messages waiting to be submitted to amazon. Messages are queued by the
+    exports and submitted in consolidated feeds per channel and feed type
+    by the cron, a newer message for the same key supersedes the pending
+    one.
+    """
+    __name__ = 'amazon.feed.queue'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        readonly=True
+    )
+    feed_type = fields.Selection(
+        FEED_TYPES, 'Feed Type', required=True, select=True, readonly=True
+    )
+    key = fields.Char(
+        'Key', required=True, select=True, readonly=True,
+        help="Identifier of the message, like the SKU for inventory"
+    )
+    payload = fields.Text('Payload', required=True, readonly=True)
+    origin = fields.Reference(
+        'Origin', selection='get_origin', readonly=True
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('submitted', 'Submitted'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('superseded', 'Superseded'),
+    ], 'State', required=True, select=True, readonly=True)
+    submission = fields.Many2One(
+        'amazon.feed.submission', 'Submission', select=True, readonly=True,
+        ondelete='SET NULL'
+    )
+    message_id = fields.Integer(
+        'Message ID', readonly=True,
+        help="MessageID of the message in the last submitted feed"
+    )
+    attempts = fields.Integer('Attempts', required=True, readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AmazonFeedQueue, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def _get_origin(cls):
+        """
+        Return the list of models of origin
+        """
+        return [
+            'product.product.channel_listing',
+            'product.product',
+            'stock.shipment.out',
+        ]
+
+    @classmethod
+    def get_origin(cls):
+        IrModel = Pool().get('ir.model')
+
+        models = IrModel.search([
+            ('model', 'in', cls._get_origin()),
+        ])
+        return [(None, '')] + [(m.model, m.name) for m in models]
+
+    @classmethod
+    def enqueue(cls, channel, feed_type, messages):
+        """
+        Queue messages of a feed type for the channel, superseding the
+        pending messages with the same key.
+
+        :param channel: Active record of the channel
+        :param feed_type: Amazon feed type
+        :param messages: List of (key, Message element, origin) where the
+                         Message element has no MessageID
+        :return: List of the queued active records
+        """
+        by_key = {}
+        for key, message, origin in messages:
+            # The last message for a key wins
+            by_key[key] = {
+                'channel': channel.id,
+                'feed_type': feed_type,
+                'key': key,
+                'payload': etree.tostring(message),
+                'origin': origin and str(origin),
+            }
+        if not by_key:
+            return []
+
+        keys = by_key.keys()
+        in_max = Transaction().cursor.IN_MAX
+        for i in range(0, len(keys), in_max):
+            superseded = cls.search([
+                ('channel', '=', channel.id),
+                ('feed_type', '=', feed_type),
+                ('state', '=', 'pending'),
+                ('key', 'in', keys[i:i + in_max]),
+            ])
+            if superseded:
+                cls.write(superseded, {'state': 'superseded'})
+        return cls.create(by_key.values())
+
+    @classmethod
+    def process(cls, channels=None):
+        """
+        Submit the pending messages in feeds per channel and feed type,
+        within the message count and size limits of a feed.
+
+        The transaction is committed after each feed so that submitted
+        messages are not sent again if a later feed fails.
+
+        :param channels: Active record list of channels, all by default
+        :return: Number of submitted messages
+        """
+        domain = [('state', '=', 'pending')]
+        if channels is not None:
+            domain.append(('channel', 'in', map(int, channels)))
+
+        submitted = 0
+        pending = sorted(
+            cls.search(domain),
+            key=lambda e: (e.channel.id, e.feed_type, e.id)
+        )
+        for (channel, feed_type), entries in groupby(
+                pending, key=lambda e: (e.channel, e.feed_type)):
+            try:
+                for submission in cls.submit(
+                        channel, feed_type, list(entries)):
+                    submitted += submission.message_count
+                    Transaction().cursor.commit()
+            except mws.MWSError:
+                # The remaining messages are kept for the next run
+                logger.exception(
+                    "Could not submit %s feed of channel %s" % (
+                        feed_type, channel.id
+                    )
+                )
+        return submitted
+
+    @classmethod
+    def submit(cls, channel, feed_type, entries):
+        """
+        Submit the messages of the queue entries, in as many feeds as the
+        feed limits need.
+
+        :param channel: Active record of the channel
+        :param feed_type: Amazon feed type
+        :param entries: Active record list of queue entries
+        :return: Generator of the active records of the feed submissions,
+                 yielded once each feed is submitted
+        """
+        Submission = Pool().get('amazon.feed.submission')
+
+        feeds_api = channel.get_amazon_feed_api()
+        envelope = channel._get_amazon_envelop(
+            FEED_MESSAGE_TYPES[feed_type], []
+        )
+        messages = (etree.fromstring(e.payload) for e in entries)
+
+        offset = 0
+        for feed_file, count in iter_feed_files(envelope, messages):
+            try:
+                # The feed is read as the api needs its MD5
+                feed = feed_file.read()
+            finally:
+                feed_file.close()
+            chunk = entries[offset:offset + count]
+            offset += count
+
+            response = feeds_api.submit_feed(
+                feed,
+                feed_type=feed_type,
+                marketplaceids=[channel.amazon_marketplace_id]
+            )
+            info = response.parsed['FeedSubmissionInfo']
+
+            submission, = Submission.create([{
+                'submission_id': info['FeedSubmissionId']['value'],
+                'channel': channel.id,
+                'feed_type': feed_type,
+                'message_count': count,
+                'payload_hash': hashlib.sha1(feed).hexdigest(),
+                'processing_status': info['FeedProcessingStatus']['value'],
+            }])
+            args = []
+            for message_id, entry in enumerate(chunk, 1):
+                args.extend([[entry], {
+                    'state': 'submitted',
+                    'submission': submission.id,
+                    'message_id': message_id,
+                    'attempts': entry.attempts + 1,
+                    'error': None,
+                }])
+            cls.write(*args)
+            channel.save_amazon_throttle_state()
+            yield submission
+
+    @classmethod
+    def set_results(cls, entries, errors):
+        """
+        Record the result of the processing of submitted entries, entries
+        amazon could not process are queued again unless a newer message
+        supersedes them or they were submitted MAX_FEED_ATTEMPTS times.
+
+        :param entries: Active record list of submitted entries
+        :param errors: Dictionary mapping MessageID to error message,
+                       MessageID 0 is an error of the whole feed
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        failed = [
+            e for e in entries if e.message_id in errors or 0 in errors
+        ]
+        failed_ids = set(map(int, failed))
+        done = [e for e in entries if e.id not in failed_ids]
+
+        newer_keys = set()
+        in_max = Transaction().cursor.IN_MAX
+        for (channel, feed_type), group in groupby(
+                sorted(failed, key=lambda e: (e.channel.id, e.feed_type)),
+                key=lambda e: (e.channel, e.feed_type)):
+            keys = [e.key for e in group]
+            for i in range(0, len(keys), in_max):
+                newer_keys.update(
+                    (channel.id, feed_type, newer.key)
+                    for newer in cls.search([
+                        ('channel', '=', channel.id),
+                        ('feed_type', '=', feed_type),
+                        ('state', '=', 'pending'),
+                        ('key', 'in', keys[i:i + in_max]),
+                    ])
+                )
+
+        args = []
+        failed_listings = defaultdict(list)
+        for entry in failed:
+            if (entry.channel.id, entry.feed_type, entry.key) in newer_keys:
+                state = 'superseded'
+            elif entry.attempts >= MAX_FEED_ATTEMPTS:
+                state = 'failed'
+                if isinstance(entry.origin, Listing):
+                    failed_listings[entry.feed_type].append(entry.origin)
+            else:
+                state = 'pending'
+            args.extend([[entry], {
+                'state': state,
+                'error': errors.get(entry.message_id, errors.get(0)),
+            }])
+        if done:
+            args.extend([done, {'state': 'done'}])
+        if args:
+            cls.write(*args)
+
+        for feed_type, listings in failed_listings.iteritems():
+            Listing.reset_amazon_export(listings, feed_type)
+
+    @classmethod
+    def process_using_cron(cls):
+        """
+        Cron method to submit the queued messages
+        """
+        cls.process()
+
+
+class AmazonFeedSubmission(ModelSQL, ModelView):
+    """
+    Amazon Feed Submission
+
+    Feed submitted to amazon, polled until amazon processed it to record
+    the result of each message.
+    """
+    __name__ = 'amazon.feed.submission'
+
+    submission_id = fields.Char(
+        'Feed Submission ID', required=True, select=True, readonly=True
+    )
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        readonly=True
+    )
+    feed_type = fields.Selection(
+        FEED_TYPES, 'Feed Type', required=True, readonly=True
+    )
+    message_count = fields.Integer('Message Count', readonly=True)
+    payload_hash = fields.Char(
+        'Payload Hash', readonly=True, help="SHA1 of the submitted feed"
+    )
+    processing_status = fields.Char('Processing Status', readonly=True)
+    messages_processed = fields.Integer('Messages Processed', readonly=True)
+    messages_with_error = fields.Integer(
+        'Messages With Error', readonly=True
+    )
+    messages_with_warning = fields.Integer(
+        'Messages With Warning', readonly=True
+    )
+    entries = fields.One2Many(
+        'amazon.feed.queue', 'submission', 'Messages', readonly=True
+    )
+    state = fields.Selection([
+        ('submitted', 'Submitted'),
+        ('done', 'Done'),
+        ('cancelled', 'Cancelled'),
+    ], 'State', required=True, select=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AmazonFeedSubmission, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'submitted'
+
+    @classmethod
+    def poll(cls, channels=None):
+        """
+        Check the processing status of the submitted feeds, for up to
+        SUBMISSION_LIST_LIMIT feeds per request, and record the result of
+        the processed ones.
+
+        :param channels: Active record list of channels, all by default
+        """
+        domain = [('state', '=', 'submitted')]
+        if channels is not None:
+            domain.append(('channel', 'in', map(int, channels)))
+
+        submissions = sorted(
+            cls.search(domain), key=lambda s: (s.channel.id, s.id)
+        )
+        for channel, submissions in groupby(
+                submissions, key=lambda s: s.channel):
+            submissions = list(submissions)
+            feeds_api = channel.get_amazon_feed_api()
+            try:
+                for i in range(0, len(submissions), SUBMISSION_LIST_LIMIT):
+                    cls.poll_submissions(
+                        feeds_api, submissions[i:i + SUBMISSION_LIST_LIMIT]
+                    )
+            except mws.MWSError:
+                logger.exception(
+                    "Could not poll feed submissions of channel %s" % (
+                        channel.id
+                    )
+                )
+            channel.save_amazon_throttle_state()
+
+    @classmethod
+    def poll_submissions(cls, feeds_api, submissions):
+        """
+        Update the submissions with one GetFeedSubmissionList request and
+        fetch the result of the processed ones. The submissions amazon does
+        not report SUBMISSION_UNREPORTED_HOURS after their submission are
+        cancelled.
+
+        The transaction is committed after each processed submission.
+
+        :param feeds_api: Feeds api of the channel of the submissions
+        :param submissions: Active record list of submissions
+        """
+        by_submission_id = dict((s.submission_id, s) for s in submissions)
+
+        statuses = {}
+        response = feeds_api.get_feed_submission_list(
+            feedids=by_submission_id.keys()
+        )
+        while True:
+            infos = response.parsed.get('FeedSubmissionInfo') or []
+            if isinstance(infos, dict):
+                infos = [infos]
+            for info in infos:
+                statuses[info['FeedSubmissionId']['value']] = \
+                    info['FeedProcessingStatus']['value']
+            if response.parsed.get('HasNext', {}).get('value') != 'true':
+                break
+            response = feeds_api.get_submission_list_by_next_token(
+                response.parsed['NextToken']['value']
+            )
+
+        for submission_id, status in statuses.iteritems():
+            submission = by_submission_id.get(submission_id)
+            if submission is None:
+                continue
+            if status == '_DONE_':
+                submission.process_result(feeds_api)
+            elif status == '_CANCELLED_':
+                submission.cancel()
+            elif status != submission.processing_status:
+                cls.write([submission], {'processing_status': status})
+            else:
+                continue
+            Transaction().cursor.commit()
+
+        unreported_before = datetime.utcnow() - timedelta(
+            hours=SUBMISSION_UNREPORTED_HOURS
+        )
+        for submission in submissions:
+            if submission.submission_id in statuses:
+                continue
+            if submission.create_date < unreported_before:
+                submission.cancel('Feed submission not reported by amazon')
+                Transaction().cursor.commit()
+
+    def process_result(self, feeds_api):
+        """
+        Fetch and record the processing report of the submission
+        """
+        FeedQueue = Pool().get('amazon.feed.queue')
+
+        response = feeds_api.get_feed_submission_result(self.submission_id)
+
+        summary = {}
+        errors = {}
+        for tag, values in iter_processing_report(response.original):
+            if tag == 'ProcessingSummary':
+                summary = values
+            elif values.get('ResultCode') == 'Error':
+                errors[int(values.get('MessageID') or 0)] = '%s: %s' % (
+                    values.get('ResultMessageCode'),
+                    values.get('ResultDescription'),
+                )
+
+        FeedQueue.set_results(
+            [e for e in self.entries if e.state == 'submitted'], errors
+        )
+        self.write([self], {
+            'state': 'done',
+            'processing_status': '_DONE_',
+            'messages_processed': int(
+                summary.get('MessagesProcessed') or 0
+            ),
+            'messages_with_error': int(
+                summary.get('MessagesWithError') or 0
+            ),
+            'messages_with_warning': int(
+                summary.get('MessagesWithWarning') or 0
+            ),
+        })
+
+    def cancel(self, error='Feed submission cancelled'):
+        """
+        Queue again the messages of the submission cancelled by amazon
+
+        :param error: Error recorded on the messages
+        """
+        FeedQueue = Pool().get('amazon.feed.queue')
+
+        entries = [e for e in self.entries if e.state == 'submitted']
+        FeedQueue.set_results(entries, dict(
+            (e.message_id, error) for e in entries
+        ))
+        self.write([self], {
+            'state': 'cancelled',
+            'processing_status': '_CANCELLED_',
+        })
+
+    @classmethod
+    def poll_using_cron(cls):
+        """
+        Cron method to record the results of the submitted feeds
+        """
+        cls.poll()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    import_cache
+
+    Reference data cache of an amazon import run
+
+"""
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+__all__ = [
+    'LRUCache', 'AmazonImportCache', 'import_cache_run', 'get_import_cache'
+]
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Mapping which evicts the least recently used keys above `size_limit`
+    """
+
+    def __init__(self, size_limit=1024):
+        self.size_limit = size_limit
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        # Mark as most recently used
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.size_limit:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class AmazonImportCache(object):
+    """
+    Memoise the resolution of reference data (currencies, countries,
+    subdivisions, units of measure...) during an import run.
+
+    Ids are cached rather than active records, so that the cache stays
+    valid across the commits of the run.
+    """
+
+    def __init__(self, size_limit=1024):
+        self._cache = LRUCache(size_limit)
+
+    def get(self, key, getter):
+        """
+        Return the cached value of key, computed with getter on a miss.
+        None values are cached too.
+        """
+        value = self._cache.get(key, _missing)
+        if value is _missing:
+            value = getter()
+            self._cache.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def get_currency(self, code):
+        """
+        Return the currency with the code
+        """
+        Currency = Pool().get('currency.currency')
+
+        def getter():
+            currency, = Currency.search([
+                ('code', '=', code),
+            ], limit=1)
+            return currency.id
+        return Currency(self.get(('currency.currency', code), getter))
+
+    def get_country(self, code):
+        """
+        Return the country with the code
+        """
+        Country = Pool().get('country.country')
+
+        def getter():
+            country, = Country.search([
+                ('code', '=', code),
+            ], limit=1)
+            return country.id
+        return Country(self.get(('country.country', code), getter))
+
+    def get_subdivision(self, value, country):
+        """
+        Return the subdivision of the country for amazon StateOrRegion or
+        None
+        """
+        Subdivision = Pool().get('country.subdivision')
+
+        def getter():
+            subdivision = Subdivision.search_using_amazon_state(
+                value, country
+            )
+            return subdivision and subdivision.id
+        subdivision_id = self.get(
+            ('country.subdivision', country.id, value), getter
+        )
+        return subdivision_id and Subdivision(subdivision_id) or None
+
+    def get_channel_uom(self, channel):
+        """
+        Return the default unit of measure of the channel
+        """
+        Uom = Pool().get('product.uom')
+
+        return Uom(self.get(
+            ('default_uom', channel.id), lambda: channel.default_uom.id
+        ))
+
+
+@contextmanager
+def import_cache_run(cache=None):
+    """
+    Share an import cache between the calls of the block, the cache of an
+    enclosing run is reused.
+
+    The cache is kept on the transaction and not in its context, as the
+    context is part of the key of the caches of trytond.
+
+    :param cache: Cache to use instead of a new one
+    """
+    transaction = Transaction()
+    previous = getattr(transaction, 'amazon_import_cache', None)
+    transaction.amazon_import_cache = cache or previous or \
+        AmazonImportCache()
+    try:
+        yield transaction.amazon_import_cache
+    finally:
+        transaction.amazon_import_cache = previous
+
+
+def get_import_cache():
+    """
+    Return the cache of the import run of the transaction.
+    Outside of an import run, a new cache is returned so nothing is kept.
+    """
+    cache = getattr(Transaction(), 'amazon_import_cache', None)
+    if cache is None:
+        cache = AmazonImportCache()
+    return cache
@@ -5,13 +5,42 @@
     Party
 
 """
+import hashlib
+from collections import defaultdict
+
+from sql.conditionals import Case
+
+from trytond import backend
 from trytond.model import fields
+from trytond.tools import reduce_ids
 from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+from import_cache import get_import_cache
 
 
 __all__ = ['Party', 'Address']
 __metaclass__ = PoolMeta
 
+#: Fields of the address the fingerprint depends on
+FINGERPRINT_FIELDS = set([
+    'name', 'street', 'streetbis', 'zip', 'city', 'country', 'subdivision',
+])
+
+
+def address_fingerprint(
+        name, street, streetbis, zip, city, country_code, subdivision_code):
+    """
+    Return the fingerprint of an address: a hash of its fields normalised
+    for case and whitespaces.
+    """
+    values = []
+    for value in (
+            name, street, streetbis, zip, city, country_code,
+            subdivision_code):
+        values.append(u' '.join((value or u'').lower().split()))
+    return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
+
 
 class Party:
     "Party"
@@ -51,23 +80,71 @@ class Party:
         :param amazon_data: Dictionary of values for customer sent by amazon
         :return: Active record of record created
         """
-        parties = cls.search([
-            ('amazon_user_email', '=', amazon_data['email']),
-        ])
-        if parties:
-            return parties[0]
+        import_cache = get_import_cache()
+        key = ('party.party', amazon_data['email'])
 
-        return cls.create_using_amazon_data(amazon_data)
+        def getter():
+            parties = cls.search([
+                ('amazon_user_email', '=', amazon_data['email']),
+            ])
+            return parties and parties[0].id or None
+
+        party_id = import_cache.get(key, getter)
+        if party_id:
+            return cls(party_id)
+
+        party = cls.create_using_amazon_data(amazon_data)
+        import_cache.set(key, party.id)
+        return party
 
     @classmethod
-    def create_using_amazon_data(cls, amazon_data):
+    def find_or_create_bulk_using_amazon_data(cls, amazon_data_list):
         """
-        Creates record of customer values sent by amazon
+        Find the parties of many amazon customers with one search and
+        create the missing ones with one create.
+
+        The parties are also added to the cache of the import run.
+
+        :param amazon_data_list: List of dictionaries of values for
+                                 customers sent by amazon
+        :return: Dictionary mapping amazon email to active record of party
+        """
+        import_cache = get_import_cache()
+
+        data_by_email = {}
+        for amazon_data in amazon_data_list:
+            data_by_email.setdefault(amazon_data['email'], amazon_data)
+        emails = data_by_email.keys()
+
+        parties = {}
+        in_max = Transaction().cursor.IN_MAX
+        for i in range(0, len(emails), in_max):
+            for party in cls.search([
+                ('amazon_user_email', 'in', emails[i:i + in_max]),
+            ], order=[('id', 'DESC')]):
+                # Keep the oldest party in case of duplicates
+                parties[party.amazon_user_email] = party
+
+        missing_emails = [e for e in emails if e not in parties]
+        if missing_emails:
+            created = cls.create([
+                cls.get_values_using_amazon_data(data_by_email[email])
+                for email in missing_emails
+            ])
+            parties.update(zip(missing_emails, created))
+
+        for email, party in parties.iteritems():
+            import_cache.set(('party.party', email), party.id)
+        return parties
+
+    @classmethod
+    def get_values_using_amazon_data(cls, amazon_data):
+        """
+        Return the values to create a party for the customer sent by amazon
 
         :param amazon_data: Dictionary of values for customer sent by amazon
-        :return: Active record of record created
         """
-        return cls.create([{
+        return {
             'name': amazon_data['name'],
             'amazon_user_email': amazon_data['email'],
             'contact_mechanisms': [
@@ -76,7 +153,19 @@ class Party:
                     'value': amazon_data['email']
                 }])
             ]
-        }])[0]
+        }
+
+    @classmethod
+    def create_using_amazon_data(cls, amazon_data):
+        """
+        Creates record of customer values sent by amazon
+
+        :param amazon_data: Dictionary of values for customer sent by amazon
+        :return: Active record of record created
+        """
+        return cls.create([
+            cls.get_values_using_amazon_data(amazon_data)
+        ])[0]
 
     def add_phone_using_amazon_data(self, amazon_phone):
         """
@@ -84,6 +173,11 @@ class Party:
         """
         ContactMechanism = Pool().get('party.contact_mechanism')
 
+        import_cache = get_import_cache()
+        key = ('party.phone', self.id, amazon_phone)
+        if import_cache.get(key, lambda: False):
+            return
+
         if not ContactMechanism.search([
             ('party', '=', self.id),
             ('type', 'in', ['phone', 'mobile']),
@@ -94,30 +188,205 @@ class Party:
                 'type': 'phone',
                 'value': amazon_phone,
             }])
+        import_cache.set(key, True)
+
+    @classmethod
+    def add_phones_using_amazon_data(cls, party_phones):
+        """
+        Add the phones to the parties with one search and one create.
+
+        :param party_phones: List of tuples (party, amazon phone)
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        import_cache = get_import_cache()
+        phones = set((p.id, phone) for p, phone in party_phones)
+        if not phones:
+            return
+
+        party_ids = list(set(party_id for party_id, _ in phones))
+        values = list(set(phone for _, phone in phones))
+        existing = set()
+        in_max = Transaction().cursor.IN_MAX
+        for i in range(0, len(party_ids), in_max):
+            for j in range(0, len(values), in_max):
+                for mechanism in ContactMechanism.search([
+                    ('party', 'in', party_ids[i:i + in_max]),
+                    ('type', 'in', ['phone', 'mobile']),
+                    ('value', 'in', values[j:j + in_max]),
+                ]):
+                    existing.add((mechanism.party.id, mechanism.value))
+
+        missing = phones - existing
+        if missing:
+            ContactMechanism.create([{
+                'party': party_id,
+                'type': 'phone',
+                'value': phone,
+            } for party_id, phone in missing])
+
+        for party_id, phone in phones:
+            import_cache.set(('party.phone', party_id, phone), True)
 
 
 class Address:
     "Address"
     __name__ = 'party.address'
 
-    def is_match_found(self, amazon_address):
+    amazon_fingerprint = fields.Char(
+        'Amazon Fingerprint', readonly=True, select=True,
+        help="Hash of the normalised fields of the address, used to match "
+        "addresses sent by amazon"
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        backfill = not table.column_exist('amazon_fingerprint')
+
+        super(Address, cls).__register__(module_name)
+
+        # Migration: compute the fingerprint of existing addresses
+        if backfill:
+            cls.migrate_amazon_fingerprint()
+
+    @classmethod
+    def migrate_amazon_fingerprint(cls):
+        """
+        Compute the fingerprint of all the addresses, with one update per
+        IN_MAX addresses
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+        cursor = Transaction().cursor
+        address = cls.__table__()
+        country = Country.__table__()
+        subdivision = Subdivision.__table__()
+
+        cursor.execute(*address.join(
+            country, 'LEFT', condition=address.country == country.id
+        ).join(
+            subdivision, 'LEFT',
+            condition=address.subdivision == subdivision.id
+        ).select(
+            address.id, address.name, address.street, address.streetbis,
+            address.zip, address.city, country.code, subdivision.code
+        ))
+        rows = cursor.fetchall()
+        for i in range(0, len(rows), cursor.IN_MAX):
+            sub_rows = rows[i:i + cursor.IN_MAX]
+            cursor.execute(*address.update(
+                [address.amazon_fingerprint],
+                [Case(*[
+                    (address.id == row[0], address_fingerprint(*row[1:]))
+                    for row in sub_rows
+                ])],
+                where=reduce_ids(address.id, [row[0] for row in sub_rows])
+            ))
+
+    @classmethod
+    def create(cls, vlist):
+        # Fields of the fingerprint left to their default value
+        defaults = cls.default_get(
+            list(FINGERPRINT_FIELDS), with_rec_name=False
+        )
+        new_vlist = []
+        for values in vlist:
+            new_values = defaults.copy()
+            new_values.update(values)
+            new_values['amazon_fingerprint'] = \
+                cls.get_amazon_fingerprint_from_values(new_values)
+            new_vlist.append(new_values)
+        return super(Address, cls).create(new_vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for addresses, values in zip(actions, actions):
+            if not set(values) & FINGERPRINT_FIELDS:
+                args.extend([addresses, values])
+                continue
+            # Addresses are grouped by their new fingerprint which also
+            # depends on their fields not written
+            by_fingerprint = defaultdict(list)
+            for address in addresses:
+                by_fingerprint[cls.get_amazon_fingerprint_from_values(
+                    values, address
+                )].append(address)
+            for fingerprint, sub_addresses in by_fingerprint.iteritems():
+                args.extend([sub_addresses, dict(
+                    values, amazon_fingerprint=fingerprint
+                )])
+        super(Address, cls).write(*args)
+
+    @classmethod
+    def get_amazon_fingerprint_from_values(cls, values, address=None):
+        """
+        Return the fingerprint of an address with the values, the fields
+        not in values are taken from address.
+
+        :param values: Dictionary of values of the fields of the address
+        :param address: Active record of the address written or None
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+
+        fields_values = {}
+        for name in FINGERPRINT_FIELDS:
+            if name in values:
+                value = values[name]
+            elif address is not None:
+                value = getattr(address, name)
+                if name in ('country', 'subdivision'):
+                    value = value and value.id
+            else:
+                value = None
+            fields_values[name] = value
+
+        country_id = fields_values['country']
+        subdivision_id = fields_values['subdivision']
+        return address_fingerprint(
+            fields_values['name'], fields_values['street'],
+            fields_values['streetbis'], fields_values['zip'],
+            fields_values['city'],
+            country_id and Country(country_id).code or None,
+            subdivision_id and Subdivision(subdivision_id).code or None,
+        )
+
+    @classmethod
+    def get_amazon_fingerprint_from_amazon_data(cls, address_data):
         """
-        Match the current address with the address fetched from amazon.
-        Match all the fields of the address, i.e., streets, city, subdivision
-        and country. For any deviation in any field, returns False.
+        Return the fingerprint of the address sent by amazon, its country
+        and subdivision are resolved through the import cache.
 
-        :param amazon_address: Amazon address instance
-        :return: True if address matches else False
+        :param address_data: Dictionary of address data from amazon
         """
-        return all([
-            self.name == amazon_address.name,
-            self.street == amazon_address.street,
-            self.streetbis == amazon_address.streetbis,
-            self.zip == amazon_address.zip,
-            self.city == amazon_address.city,
-            self.country == amazon_address.country,
-            self.subdivision == amazon_address.subdivision,
-        ])
+        import_cache = get_import_cache()
+        country = import_cache.get_country(
+            address_data['CountryCode']['value']
+        )
+        subdivision = import_cache.get_subdivision(
+            address_data['StateOrRegion']['value'], country
+        )
+        return address_fingerprint(
+            address_data['Name']['value'],
+            (
+                address_data.get('AddressLine1') and
+                address_data['AddressLine1']['value'] or None
+            ),
+            (
+                address_data.get('AddressLine2') and
+                address_data['AddressLine2'].get('value') or None
+            ),
+            address_data['PostalCode']['value'],
+            address_data['City']['value'],
+            country.code,
+            subdivision and subdivision.code,
+        )
 
     @classmethod
     def find_or_create_for_party_using_amazon_data(cls, party, address_data):
@@ -125,20 +394,27 @@ class Address:
         Look for the address in tryton corresponding to the address_record.
         If found, return the same else create a new one and return that.
 
+        Addresses are matched on their fingerprint, so only one indexed
+        search is done whatever the number of addresses of the party.
+
         :param party: Party active record
         :param address_data: Dictionary of address data from amazon
         :return: Active record of address created/found
         """
-        amazon_address = cls.get_address_from_amazon_data(party, address_data)
-
-        for address in party.addresses:
-            if address.is_match_found(amazon_address):
-                return address
+        fingerprint = cls.get_amazon_fingerprint_from_amazon_data(
+            address_data
+        )
+        addresses = cls.search([
+            ('party', '=', party.id),
+            ('amazon_fingerprint', '=', fingerprint),
+        ], limit=1)
+        if addresses:
+            return addresses[0]
 
-        else:
-            # Create new address
-            amazon_address.save()
-            return amazon_address
+        # Create new address
+        amazon_address = cls.get_address_from_amazon_data(party, address_data)
+        amazon_address.save()
+        return amazon_address
 
     @classmethod
     def get_address_from_amazon_data(cls, party, address_data):
@@ -146,13 +422,12 @@ class Address:
         Return address instance for data fetched from amazon
         """
         Address = Pool().get('party.address')
-        Country = Pool().get('country.country')
-        Subdivision = Pool().get('country.subdivision')
 
-        country, = Country.search([
-            ('code', '=', address_data['CountryCode']['value'])
-        ], limit=1)
-        subdivision = Subdivision.search_using_amazon_state(
+        import_cache = get_import_cache()
+        country = import_cache.get_country(
+            address_data['CountryCode']['value']
+        )
+        subdivision = import_cache.get_subdivision(
             address_data['StateOrRegion']['value'], country
         )
 
@@ -3,8 +3,7 @@
     product
 
 '''
-from decimal import Decimal
-from lxml import etree
+from decimal import Decimal, InvalidOperation
 from lxml.builder import E
 from collections import defaultdict
 
@@ -12,6 +11,9 @@ from trytond.model import fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
+from trytond.tools import reduce_ids
+
+from import_cache import get_import_cache
 
 
 __all__ = [
@@ -19,6 +21,11 @@ __all__ = [
 ]
 __metaclass__ = PoolMeta
 
+#: Fields of listings the product cache of amazon channels depends on
+AMAZON_PRODUCT_CACHE_FIELDS = set([
+    'channel', 'product', 'product_identifier', 'fba_code', 'asin',
+])
+
 
 class Template:
     "Product Template"
@@ -33,36 +40,71 @@ class Product:
 
     asin = fields.Function(fields.Many2One(
         'product.product.code', 'ASIN'
-    ), 'get_codes')
+    ), 'get_codes', searcher='search_codes')
     ean = fields.Function(fields.Many2One(
         'product.product.code', 'EAN'
-    ), 'get_codes')
+    ), 'get_codes', searcher='search_codes')
     upc = fields.Function(fields.Many2One(
         'product.product.code', 'UPC'
-    ), 'get_codes')
+    ), 'get_codes', searcher='search_codes')
     isbn = fields.Function(fields.Many2One(
         'product.product.code', 'ISBN'
-    ), 'get_codes')
+    ), 'get_codes', searcher='search_codes')
     gtin = fields.Function(fields.Many2One(
         'product.product.code', 'GTIN'
-    ), 'get_codes')
+    ), 'get_codes', searcher='search_codes')
 
     @classmethod
     def get_codes(cls, products, names):
+        """
+        Return the first code of each type in names for the products, all
+        read with one query per slice of products.
+        """
         ProductCode = Pool().get('product.product.code')
+        code = ProductCode.__table__()
+        cursor = Transaction().cursor
 
         res = {}
         for name in names:
-            res[name] = {}
-            for product in products:
-                code = ProductCode.search([
-                    ('product', '=', product.id),
-                    ('code_type', '=', name)
-                ])
-                res[name][product.id] = code and code[0].id or None
+            res[name] = dict((product.id, None) for product in products)
+
+        product_ids = map(int, products)
+        for i in range(0, len(product_ids), cursor.IN_MAX):
+            sub_ids = product_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*code.select(
+                code.id, code.product, code.code_type,
+                where=reduce_ids(code.product, sub_ids) &
+                code.code_type.in_(names),
+                order_by=code.id.desc
+            ))
+            for code_id, product_id, code_type in cursor.fetchall():
+                # Rows are sorted by descending id so the first code wins
+                res[code_type][product_id] = code_id
 
         return res
 
+    @classmethod
+    def search_codes(cls, name, clause):
+        """
+        Search products on the value of their code of type name, with a
+        subquery on product.product.code. Searching None matches the
+        products without a code of the type.
+        """
+        ProductCode = Pool().get('product.product.code')
+        code = ProductCode.__table__()
+
+        _, operator, value = clause
+        if value is None and operator in ('=', '!='):
+            query = code.select(code.product, where=code.code_type == name)
+            return [('id', 'not in' if operator == '=' else 'in', query)]
+
+        Operator = fields.SQL_OPERATORS[operator]
+        query = code.select(
+            code.product,
+            where=(code.code_type == name) & Operator(code.code, value)
+        )
+        return [('id', 'in', query)]
+
     @classmethod
     def extract_product_values_from_amazon_data(cls, product_attributes):
         """
@@ -80,11 +122,12 @@ class Product:
         )
         assert amazon_channel.source == 'amazon_mws'
 
+        uom = get_import_cache().get_channel_uom(amazon_channel)
         return {
             'name': product_attributes['Title']['value'],
-            'default_uom': amazon_channel.default_uom.id,
+            'default_uom': uom.id,
             'salable': True,
-            'sale_uom': amazon_channel.default_uom.id,
+            'sale_uom': uom.id,
         }
 
     @classmethod
@@ -104,7 +147,38 @@ class Product:
         :param product_data: Product Data from Amazon
         :returns: Active record of product created
         """
+        product, = cls.create_bulk_using_amazon_data([product_data])
+        return product
+
+    @classmethod
+    def create_bulk_using_amazon_data(cls, products_data):
+        """
+        Create new products from amazon data with one create.
+
+        :param products_data: List of product data from amazon
+        :returns: List of active records of the products created, in the
+                  order of `products_data`
+        """
         Template = Pool().get('product.template')
+
+        if not products_data:
+            return []
+
+        templates = Template.create([
+            cls.get_template_values_using_amazon_data(product_data)
+            for product_data in products_data
+        ])
+        return [template.products[0] for template in templates]
+
+    @classmethod
+    def get_template_values_using_amazon_data(cls, product_data):
+        """
+        Returns the values to create the template and product of the
+        `product_data` from amazon.
+
+        :param product_data: Product Data from Amazon
+        :returns: Dictionary of values of the template
+        """
         Currency = Pool().get('currency.currency')
         SaleChannel = Pool().get('sale.channel')
 
@@ -130,9 +204,7 @@ class Product:
         if product_attributes.get('ListPrice'):
             list_price = product_attributes['ListPrice']['Amount']['value']
             currency_code = product_attributes['ListPrice']['CurrencyCode']['value']  # noqa
-            currency, = Currency.search([
-                ('code', '=', currency_code),
-            ], limit=1)
+            currency = get_import_cache().get_currency(currency_code)
             list_price = Currency.compute(
                 currency, Decimal(list_price),
                 amazon_channel.company.currency
@@ -146,10 +218,71 @@ class Product:
                 'description': product_attributes['Title']['value'],
             }])],
         })
+        return product_values
+
+    @classmethod
+    def create_bulk_using_amazon_report(cls, rows):
+        """
+        Create new products from the rows of a catalog report of amazon
+        with one create.
 
-        product_template, = Template.create([product_values])
+        :param rows: List of dictionaries with the sku, name and price of
+                     the products
+        :returns: List of active records of the products created, in the
+                  order of `rows`
+        """
+        Template = Pool().get('product.template')
+
+        if not rows:
+            return []
 
-        return product_template.products[0]
+        templates = Template.create([
+            cls.get_template_values_using_amazon_report(row) for row in rows
+        ])
+        return [template.products[0] for template in templates]
+
+    @classmethod
+    def get_template_values_using_amazon_report(cls, row):
+        """
+        Returns the values to create the template and product of a row of
+        a catalog report of amazon. Prices of the report are in the
+        currency of the channel.
+
+        :param row: Dictionary with the sku, name and price of the product
+        :returns: Dictionary of values of the template
+        """
+        Currency = Pool().get('currency.currency')
+        SaleChannel = Pool().get('sale.channel')
+
+        amazon_channel = SaleChannel(
+            Transaction().context['current_channel']
+        )
+        assert amazon_channel.source == 'amazon_mws'
+
+        name = row.get('name') or row['sku']
+        product_values = cls.extract_product_values_from_amazon_data({
+            'Title': {'value': name},
+        })
+
+        list_price = Decimal('0.01')
+        if row.get('price'):
+            try:
+                list_price = Currency.compute(
+                    amazon_channel.currency, Decimal(row['price']),
+                    amazon_channel.company.currency
+                )
+            except InvalidOperation:
+                pass
+
+        product_values.update({
+            'products': [('create', [{
+                'code': row['sku'],
+                'list_price': list_price,
+                'cost_price': list_price,
+                'description': name,
+            }])],
+        })
+        return product_values
 
 
 class ProductCode:
@@ -162,6 +295,9 @@ class ProductCode:
         Setup the class before adding to pool
         """
         super(ProductCode, cls).__setup__()
+        # Products are searched by code and type of code
+        cls.code.select = True
+        cls.code_type.select = True
         cls.code_type.selection.extend([
             ('upc', 'UPC'),
             ('isbn', 'ISBN'),
@@ -183,6 +319,52 @@ class ProductSaleChannelListing:
         'invisible': Eval('channel_source') == 'amazon_mws',
     }, depends=['channel_source'])
 
+    amazon_exported_quantity = fields.Integer(
+        'Exported Quantity', readonly=True, states={
+            'invisible': Eval('channel_source') != 'amazon_mws',
+        }, depends=['channel_source'],
+        help="Quantity last exported to amazon"
+    )
+    amazon_exported_latency = fields.Integer(
+        'Exported Fulfillment Latency', readonly=True, states={
+            'invisible': Eval('channel_source') != 'amazon_mws',
+        }, depends=['channel_source'],
+        help="Fulfillment latency last exported to amazon"
+    )
+    amazon_exported_price = fields.Numeric(
+        'Exported Price', digits=(16, 4), readonly=True, states={
+            'invisible': Eval('channel_source') != 'amazon_mws',
+        }, depends=['channel_source'],
+        help="Price last exported to amazon"
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        SaleChannel = Pool().get('sale.channel')
+
+        listings = super(ProductSaleChannelListing, cls).create(vlist)
+        SaleChannel._amazon_product_cache.clear()
+        return listings
+
+    @classmethod
+    def write(cls, *args):
+        SaleChannel = Pool().get('sale.channel')
+
+        super(ProductSaleChannelListing, cls).write(*args)
+        # Exported values are written on every export and do not change
+        # the product of a SKU
+        if any(
+                set(values) & AMAZON_PRODUCT_CACHE_FIELDS
+                for values in args[1::2]):
+            SaleChannel._amazon_product_cache.clear()
+
+    @classmethod
+    def delete(cls, listings):
+        SaleChannel = Pool().get('sale.channel')
+
+        super(ProductSaleChannelListing, cls).delete(listings)
+        SaleChannel._amazon_product_cache.clear()
+
     def export_inventory(self):
         """
         Export inventory of this listing to external channel
@@ -193,10 +375,75 @@ class ProductSaleChannelListing:
         self.export_bulk_inventory([self])
 
     @classmethod
-    def export_bulk_inventory(cls, listings):
+    def reset_amazon_export(cls, listings, feed_type):
+        """
+        Forget the values last exported by a feed amazon failed to
+        process, so that the next export sends them again.
+
+        :param listings: Active record list of listings
+        :param feed_type: Amazon feed type of the failed messages
+        """
+        if feed_type == '_POST_INVENTORY_AVAILABILITY_DATA_':
+            cls.write(listings, {
+                'amazon_exported_quantity': None,
+                'amazon_exported_latency': None,
+            })
+        elif feed_type == '_POST_PRODUCT_PRICING_DATA_':
+            cls.write(listings, {
+                'amazon_exported_price': None,
+            })
+
+    @classmethod
+    def get_amazon_quantities(cls, listings):
+        """
+        Return the quantity of the listings, computed with one stock query
+        per warehouse. Listings fulfilled by amazon use the FBA warehouse
+        of their channel.
+
+        :param listings: Active record list of amazon listings
+        :return: Dictionary mapping listing id to quantity
+        """
+        Product = Pool().get('product.product')
+        Date = Pool().get('ir.date')
+
+        listings_by_warehouse = defaultdict(list)
+        for listing in listings:
+            channel = listing.channel
+            if listing.fba_code and channel.fba_warehouse:
+                warehouse = channel.fba_warehouse
+            else:
+                warehouse = channel.warehouse
+            listings_by_warehouse[warehouse.id].append(listing)
+
+        quantities = {}
+        with Transaction().set_context(stock_date_end=Date.today()):
+            for warehouse_id, warehouse_listings in \
+                    listings_by_warehouse.iteritems():
+                product_ids = list(set(
+                    l.product.id for l in warehouse_listings
+                ))
+                stock = Product.products_by_location(
+                    [warehouse_id], product_ids, with_childs=True
+                )
+                for listing in warehouse_listings:
+                    quantities[listing.id] = stock.get(
+                        (warehouse_id, listing.product.id), 0
+                    )
+        return quantities
+
+    @classmethod
+    def export_bulk_inventory(cls, listings, full_sync=False):
         """
         bulk export inventory to amazon
+
+        Only the listings whose quantity or fulfillment latency changed
+        since the last export are sent, unless full_sync is set.
+
+        :param listings: Active record list of listings
+        :param full_sync: Send the inventory of all the listings
         """
+        FeedQueue = Pool().get('amazon.feed.queue')
+
         if not listings:
             # Nothing to update
             return
@@ -209,35 +456,52 @@ class ProductSaleChannelListing:
             super(ProductSaleChannelListing, cls).export_bulk_inventory(
                 non_amazon_listings
             )
+        non_amazon_ids = set(map(int, non_amazon_listings))
         amazon_listings = filter(
-            lambda l: l not in non_amazon_listings, listings
+            lambda l: l.id not in non_amazon_ids, listings
         )
 
+        quantities = cls.get_amazon_quantities(amazon_listings)
+
         inventory_channel_map = defaultdict(list)
+        exported = defaultdict(list)
         for listing in amazon_listings:
             product = listing.product
             channel = listing.channel
 
+            quantity = int(round(quantities[listing.id]))
+            latency = max(product.delivery_time, 1)
+            if not full_sync and \
+                    listing.amazon_exported_quantity == quantity and \
+                    listing.amazon_exported_latency == latency:
+                continue
+
             # group inventory xml by channel
-            inventory_channel_map[channel].append(E.Message(
-                E.MessageID(str(product.id)),
-                E.OperationType('Update'),
-                E.Inventory(
-                    E.SKU(listing.product_identifier),
-                    E.Quantity("%d" % round(listing.quantity)),
-                    E.FulfillmentLatency(
-                        "%d" % max(product.delivery_time, 1)
-                    ),
-                )
+            inventory_channel_map[channel].append((
+                listing.product_identifier,
+                E.Message(
+                    E.OperationType('Update'),
+                    E.Inventory(
+                        E.SKU(listing.product_identifier),
+                        E.Quantity("%d" % quantity),
+                        E.FulfillmentLatency("%d" % latency),
+                    )
+                ),
+                listing,
             ))
+            exported[(quantity, latency)].append(listing)
 
-        for channel, elements in inventory_channel_map.iteritems():
-            envelope_xml = channel._get_amazon_envelop('Inventory', elements)
-
-            feeds_api = channel.get_amazon_feed_api()
-
-            feeds_api.submit_feed(
-                etree.tostring(envelope_xml),
-                feed_type='_POST_INVENTORY_AVAILABILITY_DATA_',
-                marketplaceids=[channel.amazon_marketplace_id]
+        # Submitted by the feed queue
+        for channel, messages in inventory_channel_map.iteritems():
+            FeedQueue.enqueue(
+                channel, '_POST_INVENTORY_AVAILABILITY_DATA_', messages
             )
+
+        args = []
+        for (quantity, latency), exported_listings in exported.iteritems():
+            args.extend([exported_listings, {
+                'amazon_exported_quantity': quantity,
+                'amazon_exported_latency': latency,
+            }])
+        if args:
+            cls.write(*args)
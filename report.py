@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    report
+
+    Download and parsing of the reports of amazon
+
+"""
+import csv
+import logging
+from io import BytesIO
+
+
+__all__ = ['iter_report_rows', 'iter_catalog_rows', 'get_generated_reports']
+
+logger = logging.getLogger("amazon_mws")
+
+#: Reports listing the catalog of a merchant
+CATALOG_REPORT_TYPES = [
+    '_GET_MERCHANT_LISTINGS_DATA_',
+    '_GET_AFN_INVENTORY_DATA_',
+]
+
+#: Seconds after which reports still not generated are given up
+REPORT_TIMEOUT = 2 * 60 * 60
+
+#: Encoding of the reports when amazon does not send it
+REPORT_ENCODING = 'cp1252'
+
+#: Processing status of the reports which are not generated yet
+REPORT_PENDING_STATUSES = ('_SUBMITTED_', '_IN_PROGRESS_')
+
+
+def iter_report_rows(report, encoding=REPORT_ENCODING):
+    """
+    Parse a tab delimited report of amazon one row at a time.
+
+    :param report: Content of the report as a string or a file object
+    :param encoding: Encoding of the report
+    :return: Generator of dictionaries mapping the column headers to the
+             unicode values of each row
+    """
+    if isinstance(report, basestring):
+        report = BytesIO(report)
+    reader = csv.DictReader(
+        report, delimiter='\t', quoting=csv.QUOTE_NONE
+    )
+    for row in reader:
+        yield dict(
+            (key.strip().lower(), (value or '').decode(encoding).strip())
+            for key, value in row.iteritems() if key
+        )
+
+
+def iter_catalog_rows(report_type, rows):
+    """
+    Convert the rows of a catalog report to the SKUs of the catalog.
+
+    :param report_type: One of CATALOG_REPORT_TYPES
+    :param rows: Iterable of rows of the report from iter_report_rows
+    :return: Generator of dictionaries with the sku, asin, name, price
+             and fulfillment_channel (MFN or AFN) of each SKU
+    """
+    for row in rows:
+        if not row.get('seller-sku'):
+            continue
+        if report_type == '_GET_MERCHANT_LISTINGS_DATA_':
+            # Listings fulfilled by amazon have the fulfillment network
+            # as channel, AMAZON_NA or AMAZON_EU
+            fulfillment_channel = row.get('fulfillment-channel', 'DEFAULT')
+            yield {
+                'sku': row['seller-sku'],
+                'asin': row.get('asin1') or None,
+                'name': row.get('item-name') or None,
+                'price': row.get('price') or None,
+                'fulfillment_channel': (
+                    'MFN' if fulfillment_channel in ('', 'DEFAULT')
+                    else 'AFN'
+                ),
+            }
+        else:
+            yield {
+                'sku': row['seller-sku'],
+                'asin': row.get('asin') or None,
+                'name': None,
+                'price': None,
+                'fulfillment_channel': 'AFN',
+            }
+
+
+def get_generated_reports(report_api, request_ids):
+    """
+    Check the processing status of requested reports with one
+    GetReportRequestList request.
+
+    :param report_api: Reports api instance
+    :param request_ids: List of ReportRequestId
+    :return: Dictionary mapping the ReportRequestId of the reports amazon
+             finished processing to the GeneratedReportId, or None when
+             there is no report to download (no data or cancelled)
+    """
+    response = report_api.get_report_request_list(
+        requestids=request_ids
+    ).parsed
+    infos = response.get('ReportRequestInfo') or []
+    if not isinstance(infos, list):
+        infos = [infos]
+
+    reports = {}
+    for info in infos:
+        status = info['ReportProcessingStatus']['value']
+        if status in REPORT_PENDING_STATUSES:
+            continue
+        request_id = info['ReportRequestId']['value']
+        reports[request_id] = None
+        if status == '_DONE_':
+            reports[request_id] = info['GeneratedReportId']['value']
+        else:
+            logger.info(
+                "Report %s finished with status %s" % (request_id, status)
+            )
+    return reports
@@ -6,21 +6,72 @@
 
 """
 import dateutil.parser
+from dateutil.tz import tzutc
 from decimal import Decimal
+from collections import OrderedDict
 
+from trytond.model import fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
 
+from import_cache import get_import_cache
+
 
 __all__ = ['Sale']
 __metaclass__ = PoolMeta
 
 
+def parse_amazon_datetime(value):
+    """
+    Parse a datetime sent by amazon to a naive UTC datetime
+    """
+    value = dateutil.parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(tzutc()).replace(tzinfo=None)
+    return value
+
+
 class Sale:
     "Sale"
     __name__ = 'sale.sale'
 
+    amazon_order_status = fields.Char(
+        'Amazon Order Status', readonly=True,
+        help="OrderStatus of the order on amazon when last synchronised"
+    )
+    amazon_last_update = fields.DateTime(
+        'Amazon Last Update', readonly=True,
+        help="LastUpdateDate of the order on amazon when last synchronised"
+    )
+
+    @staticmethod
+    def get_amazon_sync_values(order_data):
+        """
+        Return the values of the amazon status of the order
+
+        :param order_data: Order data from amazon
+        """
+        return {
+            'amazon_order_status': order_data['OrderStatus']['value'],
+            'amazon_last_update': (
+                order_data.get('LastUpdateDate') and
+                parse_amazon_datetime(order_data['LastUpdateDate']['value'])
+                or None
+            ),
+        }
+
+    def is_amazon_order_changed(self, order_data):
+        """
+        Check if the order changed on amazon since it was last synchronised
+
+        :param order_data: Order data from amazon
+        """
+        values = self.get_amazon_sync_values(order_data)
+        return any(
+            getattr(self, name) != value for name, value in values.items()
+        )
+
     @classmethod
     def find_or_create_using_amazon_id(cls, order_id):
         """
@@ -67,8 +118,20 @@ class Sale:
         :param order_data: Order data from amazon
         :return: Active record of record created
         """
-        Party = Pool().get('party.party')
-        Address = Pool().get('party.address')
+        sale, = cls.create_bulk_using_amazon_data([(order_data, line_data)])
+        return sale
+
+    @classmethod
+    def create_bulk_using_amazon_data(cls, orders):
+        """
+        Create the sales of many amazon orders with one create, then
+        process them with one workflow transition per group of sales
+        going to the same state.
+
+        :param orders: List of (order data, line data) from amazon
+        :return: List of active records of the sales created, in the
+                 order of `orders`
+        """
         SaleChannel = Pool().get('sale.channel')
         ChannelException = Pool().get('channel.exception')
 
@@ -77,10 +140,61 @@ class Sale:
         )
         assert amazon_channel.source == 'amazon_mws'
 
-        party_values = {
-            'name': order_data['BuyerName']['value'],
-            'email': order_data['BuyerEmail']['value'],
-        }
+        if not orders:
+            return []
+
+        cls.prepare_parties_using_amazon_data(
+            [order_data for order_data, _ in orders]
+        )
+        sales = cls.create([
+            cls.get_sale_with_party_using_amazon_data(
+                order_data, line_data
+            )._save_values
+            for order_data, line_data in orders
+        ])
+
+        # TODO: Handle Discounts
+        # TODO: Handle Taxes
+
+        exceptions = []
+        to_process = []
+        for sale, (order_data, _) in zip(sales, orders):
+            if sale.total_amount != Decimal(
+                order_data['OrderTotal']['Amount']['value']
+            ):
+                exceptions.append({
+                    'origin': '%s,%s' % (sale.__name__, sale.id),
+                    'log': 'Order total does not match.',
+                    'channel': sale.channel.id,
+                })
+            else:
+                to_process.append((sale, order_data))
+        if exceptions:
+            ChannelException.create(exceptions)
+
+        cls.process_bulk_using_amazon_data(to_process)
+
+        # Fresh records, the processing changed their state
+        return cls.browse(map(int, sales))
+
+    @classmethod
+    def get_sale_with_party_using_amazon_data(cls, order_data, line_data):
+        """
+        Returns the unsaved sale of an amazon order with its party,
+        addresses, channel and workflow methods.
+
+        :param order_data: Order data from amazon
+        :param line_data: Order items data from amazon
+        """
+        Party = Pool().get('party.party')
+        Address = Pool().get('party.address')
+        SaleChannel = Pool().get('sale.channel')
+
+        amazon_channel = SaleChannel(
+            Transaction().context['current_channel']
+        )
+
+        party_values = cls.get_party_values_using_amazon_data(order_data)
         party = Party.find_or_create_using_amazon_data(party_values)
         if 'Phone' in order_data['ShippingAddress']:
             party.add_phone_using_amazon_data(
@@ -97,30 +211,117 @@ class Sale:
         sale.invoice_address = party_invoice_address.id
         sale.shipment_address = party_shipping_address.id
         sale.channel = amazon_channel.id
+        for name, value in cls.get_amazon_sync_values(order_data).items():
+            setattr(sale, name, value)
 
         if order_data['FulfillmentChannel']['value'] == 'AFN':
             sale.warehouse = amazon_channel.fba_warehouse.id
             sale.invoice_method = 'manual'
             sale.shipment_method = 'order'
+        else:
+            tryton_action = amazon_channel.get_tryton_action(
+                order_data['OrderStatus']['value']
+            )
+            if tryton_action['action'] in (
+                    'process_manually', 'process_automatically'):
+                # Set as process_to_channel_state would, so the sales
+                # can be processed in bulk
+                sale.invoice_method = tryton_action['invoice_method']
+                sale.shipment_method = tryton_action['shipment_method']
+        return sale
 
-        sale.save()
+    @classmethod
+    def process_bulk_using_amazon_data(cls, sales_data):
+        """
+        Process new sales of amazon orders to the state of the order on
+        amazon, with one transition per group of sales.
 
-        # TODO: Handle Discounts
-        # TODO: Handle Taxes
+        A group failing is processed one sale at a time, so that only the
+        sales in error are left for the user with a channel exception.
 
-        if sale.total_amount != Decimal(
-            order_data['OrderTotal']['Amount']['value']
-        ):
-            ChannelException.create([{
-                'origin': '%s,%s' % (sale.__name__, sale.id),
-                'log': 'Order total does not match.',
-                'channel': sale.channel.id,
-            }])
+        :param sales_data: List of (sale, order data from amazon)
+        """
+        SaleChannel = Pool().get('sale.channel')
+
+        amazon_channel = SaleChannel(
+            Transaction().context['current_channel']
+        )
+
+        groups = OrderedDict([
+            ('afn', []),
+            ('process_manually', []),
+            ('process_automatically', []),
+        ])
+        one_by_one = []
+        for sale, order_data in sales_data:
+            if order_data['FulfillmentChannel']['value'] == 'AFN':
+                groups['afn'].append((sale, order_data))
+                continue
+            action = amazon_channel.get_tryton_action(
+                order_data['OrderStatus']['value']
+            )['action']
+            if action in groups:
+                groups[action].append((sale, order_data))
+            else:
+                # Past orders and other actions are left to the channel
+                one_by_one.append((sale, order_data))
+
+        for group, group_data in groups.iteritems():
+            if not group_data:
+                continue
+            sales = cls.browse([sale.id for sale, _ in group_data])
+            try:
+                if group == 'afn':
+                    cls.process_fba_orders(sales)
+                else:
+                    cls.quote(sales)
+                    cls.confirm(sales)
+                    if group == 'process_automatically':
+                        cls.process(sales)
+                        cls.assign_try_shipments(sales)
+            except UserError:
+                one_by_one.extend(group_data)
+
+        for sale, order_data in one_by_one:
+            cls.process_using_amazon_data(cls(sale.id), order_data)
+
+    @classmethod
+    def assign_try_shipments(cls, sales):
+        """
+        Try to assign the shipments of many processed sales at once, like
+        process_to_channel_state does for one sale.
+
+        :param sales: Active record list of sales
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = [
+            shipment for sale in cls.browse(map(int, sales))
+            for shipment in sale.shipments
+        ]
+        draft = [s for s in shipments if s.state == 'draft']
+        if draft:
+            Shipment.wait(draft)
+        # Browse again to read the state after the transition
+        waiting = [
+            s for s in Shipment.browse(map(int, shipments))
+            if s.state == 'waiting'
+        ]
+        if waiting:
+            Shipment.assign_try(waiting)
+
+    @classmethod
+    def process_using_amazon_data(cls, sale, order_data):
+        """
+        Process the sale of an amazon order to the state of the order on
+        amazon, errors are logged as channel exceptions.
 
-            return sale
+        :param sale: Active record of the sale
+        :param order_data: Order data from amazon
+        """
+        ChannelException = Pool().get('channel.exception')
 
-        # Process sale now
-        tryton_action = amazon_channel.get_tryton_action(
+        tryton_action = sale.channel.get_tryton_action(
             order_data['OrderStatus']['value']
         )
         try:
@@ -140,7 +341,41 @@ class Sale:
                 'channel': sale.channel.id,
             }])
 
-        return sale
+    @staticmethod
+    def get_party_values_using_amazon_data(order_data):
+        """
+        Returns the values of the buyer of the amazon order
+
+        :param order_data: Order data from amazon
+        """
+        return {
+            'name': order_data['BuyerName']['value'],
+            'email': order_data['BuyerEmail']['value'],
+        }
+
+    @classmethod
+    def prepare_parties_using_amazon_data(cls, orders_data):
+        """
+        Find or create the buyers of many amazon orders and their phones
+        in bulk, so that creating the sales finds them in the cache of the
+        import run.
+
+        :param orders_data: List of order data from amazon
+        """
+        Party = Pool().get('party.party')
+
+        parties = Party.find_or_create_bulk_using_amazon_data([
+            cls.get_party_values_using_amazon_data(order_data)
+            for order_data in orders_data
+        ])
+        Party.add_phones_using_amazon_data([
+            (
+                parties[order_data['BuyerEmail']['value']],
+                order_data['ShippingAddress']['Phone']['value']
+            )
+            for order_data in orders_data
+            if 'Phone' in order_data['ShippingAddress']
+        ])
 
     @classmethod
     def get_sale_using_amazon_data(cls, order_data, line_data):
@@ -148,10 +383,10 @@ class Sale:
         Returns sale for amazon order
         """
         Sale = Pool().get('sale.sale')
-        Currency = Pool().get('currency.currency')
-        currency, = Currency.search([
-            ('code', '=', order_data['OrderTotal']['CurrencyCode']['value'])
-        ], limit=1)
+
+        currency = get_import_cache().get_currency(
+            order_data['OrderTotal']['CurrencyCode']['value']
+        )
 
         return Sale(
             reference=order_data['AmazonOrderId']['value'],
@@ -193,6 +428,7 @@ class Sale:
             Transaction().context['current_channel']
         )
         amazon_channel.validate_amazon_channel()
+        uom = get_import_cache().get_channel_uom(amazon_channel)
         for order_item in order_items:
             quantity = Decimal(order_item['QuantityOrdered']['value'])
             promotion_discount = Decimal(
@@ -219,7 +455,7 @@ class Sale:
                 SaleLine(
                     description=order_item['Title']['value'],
                     unit_price=unit_price,
-                    unit=amazon_channel.default_uom.id,
+                    unit=uom.id,
                     quantity=quantity,
                     product=amazon_channel.get_product(
                         order_item['SellerSKU']['value'],
@@ -270,7 +506,7 @@ class Sale:
         return SaleLine(
             description=shipping_description,
             unit_price=(shipping_price - shipping_discount),
-            unit=amazon_channel.default_uom.id,
+            unit=get_import_cache().get_channel_uom(amazon_channel).id,
             quantity=1
         )
 
@@ -280,54 +516,100 @@ class Sale:
         :TODO: this only handles shipped orders of amazon mws. Should handle
         other states too?
         """
-        Shipment = Pool().get('stock.shipment.out')
-
         if order_data is None:
             order_api = self.channel.get_amazon_order_api()
             order_data = order_api.get_order(
                 [self.channel_identifier]
             ).parsed['Orders']['Order']
 
-        if order_data['OrderStatus']['value'] == "Canceled":
-            # TODO
-            # If not done
-            # - cancel shipment
-            # - cancel invoice or credit invoice
-            pass
-
-        if order_data['OrderStatus']['value'] == "Shipped":
-            # Order is completed on amazon, process shipments and
-            # invoices.
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign([shipment])
-                if shipment.state == 'assigned':
-                    Shipment.pack([shipment])
-                if shipment.state == 'packed':
-                    Shipment.done([shipment])
-
-            # TODO: handle invoices?
+        self.update_orders_status_from_amazon_mws([(self, order_data)])
+
+    @classmethod
+    def update_orders_status_from_amazon_mws(cls, sales_data):
+        """
+        Update the status of many sales from their amazon orders, the
+        shipments of all the shipped orders are processed together.
+
+        :param sales_data: List of (sale, order data from amazon)
+        """
+        shipped_sales = []
+        args = []
+        for sale, order_data in sales_data:
+            if order_data['OrderStatus']['value'] == "Canceled":
+                # TODO
+                # If not done
+                # - cancel shipment
+                # - cancel invoice or credit invoice
+                pass
+
+            if order_data['OrderStatus']['value'] == "Shipped":
+                # Order is completed on amazon, process shipments and
+                # invoices.
+                shipped_sales.append(sale)
+
+                # TODO: handle invoices?
+
+            args.extend([[sale], cls.get_amazon_sync_values(order_data)])
+
+        if shipped_sales:
+            cls.process_shipments_to_done(shipped_sales)
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def process_shipments_to_done(cls, sales):
+        """
+        Process the shipments of many sales to done, with one call per
+        transition for all the shipments in the state it applies to.
+
+        Amazon shipped these sales already, so their shipments are marked
+        as exported to not send their status back to amazon.
+
+        :param sales: Active record list of sales
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipment_ids = OrderedDict()
+        for sale in cls.browse(map(int, sales)):
+            for shipment in sale.shipments:
+                shipment_ids[shipment.id] = True
+
+        for state, transition in [
+            ('draft', Shipment.wait),
+            ('waiting', Shipment.assign),
+            ('assigned', Shipment.pack),
+            ('packed', Shipment.done),
+        ]:
+            # Browse again to read the state after the last transition
+            shipments = [
+                s for s in Shipment.browse(shipment_ids.keys())
+                if s.state == state
+            ]
+            if shipments:
+                transition(shipments)
+
+        if shipment_ids:
+            Shipment.write(Shipment.browse(shipment_ids.keys()), {
+                'amazon_exported': True,
+            })
 
     def process_fba_order(self):
         """
         Process FBA Orders as they are imported as past orders
         and handle their shipments.
         """
-        Sale = Pool().get('sale.sale')
-        Shipment = Pool().get('stock.shipment.out')
+        self.process_fba_orders([self])
+
+    @classmethod
+    def process_fba_orders(cls, sales):
+        """
+        Process many FBA orders at once, as they are imported as past
+        orders, and handle their shipments.
+
+        :param sales: Active record list of sales
+        """
+        cls.quote(sales)
+        cls.confirm(sales)
+        cls.process(sales)
 
-        Sale.quote([self])
-        Sale.confirm([self])
-        Sale.process([self])
-
-        for shipment in self.shipments:
-            if shipment.state == 'draft':
-                Shipment.wait([shipment])
-            if shipment.state == 'waiting':
-                Shipment.assign([shipment])
-            if shipment.state == 'assigned':
-                Shipment.pack([shipment])
-            if shipment.state == 'packed':
-                Shipment.done([shipment])
+        cls.process_shipments_to_done(sales)
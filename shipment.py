@@ -2,9 +2,10 @@
 """
     shipment.py
 """
+from datetime import datetime
 from collections import defaultdict
 from lxml.builder import E
-from lxml import etree
+from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 
 
@@ -16,51 +17,82 @@ class ShipmentOut:
     "ShipmentOut"
     __name__ = 'stock.shipment.out'
 
+    amazon_exported = fields.Boolean(
+        'Exported to Amazon', readonly=True,
+        help="The status of the shipment was queued for amazon"
+    )
+
+    @staticmethod
+    def default_amazon_exported():
+        return False
+
+    @classmethod
+    def copy(cls, shipments, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('amazon_exported', False)
+        return super(ShipmentOut, cls).copy(shipments, default=default)
+
     def export_shipment_status_to_amazon(self):
         """
-        TODO: This should be done in bulk to avoid over using the amazon
-        API.
+        Export the status of this shipment to amazon, use
+        export_bulk_shipment_status_to_amazon to export many shipments.
         """
-        SaleLine = Pool().get('sale.line')
-        if self.state != 'done':
-            return
-
-        # Handle the case where a shipment could have been merged
-        # across channels or even two amazon accounts.
-        items_by_sale = defaultdict(list)
+        self.export_bulk_shipment_status_to_amazon([self])
 
+    def get_amazon_fulfilment_data(self):
+        """
+        Returns the FulfillmentData element of the shipment
+        """
         # Find carrier code and shipment method
         fulfilment_elements = []
         carrier_code = None
         shipping_method = 'Standard'
 
-        if self.carrier.carrier_cost_method in ('endicia', ):
+        # The carrier and tracking number of shipments are added by
+        # optional modules
+        carrier = getattr(self, 'carrier', None)
+        carrier_cost_method = carrier and carrier.carrier_cost_method
+        if carrier_cost_method in ('endicia', ):
             carrier_code = 'USPS'
             shipping_method = self.endicia_mailclass.name
-        elif self.carrier.carrier_cost_method == 'fedex':
+        elif carrier_cost_method == 'fedex':
             carrier_code = 'FedEx'
             shipping_method = self.fedex_service_type.name
-        elif self.carrier.carrier_cost_method == 'ups':
+        elif carrier_cost_method == 'ups':
             carrier_code = 'UPS'
             shipping_method = self.ups_service_type.name
         # TODO: Add GLS etc
 
         if carrier_code is None:
             fulfilment_elements.append(
-                E.CarrierName(
-                    self.carrier and self.carrier.rec_name or 'self'
-                )
+                E.CarrierName(carrier and carrier.rec_name or 'self')
             )
         else:
             fulfilment_elements.append(
                 E.CarrierCode(carrier_code)
             )
 
-        fulfilment_elements.extend([
-            E.ShippingMethod(shipping_method),
-            E.ShipperTrackingNumber(self.tracking_number),
-        ])
-        fulfilment_data = E.FulfillmentData(*fulfilment_elements)
+        fulfilment_elements.append(E.ShippingMethod(shipping_method))
+        tracking_number = getattr(self, 'tracking_number', None)
+        if tracking_number:
+            fulfilment_elements.append(
+                E.ShipperTrackingNumber(tracking_number)
+            )
+        return E.FulfillmentData(*fulfilment_elements)
+
+    def get_amazon_fulfilment_items(self):
+        """
+        Returns the Item elements of the shipment grouped by amazon sale
+
+        :return: Dictionary mapping active record of sale to Item elements
+        """
+        SaleLine = Pool().get('sale.line')
+
+        # Handle the case where a shipment could have been merged
+        # across channels or even two amazon accounts.
+        items_by_sale = defaultdict(list)
 
         # For all outgoing moves add items
         for move in self.outgoing_moves:
@@ -77,26 +109,94 @@ class ShipmentOut:
                     E.Quantity(str(int(move.quantity)))
                 )
             )
+        return items_by_sale
 
-        # For each sale, now export the data
-        for sale, items in items_by_sale.items():
-            message = E.Message(
-                E.MessageID(str(sale.id)),  # just has to be unique in envelope
-                E.OrderFulfillment(
-                    E.AmazonOrderID(sale.channel_identifier),
-                    E.FulfillmentDate(
-                        self.write_date.strftime('%Y-%m-%dT00:00:00Z')
+    @classmethod
+    def export_bulk_shipment_status_to_amazon(cls, shipments, since=None):
+        """
+        Queue the OrderFulfillment messages of many shipments, they are
+        submitted to amazon in one feed per channel by the feed queue.
+        The done shipments are marked as exported.
+
+        :param shipments: Active record list of shipments
+        :param since: Dictionary mapping channel id to date, shipments
+                      done before are not exported for that channel
+        :return: Number of messages queued
+        """
+        FeedQueue = Pool().get('amazon.feed.queue')
+
+        since = since or {}
+
+        done_shipments = []
+        messages_by_channel = defaultdict(list)
+        for shipment in shipments:
+            if shipment.state != 'done':
+                continue
+            done_shipments.append(shipment)
+            done_date = shipment.effective_date or shipment.write_date.date()
+            fulfilment_data = shipment.get_amazon_fulfilment_data()
+            fulfilment_date = done_date.strftime('%Y-%m-%dT00:00:00Z')
+            for sale, items in \
+                    shipment.get_amazon_fulfilment_items().iteritems():
+                channel_since = since.get(sale.channel.id)
+                if channel_since and done_date < channel_since:
+                    continue
+                messages_by_channel[sale.channel].append((
+                    # A shipment is exported once per sale
+                    '%s-%d' % (sale.channel_identifier, shipment.id),
+                    E.Message(
+                        E.OrderFulfillment(
+                            E.AmazonOrderID(sale.channel_identifier),
+                            E.FulfillmentDate(fulfilment_date),
+                            # Elements can only have one parent
+                            E.FulfillmentData(*[
+                                E(child.tag, child.text)
+                                for child in fulfilment_data
+                            ]),
+                            *items
+                        )
                     ),
-                    fulfilment_data,
-                    *items
-                )
-            )
-            envelope_xml = sale.channel._get_amazon_envelop(
-                'OrderFulfillment', [message]
-            )
-            feeds_api = sale.channel.get_amazon_feed_api()
-            feeds_api.submit_feed(
-                etree.tostring(envelope_xml),
-                feed_type='_POST_ORDER_FULFILLMENT_DATA_',
-                marketplaceids=[sale.channel.amazon_marketplace_id]
+                    shipment,
+                ))
+
+        for channel, messages in messages_by_channel.iteritems():
+            FeedQueue.enqueue(
+                channel, '_POST_ORDER_FULFILLMENT_DATA_', messages
             )
+        if done_shipments:
+            cls.write(done_shipments, {'amazon_exported': True})
+        return sum(map(len, messages_by_channel.values()))
+
+    @classmethod
+    def export_shipment_status_to_amazon_using_cron(cls):
+        """
+        Cron method to export the shipments not exported yet, which were
+        done since the shipment export date of each amazon channel
+        """
+        SaleChannel = Pool().get('sale.channel')
+
+        channels = SaleChannel.search([('source', '=', 'amazon_mws')])
+        if not channels:
+            return
+
+        # Channels without an export date only export the shipments
+        # done from now on, not all their history
+        new_channels = [
+            c for c in channels if not c.amazon_last_shipment_export_time
+        ]
+        if new_channels:
+            SaleChannel.write(new_channels, {
+                'amazon_last_shipment_export_time': datetime.utcnow(),
+            })
+            channels = SaleChannel.browse(map(int, channels))
+
+        since = dict(
+            (channel.id, channel.amazon_last_shipment_export_time.date())
+            for channel in channels
+        )
+        shipments = cls.search([
+            ('state', '=', 'done'),
+            ('amazon_exported', '=', False),
+            ('effective_date', '>=', min(since.values())),
+        ])
+        cls.export_bulk_shipment_status_to_amazon(shipments, since)
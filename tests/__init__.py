@@ -11,6 +11,9 @@ import trytond.tests.test_tryton
 from tests.test_views import TestViewDepend
 from tests.test_product import TestProduct
 from tests.test_sale import TestSale
+from tests.test_throttle import TestThrottle
+from tests.test_channel import TestChannel
+from tests.test_feed import TestFeed
 
 
 def suite():
@@ -22,6 +25,9 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestViewDepend),
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle),
+        unittest.TestLoader().loadTestsFromTestCase(TestChannel),
+        unittest.TestLoader().loadTestsFromTestCase(TestFeed),
     ])
     return test_suite
 
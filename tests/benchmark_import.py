@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_import
+
+    Benchmarks the lookup of already imported orders done by
+    SaleChannel.import_mws_order_bulk against the previous one search per
+    order approach.
+
+    This is not part of the test suite, run it directly:
+
+        python tests/benchmark_import.py
+
+"""
+import os
+import sys
+import copy
+import unittest
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase, QueryCounter, load_json
+
+ORDER_COUNTS = [100, 500, 1000, 5000]
+
+
+class BenchmarkImport(TestBase):
+    """
+    Benchmark deduplication of imported orders
+    """
+
+    def create_sales(self, count):
+        """
+        Create `count` sales already imported from amazon and return the
+        amazon order data for them
+        """
+        Sale = POOL.get('sale.sale')
+        Party = POOL.get('party.party')
+
+        party, = Party.create([{
+            'name': 'Amazon Buyer',
+            'addresses': [('create', [{'name': 'Amazon Buyer'}])],
+        }])
+        address, = party.addresses
+
+        order_template = load_json('orders', 'order_list')['Orders']['Order']
+        # Pending orders are not processed further, so only the lookup
+        # is measured
+        order_template['OrderStatus']['value'] = 'Pending'
+
+        orders = []
+        sale_values = []
+        for index in xrange(count):
+            order_id = 'BENCH-%07d' % index
+            order = copy.deepcopy(order_template)
+            order['AmazonOrderId']['value'] = order_id
+            orders.append(order)
+            sale_values.append({
+                'party': party.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+                'company': self.company.id,
+                'currency': self.company.currency.id,
+                'channel': self.sale_channel.id,
+                'channel_identifier': order_id,
+            })
+        Sale.create(sale_values)
+        return orders
+
+    def naive_lookup(self, orders):
+        """
+        Previous implementation, one search per order
+        """
+        Sale = POOL.get('sale.sale')
+
+        for order in orders:
+            Sale.search([
+                ('channel', '=', self.sale_channel.id),
+                ('channel_identifier', '=', order['AmazonOrderId']['value']),
+            ])
+
+    def test_benchmark_dedup(self):
+        """
+        Print query count and wall time for increasing order counts
+        """
+        results = []
+        for count in ORDER_COUNTS:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+
+                with Transaction().set_context(company=self.company.id):
+                    orders = self.create_sales(count)
+
+                    with QueryCounter() as naive:
+                        self.naive_lookup(orders)
+
+                    with QueryCounter() as bulk:
+                        sales = self.sale_channel.import_mws_order_bulk(
+                            orders
+                        )
+                    self.assertEqual(len(sales), count)
+
+                # Transaction is rolled back on exit
+                results.append((count, naive, bulk))
+
+        print
+        print '%8s | %14s | %14s | %10s | %10s' % (
+            'orders', 'queries before', 'queries after', 'secs before',
+            'secs after'
+        )
+        for count, naive, bulk in results:
+            print '%8d | %14d | %14d | %10.3f | %10.3f' % (
+                count, naive.count, bulk.count, naive.duration, bulk.duration
+            )
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestLoader().loadTestsFromTestCase(BenchmarkImport)
+    )
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_product
+
+    Benchmarks the code function fields of products against the previous
+    one search per product and code type approach.
+
+    This is not part of the test suite, run it directly:
+
+        python tests/benchmark_product.py
+
+"""
+import os
+import sys
+import unittest
+from decimal import Decimal
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase, QueryCounter
+
+PRODUCT_COUNT = 10000
+CODE_NAMES = ['asin', 'ean', 'upc', 'isbn', 'gtin']
+
+
+class BenchmarkProduct(TestBase):
+    """
+    Benchmark code function fields of products
+    """
+
+    def create_products(self, count):
+        """
+        Create `count` products with an ASIN and an EAN
+        """
+        Template = POOL.get('product.template')
+
+        account_expense = self.get_account_by_kind('expense')
+        account_revenue = self.get_account_by_kind('revenue')
+        templates = Template.create([{
+            'name': 'Product %d' % index,
+            'default_uom': self.uom.id,
+            'account_expense': account_expense,
+            'account_revenue': account_revenue,
+            'products': [('create', [{
+                'code': 'SKU%05d' % index,
+                'list_price': Decimal('10.0'),
+                'cost_price': Decimal('8.0'),
+                'codes': [('create', [{
+                    'code': 'ASIN%05d' % index,
+                    'code_type': 'asin',
+                }, {
+                    'code': '%013d' % index,
+                    'code_type': 'ean',
+                }])]
+            }])]
+        } for index in xrange(count)])
+        return [t.products[0] for t in templates]
+
+    def naive_get_codes(self, products, names):
+        """
+        Previous implementation, one search per product and code type
+        """
+        ProductCode = POOL.get('product.product.code')
+
+        res = {}
+        for name in names:
+            res[name] = {}
+            for product in products:
+                code = ProductCode.search([
+                    ('product', '=', product.id),
+                    ('code_type', '=', name)
+                ])
+                res[name][product.id] = code and code[0].id or None
+        return res
+
+    def test_benchmark_codes(self):
+        """
+        Print query count and wall time of reading and searching codes
+        """
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            products = self.create_products(PRODUCT_COUNT)
+
+            with QueryCounter() as naive:
+                expected = self.naive_get_codes(products, CODE_NAMES)
+
+            with QueryCounter() as bulk:
+                result = Product.get_codes(products, CODE_NAMES)
+            self.assertEqual(result, expected)
+
+            with QueryCounter() as search:
+                found = Product.search([('asin', '=', 'ASIN05000')])
+            self.assertEqual(len(found), 1)
+
+        print
+        print '%d products, codes %s' % (PRODUCT_COUNT, ', '.join(CODE_NAMES))
+        print '%20s | %8s | %8s' % ('', 'queries', 'seconds')
+        for label, counter in [
+            ('get_codes before', naive),
+            ('get_codes after', bulk),
+            ('search by asin', search),
+        ]:
+            print '%20s | %8d | %8.3f' % (
+                label, counter.count, counter.duration
+            )
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestLoader().loadTestsFromTestCase(BenchmarkProduct)
+    )
@@ -5,6 +5,7 @@
 """
 import os
 import json
+import time
 import unittest
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -45,6 +46,31 @@ def load_json(resource, filename):
     return json.loads(open(file_path).read())
 
 
+class QueryCounter(object):
+    """
+    Count the queries executed on the cursor of the current transaction
+    """
+
+    def __init__(self):
+        self.cursor = Transaction().cursor
+        self.count = 0
+
+    def __enter__(self):
+        execute = self.cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+
+        self.cursor.execute = counting_execute
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        del self.cursor.execute
+
+
 class TestBase(unittest.TestCase):
     """
     Setup basic defaults
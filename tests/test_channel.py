@@ -0,0 +1,784 @@
+# -*- coding: utf-8 -*-
+"""
+    test_channel
+
+    Tests Sale Channel
+
+"""
+import sys
+import os
+import copy
+import time
+import threading
+import multiprocessing
+from decimal import Decimal
+from datetime import datetime
+from collections import OrderedDict
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from dateutil.relativedelta import relativedelta
+from mws import mws
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase, load_json
+from trytond.modules.amazon_mws.channel import (
+    iter_order_pages, prefetch, fetch_order_items, init_sync_worker,
+    sync_merchant_channels
+)
+from trytond.modules.amazon_mws.import_cache import (
+    LRUCache, AmazonImportCache, import_cache_run, get_import_cache
+)
+
+
+def worker_transaction_state(args):
+    """
+    Return the state of the transaction of a scheduler worker
+    """
+    transaction = Transaction()
+    return transaction.user, transaction.cursor, transaction.context
+
+
+class FakeResponse(object):
+
+    def __init__(self, parsed=None, original=None):
+        self.parsed = parsed
+        self.original = original
+
+
+class FakeOrderAPI(object):
+    """
+    Order api returning the given pages of orders
+    """
+
+    def __init__(self, pages, expired=()):
+        self.pages = pages
+        # Tokens amazon does not accept
+        self.expired = set(expired)
+        self.requests = []
+
+    def _page(self, index):
+        response = {'Orders': {'Order': self.pages[index]}}
+        if index + 1 < len(self.pages):
+            response['NextToken'] = {'value': str(index + 1)}
+        return FakeResponse(response)
+
+    def list_orders(self, **kwargs):
+        self.requests.append(None)
+        return self._page(0)
+
+    def list_orders_by_next_token(self, next_token):
+        self.requests.append(next_token)
+        if next_token in self.expired:
+            raise mws.MWSError('<Code>InvalidParameterValue</Code>')
+        return self._page(int(next_token))
+
+
+class FakeOrderItemsAPI(object):
+    """
+    Order api answering the first orders last, failing for the order ids
+    in `errors`
+    """
+
+    def __init__(self, errors=()):
+        self.errors = set(errors)
+        self.threads = set()
+
+    def list_order_items(self, order_id):
+        self.threads.add(threading.current_thread().ident)
+        time.sleep(0.05 / (int(order_id) + 1))
+        if order_id in self.errors:
+            raise mws.MWSError('<Code>InvalidParameterValue</Code>')
+        return FakeResponse({'OrderItems': {'OrderItem': [order_id]}})
+
+
+class FakeProductAPI(object):
+    """
+    Product api matching every SKU with the same product, with the ASIN
+    given for the SKU or one of its own
+    """
+
+    def __init__(self, asins=None):
+        self.requests = []
+        self.asins = asins or {}
+
+    def get_matching_product_for_id(self, marketplaceid, type, id):
+        self.requests.append(list(id))
+        results = []
+        for sku in id:
+            result = copy.deepcopy(load_json('products', 'product-2'))
+            result['Id']['value'] = sku
+            result['Products']['Product']['Identifiers']['MarketplaceASIN'][
+                'ASIN']['value'] = self.asins.get(sku, 'ASIN-%s' % sku)
+            results.append(result)
+        return FakeResponse(results)
+
+
+MERCHANT_LISTINGS_REPORT = '\n'.join([
+    'item-name\tseller-sku\tprice\tasin1\tfulfillment-channel',
+    'Caf\xe9 Mug\tSKU-MFN\t10.00\tASIN1\tDEFAULT',
+    'Caf\xe9 Mug\tSKU-FBA\t10.00\tASIN1\tAMAZON_NA',
+    'Blue Shirt\tSKU-B\t12.50\tASIN2\tDEFAULT',
+]) + '\n'
+
+AFN_INVENTORY_REPORT = '\n'.join([
+    'seller-sku\tfulfillment-channel-sku\tasin\tQuantity Available',
+    'SKU-FBA\tX001\tASIN1\t5',
+    'SKU-C\tX002\tASIN3\t2',
+]) + '\n'
+
+
+class FakeReportAPI(object):
+    """
+    Report api generating the catalog reports at once, unless pending
+    """
+    reports = {
+        '_GET_MERCHANT_LISTINGS_DATA_': MERCHANT_LISTINGS_REPORT,
+        '_GET_AFN_INVENTORY_DATA_': AFN_INVENTORY_REPORT,
+    }
+
+    def __init__(self):
+        self.requests = []
+        self.pending = False
+
+    def request_report(self, report_type, start_date=None, end_date=None,
+                       marketplaceids=()):
+        self.requests.append(report_type)
+        return FakeResponse({'ReportRequestInfo': {
+            'ReportRequestId': {'value': report_type},
+        }})
+
+    def get_report_request_list(self, requestids=(), **kwargs):
+        if self.pending:
+            return FakeResponse({'ReportRequestInfo': [{
+                'ReportRequestId': {'value': request_id},
+                'ReportProcessingStatus': {'value': '_IN_PROGRESS_'},
+            } for request_id in requestids]})
+        return FakeResponse({'ReportRequestInfo': [{
+            'ReportRequestId': {'value': request_id},
+            'ReportProcessingStatus': {'value': '_DONE_'},
+            'GeneratedReportId': {'value': request_id},
+        } for request_id in requestids]})
+
+    def get_report(self, report_id):
+        return FakeResponse(original=self.reports[report_id])
+
+
+class TestChannel(TestBase):
+    '''
+    Tests Sale Channel
+    '''
+
+    def test_0010_last_updated_after(self):
+        """
+        Tests the LastUpdatedAfter used to import orders
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            import_time = datetime.utcnow().replace(microsecond=0)
+            last_import_time = import_time - relativedelta(hours=1)
+            self.SaleChannel.write([self.sale_channel], {
+                'amazon_order_import_mode': 'incremental',
+                'amazon_import_overlap': 30,
+                'last_order_import_time': last_import_time,
+            })
+
+            # Incremental import starts from the watermark minus the
+            # overlap
+            self.assertEqual(
+                self.sale_channel.get_amazon_last_updated_after(
+                    import_time
+                ),
+                last_import_time - relativedelta(minutes=30)
+            )
+
+            # Without a watermark last 10 days are imported
+            self.SaleChannel.write([self.sale_channel], {
+                'last_order_import_time': None,
+            })
+            self.assertEqual(
+                self.sale_channel.get_amazon_last_updated_after(
+                    import_time
+                ).date(),
+                Date.today() - relativedelta(days=10)
+            )
+
+            # Window mode ignores the watermark
+            self.SaleChannel.write([self.sale_channel], {
+                'amazon_order_import_mode': 'window',
+                'last_order_import_time': last_import_time,
+            })
+            self.assertEqual(
+                self.sale_channel.get_amazon_last_updated_after(
+                    import_time
+                ).date(),
+                Date.today() - relativedelta(days=10)
+            )
+
+    def test_0020_order_pages(self):
+        """
+        Tests the pages of orders are fetched ahead and deduplicated
+        """
+        order = load_json('orders', 'order_list')['Orders']['Order']
+        order_afn = load_json('orders', 'order_list_afn')['Orders']['Order']
+        order_api = FakeOrderAPI([[order, order], order_afn, [order_afn]])
+
+        pages = list(prefetch(iter_order_pages(order_api, {})))
+
+        self.assertEqual(pages, [
+            ([order], '1'),
+            ([order_afn], '2'),
+            ([order_afn], None),
+        ])
+
+        # Resume from a token
+        pages = list(prefetch(iter_order_pages(order_api, next_token='2')))
+        self.assertEqual(pages, [([order_afn], None)])
+
+    def test_0030_import_cache(self):
+        """
+        Tests the reference data cache of import runs
+        """
+        cache = LRUCache(size_limit=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # Least recently used key is evicted
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 2)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            import_cache = AmazonImportCache()
+            self.assertEqual(import_cache.get_currency('USD'), self.usd)
+            self.assertEqual(
+                import_cache.get_subdivision('fl', self.country1),
+                self.subdivision1
+            )
+            self.assertIsNone(
+                import_cache.get_subdivision('XX', self.country1)
+            )
+            self.assertEqual(
+                import_cache.get_channel_uom(self.sale_channel), self.uom
+            )
+
+            # Values are served from the cache
+            self.Currency.write([self.usd], {'code': 'USX'})
+            self.assertEqual(import_cache.get_currency('USD'), self.usd)
+
+            # The cache of a run is kept on the transaction, not in its
+            # context
+            self.assertFalse(get_import_cache() is get_import_cache())
+            with import_cache_run(import_cache):
+                self.assertTrue(get_import_cache() is import_cache)
+                with import_cache_run() as cache:
+                    self.assertTrue(cache is import_cache)
+                self.assertFalse(
+                    'amazon_import_cache' in Transaction().context
+                )
+            self.assertFalse(get_import_cache() is import_cache)
+
+    def test_0040_export_product_prices(self):
+        """
+        Tests prices are exported with the price list of the channel and
+        only when they changed
+        """
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        FeedQueue = POOL.get('amazon.feed.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'SKU1',
+                'asin': 'BUYGBS6866',
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(self.sale_channel.export_product_prices(), 1)
+                entry, = FeedQueue.search([])
+                self.assertEqual(entry.key, 'SKU1')
+                # Price list of the channel adds 10%
+                self.assertTrue(
+                    '>11.00</StandardPrice>' in entry.payload
+                )
+                self.assertEqual(
+                    Listing(listing.id).amazon_exported_price,
+                    Decimal('11.00')
+                )
+
+                # Price did not change
+                self.assertEqual(self.sale_channel.export_product_prices(), 0)
+
+                Product.write([product], {'list_price': Decimal('20.0')})
+                self.assertEqual(self.sale_channel.export_product_prices(), 1)
+
+    def test_0050_product_cache(self):
+        """
+        Tests the products of SKUs are cached per channel and invalidated
+        when listings change
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'SKU1',
+                'fba_code': 'FBA1',
+                'asin': 'BUYGBS6866',
+            }])
+
+            self.assertEqual(
+                self.sale_channel.get_amazon_product_ids(
+                    ['SKU1', 'FBA1', 'SKU2']
+                ),
+                {'SKU1': product.id, 'FBA1': product.id}
+            )
+            # The listing could still be rolled back
+            self.assertEqual(
+                self.sale_channel._amazon_product_cache.get(
+                    (self.sale_channel.id, 'sku', 'SKU1')
+                ),
+                None
+            )
+
+            # As if the listing was created by a committed transaction
+            Transaction().create_records.clear()
+            self.assertEqual(
+                self.sale_channel.get_amazon_product_ids(['SKU1', 'FBA1']),
+                {'SKU1': product.id, 'FBA1': product.id}
+            )
+            self.assertEqual(
+                self.sale_channel.get_product('FBA1', {
+                    'FulfillmentChannel': 'AFN',
+                    'ASIN': 'BUYGBS6866',
+                }),
+                product
+            )
+
+            # Exporting inventory keeps the cache
+            Listing.write([listing], {'amazon_exported_quantity': 1})
+            self.assertEqual(
+                self.sale_channel._amazon_product_cache.get(
+                    (self.sale_channel.id, 'sku', 'SKU1')
+                ),
+                product.id
+            )
+
+            Listing.write([listing], {'product_identifier': 'SKU2'})
+            self.assertEqual(
+                self.sale_channel.get_amazon_product_ids(['SKU1', 'SKU2']),
+                {'SKU2': product.id}
+            )
+
+    def test_0060_import_products_in_bulk(self):
+        """
+        Tests unknown SKUs are matched on amazon in batches
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Listing = POOL.get('product.product.channel_listing')
+
+        product_api = FakeProductAPI()
+        get_amazon_product_api = SaleChannel.get_amazon_product_api
+        SaleChannel.get_amazon_product_api = lambda self: product_api
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+
+                skus = ['SKU%d' % i for i in range(7)]
+                with Transaction().set_context({
+                    'current_channel': self.sale_channel.id,
+                    'company': self.company.id,
+                }):
+                    products = self.sale_channel.import_amazon_products(
+                        dict((sku, {
+                            'FulfillmentChannel': 'MFN',
+                            'ASIN': 'ASIN-%s' % sku,
+                        }) for sku in skus)
+                    )
+
+                self.assertEqual(sorted(products), skus)
+                self.assertEqual(
+                    sorted(p.code for p in products.values()), skus
+                )
+                self.assertEqual(
+                    sorted(
+                        (l.product_identifier, l.asin)
+                        for l in Listing.search([])
+                    ),
+                    [(sku, 'ASIN-%s' % sku) for sku in skus]
+                )
+                # At most 5 SKUs per request
+                self.assertEqual(
+                    sorted(map(len, product_api.requests)), [2, 5]
+                )
+
+                # Listed SKUs are not asked again
+                with Transaction().set_context({
+                    'current_channel': self.sale_channel.id,
+                }):
+                    self.assertEqual(
+                        self.sale_channel.import_product('SKU1', {
+                            'FulfillmentChannel': 'MFN',
+                            'ASIN': 'ASIN-SKU1',
+                        }),
+                        products['SKU1']
+                    )
+                self.assertEqual(len(product_api.requests), 2)
+        finally:
+            SaleChannel.get_amazon_product_api = get_amazon_product_api
+
+    def test_0065_import_products_sharing_asin(self):
+        """
+        Tests the MFN and FBA SKUs of an ASIN get one product and listing
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Listing = POOL.get('product.product.channel_listing')
+        Template = POOL.get('product.template')
+
+        product_api = FakeProductAPI({
+            'SKU-SHARED-MFN': 'ASIN-SHARED',
+            'SKU-SHARED-FBA': 'ASIN-SHARED',
+        })
+        get_amazon_product_api = SaleChannel.get_amazon_product_api
+        SaleChannel.get_amazon_product_api = lambda self: product_api
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                templates = Template.search([], count=True)
+
+                with Transaction().set_context({
+                    'current_channel': self.sale_channel.id,
+                    'company': self.company.id,
+                }):
+                    products = self.sale_channel.import_amazon_products(
+                        OrderedDict([
+                            ('SKU-SHARED-FBA', {
+                                'FulfillmentChannel': 'AFN',
+                                'ASIN': 'ASIN-SHARED',
+                            }),
+                            ('SKU-SHARED-MFN', {
+                                'FulfillmentChannel': 'MFN',
+                                'ASIN': 'ASIN-SHARED',
+                            }),
+                        ])
+                    )
+
+                self.assertEqual(Template.search([], count=True), templates + 1)
+                product = products['SKU-SHARED-MFN']
+                self.assertEqual(products['SKU-SHARED-FBA'], product)
+                listing, = Listing.search([])
+                self.assertEqual(listing.product, product)
+                self.assertEqual(listing.product_identifier, 'SKU-SHARED-MFN')
+                self.assertEqual(listing.fba_code, 'SKU-SHARED-FBA')
+                self.assertEqual(listing.asin, 'ASIN-SHARED')
+
+                # Both SKUs are known from now on
+                self.assertEqual(
+                    self.sale_channel.get_amazon_product_ids(
+                        ['SKU-SHARED-MFN', 'SKU-SHARED-FBA']
+                    ),
+                    {
+                        'SKU-SHARED-MFN': product.id,
+                        'SKU-SHARED-FBA': product.id,
+                    }
+                )
+        finally:
+            SaleChannel.get_amazon_product_api = get_amazon_product_api
+
+    def test_0070_import_catalog(self):
+        """
+        Tests the catalog is imported from the reports of amazon
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Listing = POOL.get('product.product.channel_listing')
+
+        report_api = FakeReportAPI()
+        get_amazon_report_api = SaleChannel.get_amazon_report_api
+        SaleChannel.get_amazon_report_api = lambda self: report_api
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                SaleChannel.write([self.sale_channel], {
+                    'amazon_commit_per_page': False,
+                })
+
+                SaleChannel(self.sale_channel.id).request_amazon_catalog()
+                # Reports being generated are not requested again
+                channel = SaleChannel(self.sale_channel.id)
+                channel.request_amazon_catalog()
+                self.assertEqual(len(report_api.requests), 2)
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(
+                    channel.amazon_catalog_requests,
+                    '_GET_MERCHANT_LISTINGS_DATA_,_GET_AFN_INVENTORY_DATA_'
+                )
+
+                with Transaction().set_context(company=self.company.id):
+                    self.assertEqual(
+                        channel.import_amazon_catalog_reports(), 3
+                    )
+                self.assertEqual(
+                    SaleChannel(self.sale_channel.id).amazon_catalog_requests,
+                    None
+                )
+
+                listings = dict(
+                    (l.product_identifier, l) for l in Listing.search([])
+                )
+                self.assertEqual(
+                    sorted(listings), ['SKU-B', 'SKU-C', 'SKU-MFN']
+                )
+                # The FBA SKU of an ASIN is added to its listing
+                self.assertEqual(listings['SKU-MFN'].fba_code, 'SKU-FBA')
+                self.assertEqual(listings['SKU-MFN'].asin, 'ASIN1')
+                self.assertEqual(
+                    listings['SKU-MFN'].product.template.name, u'Caf\xe9 Mug'
+                )
+                self.assertEqual(listings['SKU-B'].fba_code, None)
+                self.assertEqual(
+                    listings['SKU-B'].product.list_price, Decimal('12.50')
+                )
+                self.assertEqual(listings['SKU-C'].fba_code, 'SKU-C')
+                self.assertEqual(listings['SKU-C'].product.code, 'SKU-C')
+
+                # Importing the catalog again changes nothing
+                channel = SaleChannel(self.sale_channel.id)
+                channel.request_amazon_catalog()
+                with Transaction().set_context(company=self.company.id):
+                    self.assertEqual(
+                        channel.import_amazon_catalog_reports(), 0
+                    )
+                self.assertEqual(len(Listing.search([])), 3)
+
+                # Reports not generated are imported by a later call, or
+                # given up after a while
+                channel = SaleChannel(self.sale_channel.id)
+                channel.request_amazon_catalog()
+                report_api.pending = True
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(channel.import_amazon_catalog_reports(), 0)
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertTrue(channel.amazon_catalog_requests)
+
+                SaleChannel.write([channel], {
+                    'amazon_catalog_request_time': (
+                        datetime.utcnow() - relativedelta(hours=3)
+                    ),
+                })
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(channel.import_amazon_catalog_reports(), 0)
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(channel.amazon_catalog_requests, None)
+        finally:
+            SaleChannel.get_amazon_report_api = get_amazon_report_api
+
+        self.assertEqual(report_api.requests, [
+            '_GET_MERCHANT_LISTINGS_DATA_', '_GET_AFN_INVENTORY_DATA_',
+        ] * 3)
+
+    def test_0080_import_orders_checkpoint(self):
+        """
+        Tests an interrupted import is resumed from the saved NextToken
+        and an expired token starts the import again
+        """
+        SaleChannel = POOL.get('sale.channel')
+        ChannelState = POOL.get('sale.channel.order_state')
+
+        pages = [[{'AmazonOrderId': {'value': str(i)}}] for i in range(3)]
+        imported = []
+
+        def import_mws_order_bulk(self, orders):
+            imported.append([o['AmazonOrderId']['value'] for o in orders])
+            return []
+
+        order_api = FakeOrderAPI(pages, expired=['2'])
+        get_amazon_order_api = SaleChannel.get_amazon_order_api
+        import_order_bulk = SaleChannel.import_mws_order_bulk
+        SaleChannel.get_amazon_order_api = lambda self: order_api
+        SaleChannel.import_mws_order_bulk = import_mws_order_bulk
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                SaleChannel.write([self.sale_channel], {
+                    'amazon_commit_per_page': False,
+                    'last_order_import_time': None,
+                })
+                ChannelState.create([{
+                    'name': 'Unshipped',
+                    'code': 'Unshipped',
+                    'action': 'process_automatically',
+                    'invoice_method': 'order',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel.id,
+                }])
+
+                # The third page fails, the token of the page is kept
+                SaleChannel(self.sale_channel.id).import_orders()
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(imported, [['0'], ['1']])
+                self.assertEqual(channel.amazon_next_token, '2')
+                self.assertTrue(channel.amazon_next_token_after)
+                self.assertTrue(channel.amazon_next_token_before)
+                self.assertIsNone(channel.last_order_import_time)
+                import_time = channel.amazon_next_token_before
+
+                # The next run resumes from the token and completes
+                order_api.expired.clear()
+                del imported[:]
+                del order_api.requests[:]
+                channel.import_orders()
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(order_api.requests, ['2'])
+                self.assertEqual(imported, [['2']])
+                self.assertIsNone(channel.amazon_next_token)
+                self.assertIsNone(channel.amazon_next_token_after)
+                self.assertIsNone(channel.amazon_next_token_before)
+                # The watermark is the start of the interrupted import
+                self.assertEqual(channel.last_order_import_time, import_time)
+
+                # An expired token is forgotten without moving the
+                # watermark
+                SaleChannel.write([channel], {
+                    'amazon_next_token': 'expired',
+                    'amazon_next_token_after': import_time,
+                    'amazon_next_token_before': import_time,
+                })
+                order_api.expired.add('expired')
+                del imported[:]
+                del order_api.requests[:]
+                SaleChannel(self.sale_channel.id).import_orders()
+                channel = SaleChannel(self.sale_channel.id)
+                self.assertEqual(order_api.requests, ['expired'])
+                self.assertEqual(imported, [])
+                self.assertIsNone(channel.amazon_next_token)
+                self.assertEqual(channel.last_order_import_time, import_time)
+
+                # So that the next run starts a new window
+                del order_api.requests[:]
+                channel.import_orders()
+                self.assertEqual(order_api.requests, [None, '1', '2'])
+                self.assertEqual(imported, [['0'], ['1'], ['2']])
+        finally:
+            SaleChannel.get_amazon_order_api = get_amazon_order_api
+            SaleChannel.import_mws_order_bulk = import_order_bulk
+
+    def test_0090_fetch_order_items(self):
+        """
+        Tests the items of orders are fetched by threads in the order of
+        the orders and errors of the threads are raised
+        """
+        order_ids = [str(i) for i in range(10)]
+
+        order_api = FakeOrderItemsAPI()
+        self.assertEqual(
+            list(fetch_order_items(order_api, order_ids, workers=4)),
+            [[order_id] for order_id in order_ids]
+        )
+        self.assertTrue(len(order_api.threads) > 1)
+
+        # A single order is fetched without threads
+        order_api = FakeOrderItemsAPI()
+        self.assertEqual(
+            list(fetch_order_items(order_api, ['3'])), [['3']]
+        )
+        self.assertEqual(
+            order_api.threads, set([threading.current_thread().ident])
+        )
+
+        # Items fetched before the error are yielded
+        order_api = FakeOrderItemsAPI(errors=['5'])
+        items = fetch_order_items(order_api, order_ids, workers=4)
+        for order_id in order_ids[:5]:
+            self.assertEqual(next(items), [order_id])
+        self.assertRaises(mws.MWSError, next, items)
+
+    def test_0100_sync_worker(self):
+        """
+        Tests the scheduler workers forked during a transaction start
+        their own
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            pool = multiprocessing.Pool(1, initializer=init_sync_worker)
+            try:
+                state, = pool.map(worker_transaction_state, [None])
+                stats = pool.map(
+                    sync_merchant_channels, [(DB_NAME, USER, [])]
+                )
+            finally:
+                pool.close()
+                pool.join()
+
+            self.assertEqual(state, (None, None, None))
+            self.assertEqual(stats, [[]])
+
+            # The transaction of the parent is untouched
+            self.assertEqual(Transaction().user, USER)
+            self.assertTrue(Transaction().cursor is not None)
+            self.assertEqual(
+                self.SaleChannel.search([
+                    ('id', '=', self.sale_channel.id),
+                ]),
+                [self.sale_channel]
+            )
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestChannel)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+    test_feed
+
+    Tests Feed Queue
+
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from datetime import datetime, timedelta
+from lxml import etree
+from lxml.builder import E
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase
+from trytond.modules.amazon_mws.feed import iter_feed_files
+
+
+PROCESSING_REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<AmazonEnvelope>
+    <Header>
+        <DocumentVersion>1.02</DocumentVersion>
+        <MerchantIdentifier>1234</MerchantIdentifier>
+    </Header>
+    <MessageType>ProcessingReport</MessageType>
+    <Message>
+        <MessageID>1</MessageID>
+        <ProcessingReport>
+            <DocumentTransactionID>50001</DocumentTransactionID>
+            <StatusCode>Complete</StatusCode>
+            <ProcessingSummary>
+                <MessagesProcessed>3</MessagesProcessed>
+                <MessagesSuccessful>2</MessagesSuccessful>
+                <MessagesWithError>1</MessagesWithError>
+                <MessagesWithWarning>0</MessagesWithWarning>
+            </ProcessingSummary>
+            <Result>
+                <MessageID>2</MessageID>
+                <ResultCode>Error</ResultCode>
+                <ResultMessageCode>13013</ResultMessageCode>
+                <ResultDescription>SKU not found</ResultDescription>
+                <AdditionalInfo>
+                    <SKU>SKU1</SKU>
+                </AdditionalInfo>
+            </Result>
+        </ProcessingReport>
+    </Message>
+</AmazonEnvelope>
+"""
+
+
+class FakeResponse(object):
+
+    def __init__(self, parsed=None, original=None):
+        self.parsed = parsed
+        self.original = original
+
+
+class FakeFeedAPI(object):
+    """
+    Feed api recording the submitted feeds
+    """
+
+    def __init__(self, statuses=None):
+        self.feeds = []
+        self.statuses = statuses or {}
+
+    def submit_feed(self, feed, feed_type, marketplaceids=None):
+        self.feeds.append((feed, feed_type))
+        return FakeResponse({
+            'FeedSubmissionInfo': {
+                'FeedSubmissionId': {'value': str(len(self.feeds))},
+                'FeedProcessingStatus': {'value': '_SUBMITTED_'},
+            }
+        })
+
+    def get_feed_submission_result(self, feedid):
+        return FakeResponse(original=PROCESSING_REPORT)
+
+    def get_feed_submission_list(self, feedids=None):
+        return FakeResponse({
+            'FeedSubmissionInfo': [{
+                'FeedSubmissionId': {'value': feed_id},
+                'FeedProcessingStatus': {'value': self.statuses[feed_id]},
+            } for feed_id in feedids if feed_id in self.statuses],
+            'HasNext': {'value': 'false'},
+        })
+
+
+def inventory_message(sku, quantity):
+    return E.Message(
+        E.OperationType('Update'),
+        E.Inventory(
+            E.SKU(sku),
+            E.Quantity(str(quantity)),
+        )
+    )
+
+
+class TestFeed(TestBase):
+    '''
+    Tests Feed Queue
+    '''
+
+    def test_0010_enqueue_coalesce(self):
+        """
+        Tests a newer message supersedes the pending one of the same key
+        """
+        FeedQueue = POOL.get('amazon.feed.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            first, second = FeedQueue.enqueue(
+                self.sale_channel, '_POST_INVENTORY_AVAILABILITY_DATA_', [
+                    ('SKU1', inventory_message('SKU1', 10), None),
+                    ('SKU2', inventory_message('SKU2', 5), None),
+                ]
+            )
+            newer, = FeedQueue.enqueue(
+                self.sale_channel, '_POST_INVENTORY_AVAILABILITY_DATA_', [
+                    ('SKU1', inventory_message('SKU1', 7), None),
+                    ('SKU1', inventory_message('SKU1', 8), None),
+                ]
+            )
+
+            pending = FeedQueue.search([('state', '=', 'pending')])
+            self.assertEqual(len(pending), 2)
+            self.assertTrue(newer in pending)
+            self.assertTrue('<Quantity>8</Quantity>' in newer.payload)
+            self.assertEqual(
+                FeedQueue.search([('state', '=', 'superseded')]),
+                [first if first.key == 'SKU1' else second]
+            )
+
+    def test_0020_submit(self):
+        """
+        Tests the queued messages are submitted in one feed and the
+        result of the submission is recorded
+        """
+        FeedQueue = POOL.get('amazon.feed.queue')
+        Submission = POOL.get('amazon.feed.submission')
+        SaleChannel = POOL.get('sale.channel')
+
+        feeds_api = FakeFeedAPI()
+        get_amazon_feed_api = SaleChannel.get_amazon_feed_api
+        SaleChannel.get_amazon_feed_api = lambda self: feeds_api
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+
+                entries = FeedQueue.enqueue(
+                    self.sale_channel,
+                    '_POST_INVENTORY_AVAILABILITY_DATA_', [
+                        ('SKU%d' % i, inventory_message('SKU%d' % i, i), None)
+                        for i in range(3)
+                    ]
+                )
+                submission, = FeedQueue.submit(
+                    self.sale_channel, '_POST_INVENTORY_AVAILABILITY_DATA_',
+                    entries
+                )
+
+                self.assertEqual(submission.submission_id, '1')
+                self.assertEqual(submission.message_count, 3)
+                self.assertTrue(
+                    all(e.state == 'submitted' for e in submission.entries)
+                )
+
+                # Only the message amazon could not process is queued
+                # again
+                submission.process_result(feeds_api)
+                submission = Submission(submission.id)
+                self.assertEqual(submission.state, 'done')
+                self.assertEqual(submission.messages_with_error, 1)
+                failed, = FeedQueue.search([('state', '=', 'pending')])
+                self.assertEqual(failed.message_id, 2)
+                self.assertEqual(failed.error, '13013: SKU not found')
+                self.assertEqual(
+                    len(FeedQueue.search([('state', '=', 'done')])), 2
+                )
+        finally:
+            SaleChannel.get_amazon_feed_api = get_amazon_feed_api
+
+        (feed, feed_type), = feeds_api.feeds
+        self.assertEqual(feed_type, '_POST_INVENTORY_AVAILABILITY_DATA_')
+        envelope = etree.fromstring(feed)
+        self.assertEqual(envelope.findtext('MessageType'), 'Inventory')
+        self.assertEqual(
+            [m.findtext('MessageID') for m in envelope.findall('Message')],
+            ['1', '2', '3']
+        )
+
+    def test_0025_poll_unreported(self):
+        """
+        Tests submissions amazon does not report are cancelled after a
+        while and their messages queued again
+        """
+        FeedQueue = POOL.get('amazon.feed.queue')
+        Submission = POOL.get('amazon.feed.submission')
+
+        SaleChannel = POOL.get('sale.channel')
+
+        feeds_api = FakeFeedAPI()
+        get_amazon_feed_api = SaleChannel.get_amazon_feed_api
+        SaleChannel.get_amazon_feed_api = lambda self: feeds_api
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+
+                cursor = Transaction().cursor
+                # Keep the test data out of the database
+                cursor.commit = lambda: None
+
+                entries = FeedQueue.enqueue(
+                    self.sale_channel, '_POST_INVENTORY_AVAILABILITY_DATA_', [
+                        ('SKU%d' % i, inventory_message('SKU%d' % i, i), None)
+                        for i in range(2)
+                    ]
+                )
+                reported, unreported = [
+                    next(FeedQueue.submit(
+                        self.sale_channel,
+                        '_POST_INVENTORY_AVAILABILITY_DATA_', [entry]
+                    )) for entry in entries
+                ]
+                feeds_api.statuses[reported.submission_id] = '_IN_PROGRESS_'
+
+                # Submissions may not be listed by amazon right away
+                Submission.poll_submissions(feeds_api, [reported, unreported])
+                self.assertEqual(
+                    [s.state for s in Submission.browse([
+                        reported.id, unreported.id
+                    ])],
+                    ['submitted', 'submitted']
+                )
+
+                submission = Submission.__table__()
+                cursor.execute(*submission.update(
+                    [submission.create_date],
+                    [datetime.utcnow() - timedelta(days=91)]
+                ))
+                # Drop the create dates read before the update
+                cursor.cache.clear()
+                Submission.poll_submissions(
+                    feeds_api, Submission.browse([reported.id, unreported.id])
+                )
+                reported, unreported = Submission.browse([
+                    reported.id, unreported.id
+                ])
+                self.assertEqual(reported.state, 'submitted')
+                self.assertEqual(reported.processing_status, '_IN_PROGRESS_')
+                self.assertEqual(unreported.state, 'cancelled')
+                failed, = FeedQueue.search([('state', '=', 'pending')])
+                self.assertEqual(failed, entries[1])
+                self.assertEqual(
+                    failed.error, 'Feed submission not reported by amazon'
+                )
+        finally:
+            SaleChannel.get_amazon_feed_api = get_amazon_feed_api
+
+    def test_0030_feed_files(self):
+        """
+        Tests messages are split in envelopes within the limits
+        """
+        envelope = E.AmazonEnvelope(E.MessageType('Inventory'))
+        messages = [inventory_message('SKU%d' % i, i) for i in range(5)]
+
+        feeds = [
+            (etree.fromstring(feed.read()), count)
+            for feed, count in iter_feed_files(
+                envelope, iter(messages), max_messages=2
+            )
+        ]
+        self.assertEqual([count for _, count in feeds], [2, 2, 1])
+        for envelope_xml, count in feeds:
+            self.assertEqual(envelope_xml.findtext('MessageType'), 'Inventory')
+            self.assertEqual(
+                [m.findtext('MessageID') for m in envelope_xml.iter('Message')],
+                map(str, range(1, count + 1))
+            )
+        self.assertEqual(
+            [
+                m.findtext('Inventory/SKU')
+                for envelope_xml, _ in feeds
+                for m in envelope_xml.iter('Message')
+            ],
+            ['SKU%d' % i for i in range(5)]
+        )
+
+        # A message too big for the size limit gets an envelope of its own
+        messages = [inventory_message('SKU%d' % i, i) for i in range(3)]
+        counts = [
+            count for _, count in iter_feed_files(
+                envelope, iter(messages), max_size=1
+            )
+        ]
+        self.assertEqual(counts, [1, 1, 1])
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestFeed)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
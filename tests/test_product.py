@@ -33,6 +33,7 @@ class TestProduct(TestBase):
         """Tests the function fields for codes
         """
         Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
             self.setup_defaults()
@@ -66,6 +67,29 @@ class TestProduct(TestBase):
             self.assertEqual(product.ean.code, '1234567890123')
             self.assertEqual(product.upc.code, '123456789012')
             self.assertEqual(product.asin.code, 'BUYGBS6866')
+            self.assertIsNone(product.isbn)
+
+            # Search products by their codes
+            self.assertEqual(
+                Product.search([('asin', '=', 'BUYGBS6866')]), [product]
+            )
+            self.assertEqual(
+                Product.search([('ean', 'ilike', '123456789%')]), [product]
+            )
+            self.assertFalse(Product.search([('upc', '=', 'BUYGBS6866')]))
+            self.assertEqual(
+                Product.search([('upc', 'in', ['123456789012', 'x'])]),
+                [product]
+            )
+
+            # Search products without a code of the type
+            self.assertFalse(Product.search([('asin', '=', None)]))
+            self.assertEqual(
+                Product.search([('isbn', '=', None)]), [product]
+            )
+            self.assertEqual(
+                Product.search([('asin', '!=', None)]), [product]
+            )
 
     def test_0020_create_product_using_amazon_data(self):
         """
@@ -86,6 +110,107 @@ class TestProduct(TestBase):
 
                 self.assertEqual(Product.search([], count=True), 1)
 
+    def test_0030_export_inventory_delta(self):
+        """
+        Tests only the listings whose inventory changed are exported
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+        FeedQueue = POOL.get('amazon.feed.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'code1',
+                'asin': 'BUYGBS6866',
+            }])
+
+            Listing.export_bulk_inventory([listing])
+            entry, = FeedQueue.search([('state', '=', 'pending')])
+            self.assertEqual(entry.key, 'code1')
+            listing = Listing(listing.id)
+            self.assertEqual(listing.amazon_exported_quantity, 0)
+            self.assertEqual(listing.amazon_exported_latency, 1)
+
+            # Nothing changed
+            Listing.export_bulk_inventory([listing])
+            self.assertEqual(FeedQueue.search([], count=True), 1)
+
+            # Full synchronisation sends it anyway
+            Listing.export_bulk_inventory([listing], full_sync=True)
+            self.assertEqual(FeedQueue.search([], count=True), 2)
+            self.assertNotEqual(
+                FeedQueue.search([('state', '=', 'pending')]), [entry]
+            )
+
+    def test_0040_listing_quantities(self):
+        """
+        Tests the quantities of listings are computed from the warehouse
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'type': 'goods',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'code1',
+                'asin': 'BUYGBS6866',
+            }])
+            self.assertEqual(
+                Listing.get_amazon_quantities([listing]), {listing.id: 0}
+            )
+
+            supplier, = Location.search([('code', '=', 'SUP')])
+            with Transaction().set_context(company=self.company.id):
+                moves = Move.create([{
+                    'product': product.id,
+                    'uom': self.uom.id,
+                    'quantity': 5,
+                    'from_location': supplier.id,
+                    'to_location':
+                        self.sale_channel.warehouse.storage_location.id,
+                    'unit_price': Decimal('8.0'),
+                    'currency': self.company.currency.id,
+                }])
+                Move.do(moves)
+
+            self.assertEqual(
+                Listing.get_amazon_quantities([listing]), {listing.id: 5}
+            )
+
 
 def suite():
     """
@@ -7,6 +7,7 @@
 """
 import os
 import sys
+import copy
 import unittest
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -17,6 +18,7 @@ DIR = os.path.abspath(os.path.normpath(
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 from decimal import Decimal
+from datetime import datetime, timedelta
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
@@ -216,6 +218,12 @@ class TestSale(TestBase):
                 # Item lines + shipping line should be equal to lines on tryton
                 self.assertEqual(len(order.lines), 2)
 
+                # Amazon status of the order is recorded
+                self.assertEqual(order.amazon_order_status, 'Shipped')
+                self.assertFalse(order.is_amazon_order_changed(order_data))
+                order_data['LastUpdateDate']['value'] = '2013-09-17T05:15:54Z'
+                self.assertTrue(order.is_amazon_order_changed(order_data))
+
     def test_0020_check_matched_address_using_amazon_data(self):
         """
         Tests address if same address already exists
@@ -248,7 +256,7 @@ class TestSale(TestBase):
                 )
 
                 # Add address for party
-                Address.find_or_create_for_party_using_amazon_data(
+                address = Address.find_or_create_for_party_using_amazon_data(
                     party, order_data['ShippingAddress']
                 )
                 self.assertTrue(
@@ -274,6 +282,124 @@ class TestSale(TestBase):
                     ], count=True), 1
                 )
 
+                # Case and whitespaces are ignored
+                same_address = copy.deepcopy(address_data)
+                same_address['Name']['value'] = ' shalabh  AGGARWAL '
+                same_address['City']['value'] = 'ghaziabad, u.p.'
+                self.assertEqual(
+                    Address.find_or_create_for_party_using_amazon_data(
+                        party, same_address
+                    ),
+                    address
+                )
+
+                # A different subdivision is a different address
+                other_address = copy.deepcopy(address_data)
+                other_address['StateOrRegion']['value'] = 'Unknown'
+                new_address = \
+                    Address.find_or_create_for_party_using_amazon_data(
+                        party, other_address
+                    )
+                self.assertNotEqual(new_address, address)
+                self.assertIsNone(new_address.subdivision)
+
+                # The fingerprint follows the changes of the address
+                Address.write([new_address], {
+                    'subdivision': self.subdivision2.id,
+                })
+                self.assertEqual(
+                    Address(new_address.id).amazon_fingerprint,
+                    address.amazon_fingerprint
+                )
+                Address.write([new_address], {'zip': '201002'})
+                self.assertNotEqual(
+                    Address(new_address.id).amazon_fingerprint,
+                    address.amazon_fingerprint
+                )
+
+    def test_0022_migrate_address_fingerprint(self):
+        """
+        Tests the fingerprint of existing addresses is computed
+        """
+        Party = POOL.get('party.party')
+        Address = POOL.get('party.address')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            party, = Party.create([{
+                'name': 'Buyer',
+                'addresses': [('create', [{
+                    'name': 'Buyer %d' % i,
+                    'city': 'City',
+                    'country': self.country1.id,
+                    'subdivision': (i % 2) and self.subdivision1.id or None,
+                } for i in range(5)])],
+            }])
+            fingerprints = dict(
+                (a.id, a.amazon_fingerprint) for a in party.addresses
+            )
+            self.assertEqual(len(set(fingerprints.values())), 5)
+
+            cursor = Transaction().cursor
+            address = Address.__table__()
+            cursor.execute(*address.update(
+                [address.amazon_fingerprint], [None]
+            ))
+            Address.migrate_amazon_fingerprint()
+
+            cursor.execute(*address.select(
+                address.id, address.amazon_fingerprint,
+                where=address.party == party.id
+            ))
+            self.assertEqual(dict(cursor.fetchall()), fingerprints)
+
+    def test_0025_subdivision_using_amazon_state(self):
+        """
+        Tests subdivisions are found by code, name and alias
+        """
+        Subdivision = POOL.get('country.subdivision')
+        Alias = POOL.get('country.subdivision.amazon_alias')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            for value in ('FL', 'fl', 'US-FL', 'Florida', 'florida '):
+                self.assertEqual(
+                    Subdivision.search_using_amazon_state(
+                        value, self.country1
+                    ), self.subdivision1
+                )
+            self.assertEqual(
+                Subdivision.search_using_amazon_state(
+                    'Uttar-Pradesh', self.country2
+                ), self.subdivision2
+            )
+
+            # Unmatched value is recorded
+            self.assertIsNone(
+                Subdivision.search_using_amazon_state('Fla.', self.country1)
+            )
+            alias, = Alias.search([])
+            self.assertEqual(alias.value, 'Fla.')
+            self.assertIsNone(
+                Subdivision.search_using_amazon_state('Fla.', self.country1)
+            )
+            self.assertEqual(Alias.search([], count=True), 1)
+
+            # Another import may record the same value
+            Alias.create([{
+                'country': self.country1.id,
+                'value': 'Fla.',
+            }])
+
+            # Alias is used once its subdivision is set
+            Alias.write([alias], {'subdivision': self.subdivision1.id})
+            self.assertEqual(
+                Subdivision.search_using_amazon_state('fla', self.country1),
+                self.subdivision1
+            )
+
     def test_0030_create_duplicate_party(self):
         """
         Tests duplicate party is created with same amazon email
@@ -328,6 +454,56 @@ class TestSale(TestBase):
                     ], count=True), 1
                 )
 
+    def test_0035_bulk_parties(self):
+        """
+        Tests parties and phones of many buyers are found or created
+        in bulk
+        """
+        Party = POOL.get('party.party')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            existing = Party.create_using_amazon_data({
+                'name': 'Buyer 1',
+                'email': 'buyer1@marketplace.amazon.com',
+            })
+
+            parties = Party.find_or_create_bulk_using_amazon_data([{
+                'name': 'Buyer 1',
+                'email': 'buyer1@marketplace.amazon.com',
+            }, {
+                'name': 'Buyer 2',
+                'email': 'buyer2@marketplace.amazon.com',
+            }, {
+                'name': 'Buyer 2',
+                'email': 'buyer2@marketplace.amazon.com',
+            }])
+
+            self.assertEqual(len(parties), 2)
+            self.assertEqual(
+                parties['buyer1@marketplace.amazon.com'], existing
+            )
+            self.assertEqual(
+                Party.search([
+                    ('amazon_user_email', '=',
+                        'buyer2@marketplace.amazon.com'),
+                ], count=True), 1
+            )
+
+            buyer2 = parties['buyer2@marketplace.amazon.com']
+            Party.add_phones_using_amazon_data([
+                (existing, '1234'), (buyer2, '5678'), (buyer2, '5678'),
+            ])
+            Party.add_phones_using_amazon_data([(existing, '1234')])
+            self.assertEqual(
+                ContactMechanism.search([
+                    ('party', 'in', [existing.id, buyer2.id]),
+                    ('type', '=', 'phone'),
+                ], count=True), 2
+            )
+
     def test_0040_check_fba_orders_processing(self):
         """
         Tests handling of shipment of FBA type orders.
@@ -390,6 +566,301 @@ class TestSale(TestBase):
                     self.assertEqual(sale.state, 'done')
                     self.assertEqual(sale.shipment_state, 'sent')
 
+    def test_0045_create_sales_in_bulk(self):
+        """
+        Tests creation and processing of many sales at once
+        """
+        Sale = POOL.get('sale.sale')
+        Product = POOL.get('product.product')
+        ChannelException = POOL.get('channel.exception')
+        Listing = POOL.get('product.product.channel_listing')
+        Shipment = POOL.get('stock.shipment.out')
+        ChannelState = POOL.get('sale.channel.order_state')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.sale_channel.id,
+            }):
+                line_data = load_json(
+                    'orders', 'order_items'
+                )['OrderItems']['OrderItem']
+
+                ChannelState.create([{
+                    'name': 'Shipped',
+                    'code': 'Shipped',
+                    'action': 'import_as_past',
+                    'invoice_method': 'order',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel,
+                }, {
+                    'name': 'Unshipped',
+                    'code': 'Unshipped',
+                    'action': 'process_automatically',
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel,
+                }])
+
+                product_data = load_json('products', 'product-2')
+                product_data.update({
+                    'Id': {
+                        'value': line_data['SellerSKU']['value']
+                    }
+                })
+                product = Product.create_from(self.sale_channel, product_data)
+                Listing(
+                    product=product,
+                    channel=self.sale_channel,
+                    product_identifier=line_data['SellerSKU']['value'],
+                    asin=product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+                ).save()
+
+                orders = []
+                for order_id, status, total in [
+                    ('108-0000000-0000001', 'Shipped', '0.03'),
+                    ('108-0000000-0000002', 'Unshipped', '0.03'),
+                    ('108-0000000-0000003', 'Unshipped', '0.04'),
+                ]:
+                    order_data = load_json(
+                        'orders', 'order_list'
+                    )['Orders']['Order']
+                    order_data['AmazonOrderId']['value'] = order_id
+                    order_data['OrderStatus']['value'] = status
+                    order_data['OrderTotal']['Amount']['value'] = total
+                    # Order item ids are unique
+                    items = copy.deepcopy(line_data)
+                    items['OrderItemId']['value'] = order_id
+                    orders.append((order_data, items))
+
+                assigned = []
+                assign_try = Shipment.assign_try
+                Shipment.assign_try = classmethod(
+                    lambda cls, shipments: assigned.extend(shipments)
+                )
+                try:
+                    with Transaction().set_context(company=self.company.id):
+                        past, processed, mismatch = \
+                            Sale.create_bulk_using_amazon_data(orders)
+                finally:
+                    Shipment.assign_try = assign_try
+
+                self.assertEqual(past.state, 'done')
+                self.assertEqual(processed.state, 'processing')
+                self.assertEqual(processed.invoice_method, 'shipment')
+                # The shipments of processed sales are assigned if possible
+                self.assertEqual(assigned, list(processed.shipments))
+                self.assertEqual(mismatch.state, 'draft')
+                exception, = ChannelException.search([])
+                self.assertEqual(exception.origin, mismatch)
+                self.assertEqual(
+                    [s.channel_identifier for s in (
+                        past, processed, mismatch
+                    )],
+                    [o['AmazonOrderId']['value'] for o, _ in orders]
+                )
+
+    def test_0050_update_orders_status(self):
+        """
+        Tests shipments of orders shipped on amazon are processed together
+        """
+        Sale = POOL.get('sale.sale')
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        ChannelState = POOL.get('sale.channel.order_state')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.sale_channel.id,
+            }):
+                line_data = load_json(
+                    'orders', 'order_items'
+                )['OrderItems']['OrderItem']
+
+                ChannelState.create([{
+                    'name': 'Unshipped',
+                    'code': 'Unshipped',
+                    'action': 'process_automatically',
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel,
+                }])
+
+                product_data = load_json('products', 'product-2')
+                product_data.update({
+                    'Id': {
+                        'value': line_data['SellerSKU']['value']
+                    }
+                })
+                product = Product.create_from(self.sale_channel, product_data)
+                Listing(
+                    product=product,
+                    channel=self.sale_channel,
+                    product_identifier=line_data['SellerSKU']['value'],
+                    asin=product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+                ).save()
+
+                orders = []
+                for order_id in ('108-0000000-0000001', '108-0000000-0000002'):
+                    order_data = load_json(
+                        'orders', 'order_list'
+                    )['Orders']['Order']
+                    order_data['AmazonOrderId']['value'] = order_id
+                    order_data['OrderStatus']['value'] = 'Unshipped'
+                    # Order item ids are unique
+                    items = copy.deepcopy(line_data)
+                    items['OrderItemId']['value'] = order_id
+                    orders.append((order_data, items))
+
+                with Transaction().set_context(company=self.company.id):
+                    sales = Sale.create_bulk_using_amazon_data(orders)
+                    for sale in sales:
+                        self.assertEqual(sale.state, 'processing')
+                        self.assertEqual(
+                            [s.state for s in sale.shipments], ['waiting']
+                        )
+
+                    for order_data, _ in orders:
+                        order_data['OrderStatus']['value'] = 'Shipped'
+                    Sale.update_orders_status_from_amazon_mws([
+                        (sale, order_data)
+                        for sale, (order_data, _) in zip(sales, orders)
+                    ])
+
+                for sale in Sale.browse(map(int, sales)):
+                    self.assertEqual(sale.amazon_order_status, 'Shipped')
+                    self.assertEqual(
+                        [s.state for s in sale.shipments], ['done']
+                    )
+                    # Amazon knows these shipments already
+                    self.assertTrue(
+                        all(s.amazon_exported for s in sale.shipments)
+                    )
+
+    def test_0055_export_shipment_status(self):
+        """
+        Tests shipments are exported once, and only when done since the
+        export date of the channel
+        """
+        Sale = POOL.get('sale.sale')
+        Shipment = POOL.get('stock.shipment.out')
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        ChannelState = POOL.get('sale.channel.order_state')
+        FeedQueue = POOL.get('amazon.feed.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            # Channels export the shipments done from their creation
+            self.assertTrue(
+                self.sale_channel.amazon_last_shipment_export_time
+            )
+
+            with Transaction().set_context({
+                'current_channel': self.sale_channel.id,
+            }):
+                line_data = load_json(
+                    'orders', 'order_items'
+                )['OrderItems']['OrderItem']
+
+                ChannelState.create([{
+                    'name': 'Unshipped',
+                    'code': 'Unshipped',
+                    'action': 'process_automatically',
+                    'invoice_method': 'shipment',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel,
+                }])
+
+                product_data = load_json('products', 'product-2')
+                product_data.update({
+                    'Id': {
+                        'value': line_data['SellerSKU']['value']
+                    }
+                })
+                product = Product.create_from(self.sale_channel, product_data)
+                Listing(
+                    product=product,
+                    channel=self.sale_channel,
+                    product_identifier=line_data['SellerSKU']['value'],
+                    asin=product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+                ).save()
+
+                orders = []
+                for order_id in ('108-0000000-0000001', '108-0000000-0000002'):
+                    order_data = load_json(
+                        'orders', 'order_list'
+                    )['Orders']['Order']
+                    order_data['AmazonOrderId']['value'] = order_id
+                    order_data['OrderStatus']['value'] = 'Unshipped'
+                    # Order item ids are unique
+                    items = copy.deepcopy(line_data)
+                    items['OrderItemId']['value'] = order_id
+                    orders.append((order_data, items))
+
+                with Transaction().set_context(company=self.company.id):
+                    sales = Sale.create_bulk_using_amazon_data(orders)
+
+            shipments = [
+                s for sale in Sale.browse(map(int, sales))
+                for s in sale.shipments
+            ]
+            self.assertEqual(len(shipments), 2)
+            # Shipped by the merchant
+            with Transaction().set_context(company=self.company.id):
+                Shipment.assign(shipments)
+                Shipment.pack(shipments)
+                Shipment.done(shipments)
+            self.assertFalse(any(
+                s.amazon_exported for s in Shipment.browse(map(int, shipments))
+            ))
+
+            Shipment.export_shipment_status_to_amazon_using_cron()
+            entries = FeedQueue.search([('state', '=', 'pending')])
+            self.assertEqual(
+                sorted(e.key for e in entries),
+                sorted(
+                    '%s-%d' % (sale.channel_identifier, shipment.id)
+                    for sale in Sale.browse(map(int, sales))
+                    for shipment in sale.shipments
+                )
+            )
+            self.assertTrue(all(
+                s.amazon_exported for s in Shipment.browse(map(int, shipments))
+            ))
+
+            # Writing an exported shipment does not export it again
+            Shipment.write(shipments, {'reference': '1Z0001'})
+            Shipment.export_shipment_status_to_amazon_using_cron()
+            self.assertEqual(
+                FeedQueue.search([], count=True), len(entries)
+            )
+
+            # An explicit export queues the message again
+            self.assertEqual(
+                Shipment.export_bulk_shipment_status_to_amazon(
+                    shipments[:1]
+                ), 1
+            )
+            self.assertEqual(
+                FeedQueue.search([('state', '=', 'superseded')], count=True),
+                1
+            )
+
+            # Shipments done before the export date are not exported
+            Shipment.write(shipments, {'amazon_exported': False})
+            self.sale_channel.amazon_last_shipment_export_time = \
+                datetime.utcnow() + timedelta(days=1)
+            self.sale_channel.save()
+            Shipment.export_shipment_status_to_amazon_using_cron()
+            self.assertEqual(
+                FeedQueue.search([], count=True), len(entries) + 1
+            )
+
 
 def suite():
     """
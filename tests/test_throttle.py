@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    test_throttle
+
+    Tests throttling of MWS API calls
+
+"""
+import sys
+import os
+import time
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+import trytond.tests.test_tryton
+from mws import mws
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.modules.amazon_mws import throttle
+from trytond.modules.amazon_mws.throttle import TokenBucket, ThrottledAPI
+
+
+class FakeOrderAPI(object):
+    """
+    Order api which is throttled by amazon for the first `throttled`
+    calls
+    """
+
+    def __init__(self, throttled=0):
+        self.throttled = throttled
+        self.calls = 0
+
+    def list_orders(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.throttled:
+            raise mws.MWSError('<Code>RequestThrottled</Code>')
+        return 'orders'
+
+    def list_order_items(self, order_id):
+        raise mws.MWSError('<Code>InvalidParameterValue</Code>')
+
+
+class TestThrottle(unittest.TestCase):
+    '''
+    Tests token buckets and throttled api
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('amazon_mws')
+        self.sleeps = []
+        self._sleep = time.sleep
+        time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        time.sleep = self._sleep
+
+    def test_0010_bucket_quota(self):
+        """
+        Requests are free until the quota is used, then wait for the
+        restore rate
+        """
+        bucket = TokenBucket(2, 60)
+
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 60, places=0)
+        # Callers are queued
+        self.assertAlmostEqual(bucket.reserve(), 120, places=0)
+
+    def test_0020_bucket_restore(self):
+        """
+        Tokens are restored over time up to the maximum quota
+        """
+        bucket = TokenBucket(2, 60, tokens=0, timestamp=time.time() - 90)
+        tokens, _ = bucket.state()
+        self.assertAlmostEqual(tokens, 1.5, places=1)
+
+        bucket = TokenBucket(2, 60, tokens=0, timestamp=time.time() - 600)
+        tokens, _ = bucket.state()
+        self.assertEqual(tokens, 2)
+
+    def test_0030_bucket_merge(self):
+        """
+        Merging keeps the state with the least tokens
+        """
+        bucket = TokenBucket(6, 60)
+        bucket.merge(1, time.time())
+        tokens, _ = bucket.state()
+        self.assertAlmostEqual(tokens, 1, places=1)
+
+        bucket.merge(6, time.time())
+        tokens, _ = bucket.state()
+        self.assertAlmostEqual(tokens, 1, places=1)
+
+    def test_0040_throttled_api_retries(self):
+        """
+        Throttled requests are retried after backing off
+        """
+        api = FakeOrderAPI(throttled=2)
+        throttled_api = ThrottledAPI(api, {
+            'ListOrders': TokenBucket(6, 60),
+            'ListOrderItems': TokenBucket(30, 2),
+        })
+
+        self.assertEqual(throttled_api.list_orders(), 'orders')
+        self.assertEqual(api.calls, 3)
+        self.assertTrue(self.sleeps)
+
+    def test_0050_throttled_api_errors(self):
+        """
+        Errors other than throttling are raised
+        """
+        api = FakeOrderAPI()
+        throttled_api = ThrottledAPI(api, {
+            'ListOrders': TokenBucket(6, 60),
+            'ListOrderItems': TokenBucket(30, 2),
+        })
+
+        self.assertRaises(
+            mws.MWSError, throttled_api.list_order_items, '1234'
+        )
+        self.assertFalse(self.sleeps)
+
+    def saved_tokens(self, merchant_id):
+        """
+        Return the tokens saved per operation, read like another worker
+        """
+        Throttle = POOL.get('amazon.mws.throttle')
+
+        with Transaction().new_cursor():
+            return dict((r.operation, r.tokens) for r in Throttle.search([
+                ('merchant_id', '=', merchant_id),
+            ]))
+
+    def test_0060_persist_buckets(self):
+        """
+        Only the buckets used are saved and other workers merge them
+        """
+        Throttle = POOL.get('amazon.mws.throttle')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            throttle._buckets.clear()
+            buckets = Throttle.get_buckets('M1', 'MP1')
+
+            # Nothing used, nothing saved
+            Throttle.persist('M1', 'MP1')
+            self.assertEqual(self.saved_tokens('M1'), {})
+
+            buckets['ListOrders'].reserve()
+            buckets['ListOrders'].reserve()
+            Throttle.persist('M1', 'MP1')
+            saved = self.saved_tokens('M1')
+            self.assertEqual(saved.keys(), ['ListOrders'])
+            self.assertAlmostEqual(saved['ListOrders'], 4, places=1)
+            self.assertFalse(buckets['ListOrders'].used)
+
+            # Another worker starts from the saved state
+            throttle._buckets.clear()
+            with Transaction().new_cursor():
+                buckets = Throttle.get_buckets('M1', 'MP1')
+            tokens, _ = buckets['ListOrders'].state()
+            self.assertAlmostEqual(tokens, 4, places=1)
+            tokens, _ = buckets['GetOrder'].state()
+            self.assertEqual(tokens, 6)
+
+            buckets['ListOrders'].reserve()
+            Throttle.persist('M1', 'MP1')
+            saved = self.saved_tokens('M1')
+            self.assertAlmostEqual(saved['ListOrders'], 3, places=1)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            Throttle.delete(Throttle.search([('merchant_id', '=', 'M1')]))
+            Transaction().cursor.commit()
+        throttle._buckets.clear()
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+    throttle
+
+    Throttling of Amazon MWS API calls
+
+"""
+import time
+import logging
+import functools
+import threading
+
+from mws import mws
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+
+__all__ = ['MWSThrottle']
+
+logger = logging.getLogger("amazon_mws")
+
+#: Request quota of the throttled operations as
+#: (maximum request quota, seconds needed to restore one request)
+MWS_QUOTAS = {
+    'ListOrders': (6, 60),
+    'ListOrdersByNextToken': (6, 60),
+    'ListOrderItems': (30, 2),
+    'GetOrder': (6, 60),
+    'SubmitFeed': (15, 120),
+    'GetFeedSubmissionList': (10, 45),
+    'GetFeedSubmissionListByNextToken': (30, 2),
+    'GetFeedSubmissionResult': (15, 60),
+    'GetMatchingProductForId': (20, 0.2),
+    'RequestReport': (15, 60),
+    'GetReportRequestList': (10, 45),
+    'GetReport': (15, 60),
+}
+
+#: Map of the methods of the python mws api to the MWS operation
+MWS_OPERATIONS = {
+    'list_orders': 'ListOrders',
+    'list_orders_by_next_token': 'ListOrdersByNextToken',
+    'list_order_items': 'ListOrderItems',
+    'get_order': 'GetOrder',
+    'submit_feed': 'SubmitFeed',
+    'get_feed_submission_list': 'GetFeedSubmissionList',
+    'get_submission_list_by_next_token': 'GetFeedSubmissionListByNextToken',
+    'get_feed_submission_result': 'GetFeedSubmissionResult',
+    'get_matching_product_for_id': 'GetMatchingProductForId',
+    'request_report': 'RequestReport',
+    'get_report_request_list': 'GetReportRequestList',
+    'get_report': 'GetReport',
+}
+
+#: Number of times a throttled request is retried before giving up
+MAX_RETRIES = 5
+
+#: Maximum seconds to back off between two retries
+MAX_BACKOFF = 300
+
+# Buckets shared by all the api instances of this process
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def is_throttled(error):
+    """
+    Check if the MWSError was raised because the request was throttled
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and \
+            getattr(response, 'status_code', None) == 503:
+        return True
+    return 'RequestThrottled' in str(error)
+
+
+class TokenBucket(object):
+    """
+    Token bucket modelling the request quota of an MWS operation.
+
+    Every request takes a token and tokens are restored at the restore
+    rate of the operation, up to the maximum request quota. Tokens can
+    go below zero, the deficit is the time a caller has to wait so that
+    concurrent callers are served in order.
+    """
+
+    def __init__(self, capacity, restore_rate, tokens=None, timestamp=None):
+        self.capacity = capacity
+        self.restore_rate = restore_rate
+        self.tokens = capacity if tokens is None else tokens
+        self.timestamp = timestamp or time.time()
+        self.lock = threading.Lock()
+        # Tokens were taken since the state was last saved
+        self.used = False
+
+    def _refill(self, now):
+        if now > self.timestamp:
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.timestamp) / self.restore_rate
+            )
+            self.timestamp = now
+
+    def reserve(self):
+        """
+        Take a token from the bucket
+
+        :return: Seconds to wait before the request can be sent
+        """
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= 1
+            self.used = True
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens * self.restore_rate
+
+    def drain(self, deficit=0):
+        """
+        Empty the bucket, Amazon throttled a request so the quota is
+        exhausted whatever the local state says.
+
+        :param deficit: Extra tokens to owe, to back off further
+        """
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, -deficit)
+            self.used = True
+
+    def merge(self, tokens, timestamp):
+        """
+        Merge the state saved by another worker, keeping the most
+        conservative one.
+        """
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if timestamp and now > timestamp:
+                tokens = min(
+                    self.capacity,
+                    tokens + (now - timestamp) / self.restore_rate
+                )
+            self.tokens = min(self.tokens, tokens)
+
+    def state(self):
+        """
+        Return the current (tokens, timestamp) of the bucket
+        """
+        with self.lock:
+            self._refill(time.time())
+            return self.tokens, self.timestamp
+
+
+class ThrottledAPI(object):
+    """
+    Wrap an mws api instance so that calls to the throttled operations
+    wait for the quota instead of failing, and back off when amazon still
+    throttles the request.
+    """
+
+    def __init__(self, api, buckets):
+        self._api = api
+        self._buckets = buckets
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        operation = MWS_OPERATIONS.get(name)
+        if operation is None or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def throttled(*args, **kwargs):
+            return self._call(operation, attr, *args, **kwargs)
+
+        return throttled
+
+    def _call(self, operation, method, *args, **kwargs):
+        bucket = self._buckets[operation]
+        attempt = 0
+        while True:
+            wait = bucket.reserve()
+            if wait:
+                logger.info(
+                    "Waiting %.1f seconds for %s quota" % (wait, operation)
+                )
+                time.sleep(wait)
+            try:
+                return method(*args, **kwargs)
+            except mws.MWSError, e:
+                if not is_throttled(e) or attempt >= MAX_RETRIES:
+                    raise
+                # Back off exponentially, the wait is done when reserving
+                # the token for the next attempt.
+                bucket.drain(min(
+                    2 ** attempt, MAX_BACKOFF / bucket.restore_rate
+                ) - 1)
+                attempt += 1
+                logger.warning("%s request throttled" % operation)
+
+
+class MWSThrottle(ModelSQL):
+    """
+    Amazon MWS Throttle
+
+    State of the request quota of each MWS operation for a merchant and
+    marketplace, shared by the workers importing from the same account.
+    """
+    __name__ = 'amazon.mws.throttle'
+
+    merchant_id = fields.Char('Merchant ID', required=True, select=True)
+    marketplace_id = fields.Char('MarketPlace ID', select=True)
+    operation = fields.Char('Operation', required=True)
+    tokens = fields.Float('Tokens', required=True)
+    timestamp = fields.Float(
+        'Timestamp', required=True,
+        help="Unix time at which the tokens were last computed"
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(MWSThrottle, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'operation_uniq',
+                'UNIQUE(merchant_id, marketplace_id, operation)',
+                'Throttle state must be unique per operation'
+            )
+        ]
+
+    @classmethod
+    def get_buckets(cls, merchant_id, marketplace_id):
+        """
+        Return the token buckets of the merchant and marketplace
+
+        Buckets are shared by all the callers of this process and merged
+        with the state saved by the other workers.
+
+        :return: Dictionary mapping operation to TokenBucket
+        """
+        with _buckets_lock:
+            buckets = _buckets.setdefault((merchant_id, marketplace_id), {})
+            for operation, (capacity, restore_rate) in \
+                    MWS_QUOTAS.iteritems():
+                if operation not in buckets:
+                    buckets[operation] = TokenBucket(capacity, restore_rate)
+
+        for record in cls.search([
+            ('merchant_id', '=', merchant_id),
+            ('marketplace_id', '=', marketplace_id),
+        ]):
+            if record.operation in buckets:
+                buckets[record.operation].merge(
+                    record.tokens, record.timestamp
+                )
+        return buckets
+
+    @classmethod
+    def persist(cls, merchant_id, marketplace_id):
+        """
+        Save the state of the buckets used by this process since the last
+        save, merged with the state saved by the other workers.
+
+        The state is saved in a transaction of its own so that the rows
+        are not locked by the caller and a conflict with another worker
+        never aborts the caller, the state is then saved by the next call.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        with _buckets_lock:
+            buckets = dict(
+                (operation, bucket) for operation, bucket in
+                _buckets.get((merchant_id, marketplace_id), {}).iteritems()
+                if bucket.used
+            )
+        if not buckets:
+            return
+
+        with Transaction().new_cursor():
+            try:
+                records = dict((r.operation, r) for r in cls.search([
+                    ('merchant_id', '=', merchant_id),
+                    ('marketplace_id', '=', marketplace_id),
+                    ('operation', 'in', buckets.keys()),
+                ]))
+                to_write = []
+                to_create = []
+                for operation, bucket in buckets.iteritems():
+                    record = records.get(operation)
+                    if record is not None:
+                        bucket.merge(record.tokens, record.timestamp)
+                    bucket.used = False
+                    tokens, timestamp = bucket.state()
+                    values = {
+                        'tokens': tokens,
+                        'timestamp': timestamp,
+                    }
+                    if record is not None:
+                        to_write.extend([[record], values])
+                    else:
+                        values.update({
+                            'merchant_id': merchant_id,
+                            'marketplace_id': marketplace_id,
+                            'operation': operation,
+                        })
+                        to_create.append(values)
+                if to_write:
+                    cls.write(*to_write)
+                if to_create:
+                    cls.create(to_create)
+                Transaction().cursor.commit()
+            except (DatabaseOperationalError, DatabaseIntegrityError), e:
+                Transaction().cursor.rollback()
+                for bucket in buckets.itervalues():
+                    bucket.used = True
+                logger.info(
+                    "Throttle state of %s not saved: %s" % (merchant_id, e)
+                )